@@ -0,0 +1,55 @@
+"""
+BlockIdの作成と辞書引きのベンチマーク(frozen dataclassとの比較)
+
+    $ python benchmarks/bench_blockid.py --ops 1000000 --blocks 1000
+"""
+
+import argparse
+import time
+from dataclasses import dataclass
+
+from rdbms.storage.disk import BlockId
+
+
+@dataclass(frozen=True)
+class DataclassBlockId:
+    """以前の実装"""
+
+    filename: str
+    blknum: int
+
+
+def bench(cls, args: argparse.Namespace) -> tuple[float, float]:
+    table = {cls("bench.tbl", n): n for n in range(args.blocks)}
+    nums = [n % args.blocks for n in range(args.ops)]
+
+    start = time.perf_counter()
+    for n in nums:
+        cls("bench.tbl", n)
+    create = time.perf_counter() - start
+
+    # バッファの表やロック表のように、毎回作ったBlockIdで引く
+    start = time.perf_counter()
+    for n in nums:
+        table[cls("bench.tbl", n)]
+    lookup = time.perf_counter() - start
+    return create, lookup
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=1000000)
+    parser.add_argument("--blocks", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'impl':<12}{'create':>12}{'create+lookup':>16}")
+    for name, cls in (("dataclass", DataclassBlockId), ("BlockId", BlockId)):
+        create, lookup = bench(cls, args)
+        print(
+            f"{name:<12}{create / args.ops * 1e9:>10.1f}ns"
+            f"{lookup / args.ops * 1e9:>14.1f}ns"
+        )
+
+
+if __name__ == "__main__":
+    main()
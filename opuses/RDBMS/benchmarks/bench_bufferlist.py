@@ -0,0 +1,80 @@
+"""
+トランザクションのpin管理のベンチマーク(リストで持つ旧実装と回数で持つBufferListの比較)。
+1トランザクションで多数のブロックを2回ずつpinし、半分を1つずつunpinしてから残りを
+unpin_allする。
+
+    $ python benchmarks/bench_bufferlist.py --blocks 10000
+"""
+
+import argparse
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from rdbms.storage.buffer import Buffer, BufferList, BufferMgr, LogMgr
+from rdbms.storage.disk import BlockId, FileMgr
+
+
+@dataclass
+class ListBufferList:
+    """pinをリストで持っていた以前の実装"""
+
+    bm: BufferMgr
+    buffers: dict[BlockId, Buffer] = field(default_factory=dict)
+    pins: list[BlockId] = field(default_factory=list)
+
+    def pin(self, blk: BlockId) -> None:
+        self.buffers[blk] = self.bm.pin(blk)
+        self.pins.append(blk)
+
+    def unpin(self, blk: BlockId) -> None:
+        self.bm.unpin(self.buffers[blk])
+        self.pins.remove(blk)
+        if blk not in self.pins:
+            del self.buffers[blk]
+
+    def unpin_all(self) -> None:
+        for blk in self.pins:
+            self.bm.unpin(self.buffers[blk])
+        self.buffers.clear()
+        self.pins.clear()
+
+
+def run(cls, bm: BufferMgr, blks: list[BlockId]) -> float:
+    start = time.perf_counter()
+    bl = cls(bm)
+    for blk in blks:
+        bl.pin(blk)
+    for blk in blks:
+        bl.pin(blk)
+    for blk in blks[::2]:
+        bl.unpin(blk)
+    bl.unpin_all()
+    elapsed = time.perf_counter() - start
+    assert bm.available() == len(blks)
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fm = FileMgr(str(Path(tmp) / "bench"), 400, durability="none")
+        lm = LogMgr(fm, "logfile")
+        bm = BufferMgr(fm, lm, args.blocks)
+        blks = [fm.append("bench.tbl") for _ in range(args.blocks)]
+        run(BufferList, bm, blks)  # 全ブロックをプールに載せておく
+
+        print(f"{'impl':<16}{'time':>10}{'us/pin':>10}")
+        for name, cls in (("list", ListBufferList), ("Counter", BufferList)):
+            elapsed = run(cls, bm, blks)
+            us = elapsed / (2 * args.blocks) * 1e6
+            print(f"{name:<16}{elapsed:>9.3f}s{us:>10.2f}")
+        fm.close()
+
+
+if __name__ == "__main__":
+    main()
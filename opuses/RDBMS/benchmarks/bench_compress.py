@@ -0,0 +1,92 @@
+"""
+ブロック圧縮と圧縮キャッシュのベンチマーク。
+半分ほど埋まったテーブルのページを書き、プールより大きい範囲をランダムに読み直す。
+ディスクに書いた/読んだバイト数と時間を、生のFileMgr・CompressedFileMgr・
+圧縮キャッシュ付きで比べる。
+
+    $ python benchmarks/bench_compress.py --blocks 2000 --buffers 100
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.disk import CompressedFileMgr, FileMgr
+from rdbms.storage.metrics import metrics
+
+
+def fill(buff, n: int, rng: random.Random) -> None:
+    """固定長のレコード(整数2つと短い文字列)でページの半分を埋める"""
+    p = buff.contents
+    for i in range(0, len(p.contents()) // 2, 32):
+        p.set_int(i, n)
+        p.set_int(i + 4, rng.randrange(1000))
+        p.set_string(i + 8, f"name{rng.randrange(100)}")
+
+
+def run(args: argparse.Namespace, compressed: bool, cache: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        cls = CompressedFileMgr if compressed else FileMgr
+        fm = cls(str(Path(tmp) / "bench"), args.blocksize, durability="none")
+        lm = LogMgr(fm, "logfile")
+        bm = BufferMgr(fm, lm, args.buffers, compressed_cache=cache)
+        rng = random.Random(0)
+        blks = [fm.append("bench.tbl") for _ in range(args.blocks)]
+
+        metrics.reset()
+        metrics.enable()
+        start = time.perf_counter()
+        for n, blk in enumerate(blks):
+            buff = bm.pin(blk)
+            fill(buff, n, rng)
+            buff.set_modified(1, -1)
+            bm.unpin(buff)
+        bm.flush_all(1)
+        write_time = time.perf_counter() - start
+        written = metrics.snapshot()["counters"]["file_bytes_written"]
+
+        metrics.reset()
+        start = time.perf_counter()
+        hot = blks[: args.buffers * 4]
+        for _ in range(args.reads):
+            bm.unpin(bm.pin(rng.choice(hot)))
+        read_time = time.perf_counter() - start
+        read = metrics.snapshot()["counters"]["file_bytes_read"]
+        metrics.disable()
+        fm.close()
+        return {
+            "write": write_time,
+            "written": written,
+            "read": read_time,
+            "bytes_read": read,
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--blocksize", type=int, default=4096)
+    parser.add_argument("--buffers", type=int, default=100)
+    parser.add_argument("--reads", type=int, default=20000)
+    parser.add_argument("--cache", type=int, default=1 << 20)
+    args = parser.parse_args()
+
+    print(f"{'mode':<22}{'write':>9}{'written':>11}{'read':>9}{'bytes read':>12}")
+    for name, compressed, cache in (
+        ("raw", False, 0),
+        ("compressed", True, 0),
+        ("raw + ccache", False, args.cache),
+        ("compressed + ccache", True, args.cache),
+    ):
+        r = run(args, compressed, cache)
+        print(
+            f"{name:<22}{r['write']:>8.3f}s{r['written'] // 1024:>9}KB"
+            f"{r['read']:>8.3f}s{r['bytes_read'] // 1024:>10}KB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+FileMgrの耐久性・I/Oモードごとの比較
+
+    $ python benchmarks/bench_filemgr.py --blocks 2000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from rdbms.storage.disk import BlockId, FileMgr, Page
+
+MODES = {
+    "none": dict(durability="none"),
+    "deferred": dict(durability="deferred"),
+    "fdatasync": dict(durability="fdatasync"),
+    "none+prealloc": dict(durability="none", prealloc_blocks=256),
+    "deferred+direct": dict(durability="deferred", direct_io=True),
+}
+
+
+def run(options: dict, nblocks: int, blocksize: int) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        fm = FileMgr(str(Path(tmp) / "bench"), blocksize, **options)
+        p = Page(blocksize)
+        result = {}
+
+        start = time.perf_counter()
+        for _ in range(nblocks):
+            fm.append("bench.tbl")
+        fm.sync_all()
+        result["append"] = time.perf_counter() - start
+
+        blknums = list(range(nblocks))
+        random.shuffle(blknums)
+        start = time.perf_counter()
+        for n in blknums:
+            fm.write(BlockId("bench.tbl", n), p)
+        fm.sync_all()
+        result["random write"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for n in range(nblocks):
+            fm.read(BlockId("bench.tbl", n), p)
+        result["sequential read"] = time.perf_counter() - start
+
+        fm.close()
+        return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=2000)
+    parser.add_argument("--blocksize", type=int, default=4096)
+    args = parser.parse_args()
+
+    print(f"{'mode':<18}{'append':>12}{'random write':>16}{'sequential read':>18}")
+    for name, options in MODES.items():
+        r = run(options, args.blocks, args.blocksize)
+        print(
+            f"{name:<18}{r['append']:>11.3f}s{r['random write']:>15.3f}s"
+            f"{r['sequential read']:>17.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+ログ追記のベンチマーク(1件ずつのappendとappend_manyの比較)
+
+    $ python benchmarks/bench_log.py --records 200000 --batch 64
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from rdbms.storage.buffer import LogMgr
+from rdbms.storage.disk import BlockId, FileMgr, Page
+from rdbms.transaction import SetIntRecord
+
+
+def fixed_width_size(rec: SetIntRecord) -> int:
+    """ファイル名と4バイト整数をそのまま並べた場合のサイズ(長さの4バイトを含む)"""
+    return 4 + 4 * 6 + Page.max_length(len(rec.blk.filename))
+
+
+def run(args: argparse.Namespace, batch: int) -> tuple[float, int]:
+    with tempfile.TemporaryDirectory() as tmp:
+        fm = FileMgr(str(Path(tmp) / "bench"), args.blocksize, durability="none")
+        lm = LogMgr(fm, "logfile", checksum=args.checksum)
+        recs = [
+            SetIntRecord(
+                n % 100, (n * 4) % 400, n, n + 1, BlockId("bench.tbl", n // 50)
+            )
+            for n in range(args.records)
+        ]
+        start = time.perf_counter()
+        if batch == 1:
+            for rec in recs:
+                lm.append(rec)
+        else:
+            for i in range(0, len(recs), batch):
+                lm.append_many(recs[i : i + batch])
+        lm.flush(lm.latest_lsn)
+        elapsed = time.perf_counter() - start
+        nbytes = (lm.current_gblk + 1 - lm.first_block()) * args.blocksize
+        fm.close()
+        return elapsed, nbytes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=200000)
+    parser.add_argument("--blocksize", type=int, default=4096)
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--checksum", action="store_true")
+    args = parser.parse_args()
+
+    rec = SetIntRecord(1, 80, 1, 2, BlockId("bench.tbl", 0))
+    print(f"SETINT record: {len(rec.encode(lambda name: 0))} bytes", end="")
+    print(f" (fixed width: {fixed_width_size(rec)} bytes)")
+    print(f"{'mode':<16}{'time':>10}{'us/record':>12}{'log size':>12}")
+    for name, batch in (("append", 1), (f"append_many({args.batch})", args.batch)):
+        elapsed, nbytes = run(args, batch)
+        us = elapsed / args.records * 1e6
+        print(f"{name:<16}{elapsed:>9.3f}s{us:>12.2f}{nbytes // 1024:>10}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+preadのFileMgrとmmapのMMapFileMgrの比較(読み取り中心の負荷)
+
+    $ python benchmarks/bench_mmap.py --blocks 4000 --pins 50000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.disk import BlockId, FileMgr, MMapFileMgr, Page
+
+BACKENDS = {"pread": FileMgr, "mmap": MMapFileMgr}
+
+
+def run(cls: type[FileMgr], args: argparse.Namespace) -> dict[str, float]:
+    with tempfile.TemporaryDirectory() as tmp:
+        fm = cls(str(Path(tmp) / "bench"), args.blocksize, durability="none")
+        for _ in range(args.blocks):
+            fm.append("bench.tbl")
+        lm = LogMgr(fm, "logfile")
+        bm = BufferMgr(fm, lm, args.buffers)
+        result = {}
+
+        p = Page(args.blocksize)
+        start = time.perf_counter()
+        for n in range(args.blocks):
+            blk = BlockId("bench.tbl", n)
+            if fm.zero_copy:
+                fm.page(blk).get_int(0)
+            else:
+                fm.read(blk, p)
+                p.get_int(0)
+        result["sequential"] = time.perf_counter() - start
+
+        rng = random.Random(0)
+        blknums = [rng.randrange(args.blocks) for _ in range(args.pins)]
+        start = time.perf_counter()
+        for n in blknums:
+            buff = bm.pin(BlockId("bench.tbl", n))
+            buff.contents.get_int(0)
+            bm.unpin(buff)
+        result["random pin"] = time.perf_counter() - start
+
+        fm.close()
+        return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blocks", type=int, default=4000)
+    parser.add_argument("--blocksize", type=int, default=4096)
+    parser.add_argument("--buffers", type=int, default=256)
+    parser.add_argument("--pins", type=int, default=50000)
+    args = parser.parse_args()
+
+    print(f"{'backend':<10}{'sequential':>14}{'random pin':>14}")
+    for name, cls in BACKENDS.items():
+        r = run(cls, args)
+        print(f"{name:<10}{r['sequential']:>13.3f}s{r['random pin']:>13.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Pageのアクセサのベンチマーク(int.from_bytesによる旧実装とstruct.Structの比較)
+
+    $ python benchmarks/bench_page.py --ops 1000000
+"""
+
+import argparse
+import time
+
+from rdbms.storage.disk import Page
+
+
+class BytesPage(Page):
+    """スライスとint.from_bytes/to_bytesで読み書きする旧実装"""
+
+    def get_int(self, offset: int) -> int:
+        return int.from_bytes(
+            self.bb[offset : offset + 4], byteorder="big", signed=True
+        )
+
+    def set_int(self, offset: int, n: int) -> None:
+        self.bb[offset : offset + 4] = n.to_bytes(4, byteorder="big", signed=True)
+
+    def get_string(self, offset: int) -> str:
+        length = self.get_int(offset)
+        return bytes(self.bb[offset + 4 : offset + 4 + length]).decode(self.CHARSET)
+
+
+def timeit(fn, ops: int) -> float:
+    start = time.perf_counter()
+    fn(ops)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=1000000)
+    parser.add_argument("--blocksize", type=int, default=4096)
+    args = parser.parse_args()
+    slots = args.blocksize // 4
+
+    def cases(p: Page):
+        def set_int(ops):
+            for i in range(ops):
+                p.set_int((i % slots) * 4, i)
+
+        def get_int(ops):
+            for i in range(ops):
+                p.get_int((i % slots) * 4)
+
+        def get_string(ops):
+            p.set_string(0, "x" * 32)
+            for _ in range(ops):
+                p.get_string(0)
+
+        def get_ints(ops):
+            # 1回でslots個読むので、呼び出し回数はops/slots
+            for _ in range(ops // slots):
+                p.get_ints(0, slots)
+
+        return {
+            "set_int": set_int,
+            "get_int": get_int,
+            "get_string": get_string,
+            "get_ints": get_ints,
+        }
+
+    old = cases(BytesPage(args.blocksize))
+    new = cases(Page(args.blocksize))
+    print(f"{'op':<12}{'from_bytes':>14}{'struct':>12}{'speedup':>10}")
+    for name in new:
+        if name == "get_ints":
+            # 旧実装には一括読み出しが無いのでget_intのループと比べる
+            t_old = timeit(old["get_int"], args.ops)
+        else:
+            t_old = timeit(old[name], args.ops)
+        t_new = timeit(new[name], args.ops)
+        print(
+            f"{name:<12}{t_old / args.ops * 1e9:>11.1f}ns"
+            f"{t_new / args.ops * 1e9:>10.1f}ns{t_old / t_new:>9.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+ストレージ周りをまとめて測るベンチマーク。結果をJSONに書き出し、前の結果と比べて
+遅くなったケースを表示する。
+
+    $ python benchmarks/suite.py --output results.json
+    $ python benchmarks/suite.py --output new.json --compare results.json
+    $ python benchmarks/suite.py --quick --only pin_random,log
+
+ケース(--onlyにはbench_を除いた関数名を渡す):
+    pin_sequential / pin_random  BufferMgrのpin/unpin(プールより大きいファイル)
+    page_*                       Pageのアクセサ
+    log_append / log_flush       ログの追記と、追記ごとのフラッシュ
+    tx_mix_<n>threads            nワーカーで読み書きの混ざったトランザクション
+    recovery_<n>records          ログのレコード数ごとのリカバリ時間
+
+各ケースはrepeat回測って最も速い回を記録する。比較ではops/secがthreshold以上
+下がったケースを回帰として表示し、終了コードを1にする。
+"""
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable
+
+from rdbms.executor import TxExecutor
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.disk import BlockId, Page
+from rdbms.transaction import ConcurrencyMgr, LockTable, Transaction
+
+Result = dict[str, float]
+CASES: dict[str, Callable[[Path, argparse.Namespace], dict[str, Result]]] = {}
+
+
+def case(fn):
+    CASES[fn.__name__.removeprefix("bench_")] = fn
+    return fn
+
+
+def result(ops: int, elapsed: float, **extra: float) -> Result:
+    return {"ops": ops, "seconds": elapsed, "ops_per_sec": ops / elapsed, **extra}
+
+
+def open_db(tmp: Path, args: argparse.Namespace, buffs: int) -> SimpleDB:
+    ConcurrencyMgr.locktbl = LockTable()
+    return SimpleDB(str(tmp / "bench"), args.blocksize, buffs, durability="none")
+
+
+def fill_table(db: SimpleDB, nblocks: int) -> list[BlockId]:
+    return [db.fm.append("bench.tbl") for _ in range(nblocks)]
+
+
+def pin_unpin(db: SimpleDB, blks: list[BlockId]) -> float:
+    bm = db.buffer_mgr()
+    start = time.perf_counter()
+    for blk in blks:
+        bm.unpin(bm.pin(blk))
+    return time.perf_counter() - start
+
+
+@case
+def bench_pin_sequential(tmp: Path, args: argparse.Namespace) -> dict[str, Result]:
+    db = open_db(tmp, args, args.buffers)
+    blks = fill_table(db, args.buffers * 4)
+    ops = len(blks) * 4
+    elapsed = pin_unpin(db, blks * 4)
+    db.close()
+    return {"pin_sequential": result(ops, elapsed)}
+
+
+@case
+def bench_pin_random(tmp: Path, args: argparse.Namespace) -> dict[str, Result]:
+    db = open_db(tmp, args, args.buffers)
+    blks = fill_table(db, args.buffers * 4)
+    rng = random.Random(args.seed)
+    order = [rng.choice(blks) for _ in range(len(blks) * 4)]
+    elapsed = pin_unpin(db, order)
+    db.close()
+    return {"pin_random": result(len(order), elapsed)}
+
+
+@case
+def bench_page(tmp: Path, args: argparse.Namespace) -> dict[str, Result]:
+    p = Page(args.blocksize)
+    n = args.ops
+    offsets = [(i * 8) % (args.blocksize - 64) for i in range(n)]
+    accessors = {
+        "page_set_int": lambda o: p.set_int(o, o),
+        "page_get_int": p.get_int,
+        "page_set_long": lambda o: p.set_long(o, o),
+        "page_get_long": p.get_long,
+        "page_set_string": lambda o: p.set_string(o, "benchmark"),
+        "page_get_string": p.get_string,
+    }
+    results = {}
+    for name, fn in accessors.items():
+        start = time.perf_counter()
+        for o in offsets:
+            fn(o)
+        results[name] = result(n, time.perf_counter() - start)
+    return results
+
+
+@case
+def bench_log(tmp: Path, args: argparse.Namespace) -> dict[str, Result]:
+    db = open_db(tmp, args, 8)
+    lm = db.log_mgr()
+    rec = b"x" * 40
+    n = args.ops
+    start = time.perf_counter()
+    for _ in range(n):
+        lm.append(rec)
+    lm.flush(lm.latest_lsn)
+    results = {"log_append": result(n, time.perf_counter() - start)}
+
+    n //= 10
+    start = time.perf_counter()
+    for _ in range(n):
+        lm.flush(lm.append(rec))
+    results["log_flush"] = result(n, time.perf_counter() - start)
+    db.close()
+    return results
+
+
+def mixed_tx(tx: Transaction, blks: list[BlockId], seed: int, writes: int) -> None:
+    """ランダムなブロックを4つ読み、そのうちwrites個に書く"""
+    for i, blk in enumerate(random.Random(seed).sample(blks, 4)):
+        tx.pin(blk)
+        val = tx.get_int(blk, 0)
+        if i < writes:
+            tx.set_int(blk, 0, val + 1, True)
+
+
+@case
+def bench_tx_mix(tmp: Path, args: argparse.Namespace) -> dict[str, Result]:
+    results = {}
+    for nthreads in args.threads:
+        db = open_db(tmp / f"t{nthreads}", args, args.buffers)
+        blks = fill_table(db, args.buffers // 2)
+        with TxExecutor(db, workers=nthreads) as ex:
+            start = time.perf_counter()
+            futures = [
+                ex.submit(mixed_tx, blks, args.seed + n, 1 if n % 4 else 2)
+                for n in range(args.txs)
+            ]
+            for f in futures:
+                f.result()
+            elapsed = time.perf_counter() - start
+        results[f"tx_mix_{nthreads}threads"] = result(
+            ex.committed, elapsed, retried=ex.retried
+        )
+        db.close()
+    return results
+
+
+@case
+def bench_recovery(tmp: Path, args: argparse.Namespace) -> dict[str, Result]:
+    results = {}
+    for nrecords in args.log_sizes:
+        path = tmp / f"r{nrecords}"
+        db = open_db(path, args, args.buffers)
+        blks = fill_table(db, args.buffers)
+        rng = random.Random(args.seed)
+        tx = db.new_tx()
+        for n in range(nrecords):
+            if n % 100 == 99:  # 100件ごとにコミットし、最後のは終わらせない
+                tx.commit()
+                tx = db.new_tx()
+            blk = rng.choice(blks)
+            tx.pin(blk)
+            tx.set_int(blk, (n % 50) * 4, n, True)
+            tx.unpin(blk)
+        db.lm.flush(db.lm.latest_lsn)
+        db.fm.close()  # バッファを書き出さずに終わる
+
+        start = time.perf_counter()
+        db = open_db(path, args, args.buffers)
+        results[f"recovery_{nrecords}records"] = result(
+            nrecords, time.perf_counter() - start
+        )
+        db.close()
+    return results
+
+
+def git_revision() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).parent,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+
+def run_suite(args: argparse.Namespace) -> dict:
+    names = args.only.split(",") if args.only else list(CASES)
+    results: dict[str, Result] = {}
+    for name in names:
+        best: dict[str, Result] = {}
+        for _ in range(args.repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                for key, r in CASES[name](Path(tmp), args).items():
+                    if key not in best or r["seconds"] < best[key]["seconds"]:
+                        best[key] = r
+        for key, r in best.items():
+            print(f"{key:<28}{r['ops_per_sec']:>14,.0f} ops/s{r['seconds']:>10.3f}s")
+        results.update(best)
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "args": {
+                k: v for k, v in vars(args).items() if k not in ("output", "compare")
+            },
+        },
+        "results": results,
+    }
+
+
+def compare(new: dict, old: dict, threshold: float) -> list[str]:
+    """ops/secがthreshold以上下がったケースの名前"""
+    regressions = []
+    print(f"\n{'case':<28}{'old ops/s':>14}{'new ops/s':>14}{'change':>10}")
+    for key, r in new["results"].items():
+        if key not in old["results"]:
+            continue
+        before, after = old["results"][key]["ops_per_sec"], r["ops_per_sec"]
+        change = after / before - 1
+        mark = ""
+        if change < -threshold:
+            regressions.append(key)
+            mark = "  REGRESSION"
+        print(f"{key:<28}{before:>14,.0f}{after:>14,.0f}{change:>+10.1%}{mark}")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=Path, default=Path("bench-results.json"))
+    parser.add_argument("--compare", type=Path)
+    parser.add_argument("--threshold", type=float, default=0.10)
+    parser.add_argument("--only", help="カンマ区切りのケース名: " + ",".join(CASES))
+    parser.add_argument("--quick", action="store_true", help="小さいサイズで1回ずつ")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--blocksize", type=int, default=4096)
+    parser.add_argument("--buffers", type=int, default=256)
+    parser.add_argument("--ops", type=int, default=200000)
+    parser.add_argument("--txs", type=int, default=4000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--log-sizes", type=int, nargs="+", default=[1000, 10000, 50000]
+    )
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat, args.buffers, args.ops, args.txs = 1, 64, 20000, 400
+        args.threads, args.log_sizes = [1, 4], [1000, 5000]
+
+    report = run_suite(args)
+    args.output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"\nwrote {args.output}")
+    if args.compare:
+        old = json.loads(args.compare.read_text())
+        if compare(report, old, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
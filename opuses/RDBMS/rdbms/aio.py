@@ -0,0 +1,279 @@
+"""
+asyncioからトランザクションを使うための入口。
+
+    adb = AsyncDB(SimpleDB("studentdb"))
+    async with await adb.begin() as tx:
+        await tx.pin(blk)
+        n = await tx.get_int(blk, 0)
+        await tx.set_int(blk, 0, n + 1, True)
+    await adb.close()
+
+ロックとバッファの空きはスレッドを止めずに待つ。LockTable.request/pollと
+BufferMgr.try_pinで取れなければ起こしてもらうコールバックを登録し、イベントループ
+のFutureをawaitする。待っている間もセッションはスレッドを持たないので、多数の
+セッションが1つのエンジンを共有できる。
+
+ブロックの読み込み、更新のログの追記(ページが埋まれば書き出す)、コミット時の
+ログのフラッシュ、ロールバックのようなディスクI/Oは、AsyncDBのioプール
+(io_workers本のスレッド)で行う。ロックは先に取っておくので、ioプールのスレッドが
+ロックを待って止まることはない。
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, TypeVar
+
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.buffer import BufferAbortException, BufferMgr
+from rdbms.storage.disk import BlockId
+from rdbms.storage.metrics import metrics
+from rdbms.transaction import LockAbortException, Transaction
+
+T = TypeVar("T")
+
+
+class Wakeup:
+    """
+    別のスレッドからイベントループのFutureを完了させる。LockTable.pollの
+    wakeupにも、BufferMgr.try_pinのwaiter(notify()を持つもの)にもなる。
+    取れるか試す前にarmしておくので、試してからawaitするまでの通知も失われない
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.future = loop.create_future()
+
+    def arm(self) -> asyncio.Future:
+        self.future = self.loop.create_future()
+        return self.future
+
+    def notify(self) -> None:
+        try:
+            self.loop.call_soon_threadsafe(self._set, self.future)
+        except RuntimeError:
+            pass  # イベントループはもう閉じている
+
+    __call__ = notify
+
+    @staticmethod
+    def _set(future: asyncio.Future) -> None:
+        if not future.done():
+            future.set_result(None)
+
+
+async def wait_until(
+    wakeup: Wakeup, attempt: Callable[[Wakeup], T | None], deadline: float
+) -> T | None:
+    """
+    attempt(wakeup)がNone以外を返すまで、wakeupが呼ばれるたびに試し直す。
+    deadline(time.monotonic)までに取れなければNoneを返す。
+    1回目で取れたときはイベントループに処理を返さない
+    """
+    while True:
+        future = wakeup.arm()
+        got = attempt(wakeup)
+        if got is not None:
+            return got
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        try:
+            await asyncio.wait_for(future, remaining)
+        except TimeoutError:
+            pass  # 最後にもう一度だけ試す
+
+
+@dataclass
+class AsyncDB:
+    """SimpleDBをイベントループから使う。ディスクI/Oはioプールのスレッドで行う"""
+
+    db: SimpleDB
+    io_workers: int = 8
+    io: ThreadPoolExecutor = field(init=False)
+
+    def __post_init__(self):
+        self.io = ThreadPoolExecutor(
+            max_workers=self.io_workers, thread_name_prefix="aio"
+        )
+
+    async def begin(self, read_only: bool = False) -> "AsyncTransaction":
+        # STARTレコードの追記でログブロックを書き出すことがある
+        tx = await self.run_io(self.db.new_tx, read_only)
+        return AsyncTransaction(self, tx)
+
+    async def run_io(self, fn: Callable[..., T], *args) -> T:
+        return await asyncio.get_running_loop().run_in_executor(self.io, fn, *args)
+
+    async def close(self) -> None:
+        await self.run_io(self.db.close)
+        self.io.shutdown()
+
+
+@dataclass
+class AsyncTransaction:
+    """
+    Transactionのasync版。ロックやバッファを待つ操作とディスクI/Oを伴う操作は
+    コルーチンで、待たないもの(unpinなど)は普通のメソッド。
+    async withで使うと、抜けるときにコミット(例外ならロールバック)する
+    """
+
+    adb: AsyncDB
+    tx: Transaction
+
+    @property
+    def txnum(self) -> int:
+        return self.tx.txnum
+
+    async def __aenter__(self) -> "AsyncTransaction":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+
+    async def commit(self) -> None:
+        await self.adb.run_io(self.tx.commit)
+
+    async def rollback(self) -> None:
+        await self.adb.run_io(self.tx.rollback)
+
+    async def pin(self, blk: BlockId) -> None:
+        bm = self.tx.bm
+        got = await self._claim_frame(bm, blk)
+        # 読み込みはioプールで。キャンセルされてもpinは外す
+        loop = asyncio.get_running_loop()
+        io = loop.run_in_executor(self.adb.io, bm.finish_pin, blk, *got)
+        try:
+            buff = await asyncio.shield(io)
+        except asyncio.CancelledError:
+            io.add_done_callback(
+                lambda f: f.exception() is None and bm.unpin(f.result())
+            )
+            raise
+        self.tx.mybuffers.add(blk, buff)
+
+    def unpin(self, blk: BlockId) -> None:
+        self.tx.unpin(blk)
+
+    async def get_int(self, blk: BlockId, offset: int) -> int:
+        await self._s_lock(blk)
+        return self.tx.get_int(blk, offset)
+
+    async def get_string(self, blk: BlockId, offset: int) -> str:
+        await self._s_lock(blk)
+        return self.tx.get_string(blk, offset)
+
+    async def set_int(
+        self, blk: BlockId, offset: int, val: int, ok_to_log: bool
+    ) -> None:
+        await self.x_lock(blk)
+        await self.adb.run_io(self.tx.set_int, blk, offset, val, ok_to_log)
+
+    async def set_string(
+        self, blk: BlockId, offset: int, val: str, ok_to_log: bool
+    ) -> None:
+        await self.x_lock(blk)
+        await self.adb.run_io(self.tx.set_string, blk, offset, val, ok_to_log)
+
+    async def x_lock(self, blk: BlockId) -> None:
+        self.tx._check_writable()
+        cm = self.tx.concur_mgr
+        if not cm.has_xlock(blk):
+            await self._s_lock(blk)
+            await self._lock(blk, "X")
+            cm.locks[blk] = "X"
+
+    def unlock(self, blk: BlockId) -> None:
+        self.tx.unlock(blk)
+
+    async def size(self, filename: str) -> int:
+        await self._s_lock(BlockId(filename, Transaction.END_OF_FILE))
+        return self.tx.size(filename)
+
+    async def append(self, filename: str) -> BlockId:
+        await self.x_lock(BlockId(filename, Transaction.END_OF_FILE))
+        return await self.adb.run_io(self.tx.append, filename)
+
+    def block_size(self) -> int:
+        return self.tx.block_size()
+
+    def available_buffs(self) -> int:
+        return self.tx.available_buffs()
+
+    async def _s_lock(self, blk: BlockId) -> None:
+        cm = self.tx.concur_mgr
+        if not self.tx.read_only and blk not in cm.locks:
+            await self._lock(blk, "S")
+            cm.locks[blk] = "S"
+
+    async def _lock(self, blk: BlockId, mode: str) -> None:
+        lt = self.tx.concur_mgr.locktbl
+        txnum = self.tx.txnum
+        entry = lt.request(blk, txnum, mode)
+        if entry is None:
+            return
+        wait = _Waiting("lock_waits", "lock_wait_seconds")
+
+        def attempt(wakeup: Wakeup) -> bool | None:
+            if lt.poll(blk, entry, txnum, mode, wakeup):
+                return True
+            return wait.start()
+
+        deadline = time.monotonic() + lt.MAX_TIME / 1000
+        granted = None
+        try:
+            granted = await wait_until(
+                Wakeup(asyncio.get_running_loop()), attempt, deadline
+            )
+        finally:
+            if granted is None:
+                lt.cancel(blk, entry, txnum, mode)
+            wait.stop()
+        if granted is None:
+            if metrics.enabled:
+                metrics.inc("lock_timeouts")
+            raise LockAbortException(f"lock wait timeout on {blk}")
+
+    @staticmethod
+    async def _claim_frame(bm: BufferMgr, blk: BlockId) -> tuple:
+        """BufferMgr.try_pinでフレームを確保する。空きがなければ順番を待つ"""
+        wait = _Waiting("buffer_pin_waits", "buffer_pin_wait_seconds")
+
+        def attempt(wakeup: Wakeup) -> tuple | None:
+            got = bm.try_pin(blk, wakeup)
+            return got if got is not None else wait.start()
+
+        wakeup = Wakeup(asyncio.get_running_loop())
+        deadline = time.monotonic() + bm.MAX_TIME / 1000
+        got = None
+        try:
+            got = await wait_until(wakeup, attempt, deadline)
+        finally:
+            if got is None:
+                bm.cancel_pin(wakeup)
+            wait.stop()
+        if got is None:
+            raise BufferAbortException()
+        return got
+
+
+@dataclass
+class _Waiting:
+    """待った回数と時間をmetricsに記録する"""
+
+    counter: str
+    histogram: str
+    since: float | None = None
+
+    def start(self) -> None:
+        if self.since is None and metrics.enabled:
+            self.since = time.perf_counter()
+            metrics.inc(self.counter)
+
+    def stop(self) -> None:
+        if self.since is not None:
+            metrics.observe(self.histogram, time.perf_counter() - self.since)
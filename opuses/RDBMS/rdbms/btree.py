@@ -0,0 +1,466 @@
+"""
+B+木索引。ノードは索引ファイルのブロックで、読み書きはすべてTransaction経由
+(ロックとログはトランザクションに任せる)。キーは整数で、値はレコードのRID。
+
+同じキーが複数あってもよいように、木の中では(キー, ブロック番号, スロット)の組を
+一意なエントリとして順序づける。
+
+ノードのページ:
+    [レベル][エントリ数][右隣の葉] の後にエントリを並べる。
+    レベル0が葉で、エントリは(キー, ブロック番号, スロット)。右隣が0なら最後の葉。
+    内部ノードはヘッダの後に左端の子を置き、エントリは(キー, ブロック番号, スロット,
+    子)。エントリ以上の値はその子の側にある。
+    根はいつもブロック0で、全部0のブロックは空の葉とみなす。
+
+並行性はロックカップリング(latch crabbing)。子のロックを取ってから親のロックを外す。
+挿入は下りながらXロックを取り、子が満杯でなければ(分割が親まで伝わらないので)
+祖先のロックを外す。書き込んだノードのロックはトランザクションの終了まで持つ。
+葉のSロックはデータのロックなので読んだあとも外さない。
+"""
+
+from dataclasses import dataclass
+from typing import ClassVar, Iterable, Iterator
+
+from rdbms.record import RID
+from rdbms.storage.disk import BlockId
+from rdbms.transaction import Transaction
+
+Entry = tuple[int, int, int]  # (キー, ブロック番号, スロット)
+MIN_INT = -(2**31)
+
+
+@dataclass
+class BTreePage:
+    """B+木の1ノード。ブロックはpinしておくこと"""
+
+    tx: Transaction
+    blk: BlockId
+
+    LEVEL: ClassVar[int] = 0
+    NKEYS: ClassVar[int] = 4
+    NEXT: ClassVar[int] = 8
+    HEADER: ClassVar[int] = 12
+    CHILD0: ClassVar[int] = 12
+    LEAF_SLOT: ClassVar[int] = 12
+    INTERNAL_SLOT: ClassVar[int] = 16
+
+    def level(self) -> int:
+        return self.tx.get_int(self.blk, self.LEVEL)
+
+    def is_leaf(self) -> bool:
+        return self.level() == 0
+
+    def nkeys(self) -> int:
+        return self.tx.get_int(self.blk, self.NKEYS)
+
+    def next(self) -> int:
+        return self.tx.get_int(self.blk, self.NEXT)
+
+    def capacity(self) -> int:
+        bs = self.tx.block_size()
+        if self.is_leaf():
+            return (bs - self.HEADER) // self.LEAF_SLOT
+        return (bs - self.HEADER - 4) // self.INTERNAL_SLOT
+
+    def is_full(self) -> bool:
+        return self.nkeys() >= self.capacity()
+
+    def entry(self, i: int) -> Entry:
+        pos = self._pos(i)
+        get = self.tx.get_int
+        return get(self.blk, pos), get(self.blk, pos + 4), get(self.blk, pos + 8)
+
+    def child(self, i: int) -> int:
+        """i番目の子。0は左端の子で、i>0はi-1番目のエントリの右の子"""
+        if i == 0:
+            return self.tx.get_int(self.blk, self.CHILD0)
+        return self.tx.get_int(self.blk, self._pos(i - 1) + 12)
+
+    def lower_bound(self, e: Entry) -> int:
+        """e以上の最初のエントリの位置"""
+        lo, hi = 0, self.nkeys()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid) < e:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def upper_bound(self, e: Entry) -> int:
+        """eより大きい最初のエントリの位置"""
+        lo, hi = 0, self.nkeys()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid) <= e:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def child_for(self, e: Entry) -> int:
+        """eを含む部分木の子"""
+        return self.child(self.upper_bound(e))
+
+    def format(self, level: int, next_blk: int = 0) -> None:
+        self._set(self.LEVEL, level)
+        self._set(self.NKEYS, 0)
+        self._set(self.NEXT, next_blk)
+
+    def set_next(self, blknum: int) -> None:
+        self._set(self.NEXT, blknum)
+
+    def set_child0(self, blknum: int) -> None:
+        self._set(self.CHILD0, blknum)
+
+    def insert(self, i: int, e: Entry, child: int = 0) -> None:
+        """i番目にエントリを入れる(内部ノードならその右の子も)"""
+        n = self.nkeys()
+        leaf = self.is_leaf()
+        for j in range(n, i, -1):
+            self._write(j, self.entry(j - 1), 0 if leaf else self.child(j))
+        self._write(i, e, child)
+        self._set(self.NKEYS, n + 1)
+
+    def delete(self, i: int) -> None:
+        n = self.nkeys()
+        leaf = self.is_leaf()
+        for j in range(i, n - 1):
+            self._write(j, self.entry(j + 1), 0 if leaf else self.child(j + 2))
+        self._set(self.NKEYS, n - 1)
+
+    def append_all(self, entries: list[Entry], children: list[int]) -> None:
+        """空のノードの末尾にエントリを並べる(childrenは内部ノードのときだけ)"""
+        n = self.nkeys()
+        for j, e in enumerate(entries):
+            self._write(n + j, e, children[j] if children else 0)
+        self._set(self.NKEYS, n + len(entries))
+
+    def split(self, newblk: BlockId) -> Entry:
+        """
+        後ろ半分をnewblkに移し、親に入れる区切りのエントリを返す。
+        葉の区切りは右の最初のエントリで、内部ノードの区切りは真ん中のエントリを親に上げる
+        """
+        n = self.nkeys()
+        mid = n // 2
+        right = BTreePage(self.tx, newblk)
+        if self.is_leaf():
+            right.format(0, self.next())
+            right.append_all([self.entry(j) for j in range(mid, n)], [])
+            self.set_next(newblk.blknum)
+            self._set(self.NKEYS, mid)
+            return right.entry(0)
+        sep = self.entry(mid)
+        right.format(self.level())
+        right.set_child0(self.child(mid + 1))
+        right.append_all(
+            [self.entry(j) for j in range(mid + 1, n)],
+            [self.child(j + 1) for j in range(mid + 1, n)],
+        )
+        self._set(self.NKEYS, mid)
+        return sep
+
+    def copy_to(self, dest: BlockId) -> None:
+        """このノードの中身をdestに写す"""
+        other = BTreePage(self.tx, dest)
+        other.format(self.level(), self.next())
+        n = self.nkeys()
+        if self.is_leaf():
+            other.append_all([self.entry(j) for j in range(n)], [])
+        else:
+            other.set_child0(self.child(0))
+            other.append_all(
+                [self.entry(j) for j in range(n)],
+                [self.child(j + 1) for j in range(n)],
+            )
+
+    def _pos(self, i: int) -> int:
+        if self.is_leaf():
+            return self.HEADER + i * self.LEAF_SLOT
+        return self.CHILD0 + 4 + i * self.INTERNAL_SLOT
+
+    def _write(self, i: int, e: Entry, child: int) -> None:
+        pos = self._pos(i)
+        for k, v in enumerate(e):
+            self._set(pos + 4 * k, v)
+        if not self.is_leaf():
+            self._set(pos + 12, child)
+
+    def _set(self, offset: int, val: int) -> None:
+        self.tx.set_int(self.blk, offset, val, True)
+
+
+@dataclass
+class BTreeIndex:
+    """
+    整数キーからRIDを引くB+木索引。ファイルは<name>.idx。
+    葉の分割だけでなく根の分割も根をブロック0に置いたまま行う。
+    削除したノードは併合しない(空いた葉も右隣へのリンクとして残す)。
+    """
+
+    tx: Transaction
+    name: str
+
+    ROOT: ClassVar[int] = 0
+
+    def __post_init__(self):
+        self.filename = self.name + ".idx"
+        if self.tx.size(self.filename) == 0:
+            self.tx.append(self.filename)
+
+    def search(self, key: int) -> list[RID]:
+        """keyを持つRIDの一覧"""
+        return [rid for _, rid in self.range(key, key)]
+
+    def range(self, lo: int | None = None, hi: int | None = None) -> Iterator:
+        """lo <= キー <= hi の(キー, RID)をキーの順に返す。Noneは上限・下限なし"""
+        start: Entry = (MIN_INT if lo is None else lo, MIN_INT, MIN_INT)
+        blk = self._find_leaf(start)
+        try:
+            page = BTreePage(self.tx, blk)
+            i = page.lower_bound(start)
+            while True:
+                n = page.nkeys()
+                while i < n:
+                    key, blknum, slot = page.entry(i)
+                    if hi is not None and key > hi:
+                        return
+                    yield key, RID(blknum, slot)
+                    i += 1
+                nxt = page.next()
+                if nxt == 0:
+                    return
+                # 葉は左から右へ順にロックするので下りてくる書き手とは交差しない
+                nextblk = BlockId(self.filename, nxt)
+                self.tx.pin(nextblk)
+                self.tx.unpin(blk)
+                blk, page, i = nextblk, BTreePage(self.tx, nextblk), 0
+        finally:
+            self.tx.unpin(blk)
+
+    def insert(self, key: int, rid: RID) -> None:
+        e: Entry = (key, rid.blknum, rid.slot)
+        path = self._lock_path_for_insert(e)
+        try:
+            self._insert_at(path, len(path) - 1, e, 0)
+        finally:
+            for blk in path:
+                self.tx.unlock(blk)
+                self.tx.unpin(blk)
+
+    def delete(self, key: int, rid: RID) -> bool:
+        """エントリを消す。見つからなければFalse"""
+        e: Entry = (key, rid.blknum, rid.slot)
+        blk = self._find_leaf(e, exclusive=True)
+        try:
+            page = BTreePage(self.tx, blk)
+            while True:
+                i = page.lower_bound(e)
+                if i < page.nkeys():
+                    if page.entry(i) != e:
+                        return False
+                    page.delete(i)
+                    return True
+                # 併合しないので、空いた葉の先にあることがある
+                nxt = page.next()
+                if nxt == 0:
+                    return False
+                nextblk = BlockId(self.filename, nxt)
+                self.tx.x_lock(nextblk)
+                self.tx.pin(nextblk)
+                self.tx.unpin(blk)
+                blk, page = nextblk, BTreePage(self.tx, nextblk)
+        finally:
+            self.tx.unpin(blk)
+
+    def bulk_load(self, entries: Iterable[tuple[int, RID]], fill: float = 1.0) -> None:
+        """
+        キーの順に並んだ(キー, RID)から空の索引を下から組み立てる。
+        葉をfillの割合まで詰めて順に追加し、その上の内部ノードを1段ずつ作る。
+        """
+        root = BlockId(self.filename, self.ROOT)
+        self.tx.x_lock(root)
+        self.tx.pin(root)
+        try:
+            rootpage = BTreePage(self.tx, root)
+            if rootpage.nkeys() != 0 or not rootpage.is_leaf():
+                raise RuntimeError(f"index {self.name} is not empty")
+            per_leaf = max(1, int(rootpage.capacity() * fill))
+            level = self._load_leaves(entries, per_leaf)
+            if level is None:
+                return
+            height = 0
+            fanout = max(2, int(((self.tx.block_size() - 16) // 16) * fill) + 1)
+            while len(level) > fanout:
+                height += 1
+                level = [
+                    self._write_internal(self.tx.append(self.filename), height, group)
+                    for group in _chunks(level, fanout)
+                ]
+            self._write_internal(root, height + 1, level)
+        finally:
+            self.tx.unpin(root)
+
+    def _load_leaves(
+        self, entries: Iterable[tuple[int, RID]], per_leaf: int
+    ) -> list[tuple[Entry, int]] | None:
+        """葉を作り(最初のエントリ, ブロック番号)を返す。1枚に収まれば根に書いてNone"""
+        leaves: list[tuple[Entry, int]] = []
+        chunk: list[Entry] = []
+        prev: BTreePage | None = None
+        last: Entry | None = None
+
+        def flush() -> None:
+            nonlocal prev
+            blk = self.tx.append(self.filename)
+            self.tx.pin(blk)
+            page = BTreePage(self.tx, blk)
+            page.format(0)
+            page.append_all(chunk, [])
+            if prev is not None:
+                prev.set_next(blk.blknum)
+                self.tx.unpin(prev.blk)
+            prev = page
+            leaves.append((chunk[0], blk.blknum))
+            chunk.clear()
+
+        try:
+            for key, rid in entries:
+                e = (key, rid.blknum, rid.slot)
+                if last is not None and e < last:
+                    raise ValueError(f"bulk_load input is not sorted at key {key}")
+                last = e
+                if len(chunk) == per_leaf:
+                    flush()
+                chunk.append(e)
+            if not leaves:
+                BTreePage(self.tx, BlockId(self.filename, self.ROOT)).append_all(
+                    chunk, []
+                )
+                return None
+            if chunk:
+                flush()
+        finally:
+            if prev is not None:
+                self.tx.unpin(prev.blk)
+        return leaves
+
+    def _write_internal(
+        self, blk: BlockId, level: int, children: list[tuple[Entry, int]]
+    ) -> tuple[Entry, int]:
+        self.tx.pin(blk)
+        try:
+            page = BTreePage(self.tx, blk)
+            page.format(level)
+            page.set_child0(children[0][1])
+            page.append_all([c[0] for c in children[1:]], [c[1] for c in children[1:]])
+        finally:
+            self.tx.unpin(blk)
+        return children[0][0], blk.blknum
+
+    def _find_leaf(self, e: Entry, exclusive: bool = False) -> BlockId:
+        """
+        根から葉まで下り、葉をpinしたまま返す。子をロックしてから親のロックを外す。
+        exclusiveなら葉だけXロックを取る
+        """
+        blk = BlockId(self.filename, self.ROOT)
+        self.tx.pin(blk)
+        page = BTreePage(self.tx, blk)
+        if exclusive and page.is_leaf():
+            self.tx.x_lock(blk)
+        while not page.is_leaf():
+            child = BlockId(self.filename, page.child_for(e))
+            self.tx.pin(child)
+            if exclusive and page.level() == 1:
+                self.tx.x_lock(child)
+            else:
+                self.tx.get_int(child, BTreePage.LEVEL)  # 読んでSロックを取る
+            self.tx.unlock(blk)
+            self.tx.unpin(blk)
+            blk, page = child, BTreePage(self.tx, child)
+        return blk
+
+    def _lock_path_for_insert(self, e: Entry) -> list[BlockId]:
+        """
+        Xロックを取りながら下り、分割が伝わりうるノードの列を返す(pinしたまま)。
+        満杯でないノードに着いたら、それより上のノードのロックを外す
+        """
+        blk = BlockId(self.filename, self.ROOT)
+        self.tx.x_lock(blk)
+        self.tx.pin(blk)
+        path = [blk]
+        page = BTreePage(self.tx, blk)
+        while True:
+            if not page.is_full():
+                for b in path[:-1]:
+                    self.tx.unlock(b)
+                    self.tx.unpin(b)
+                del path[:-1]
+            if page.is_leaf():
+                return path
+            child = BlockId(self.filename, page.child_for(e))
+            self.tx.x_lock(child)
+            self.tx.pin(child)
+            path.append(child)
+            page = BTreePage(self.tx, child)
+
+    def _insert_at(self, path: list[BlockId], depth: int, e: Entry, child: int) -> None:
+        """
+        path[depth]のノードにエントリを入れる。満杯なら先に分割して、区切りを
+        path[depth - 1]に入れる。path[0]は根か満杯でないノード
+        """
+        page = BTreePage(self.tx, path[depth])
+        if not page.is_full():
+            _put(page, e, child)
+            return
+        if depth == 0:
+            self._split_root(page, e, child)
+            return
+        newblk = self.tx.append(self.filename)
+        self.tx.pin(newblk)
+        try:
+            sep = page.split(newblk)
+            _put(page if e < sep else BTreePage(self.tx, newblk), e, child)
+        finally:
+            self.tx.unpin(newblk)
+        self._insert_at(path, depth - 1, sep, newblk.blknum)
+
+    def _split_root(self, root: BTreePage, e: Entry, child: int) -> None:
+        """
+        根の中身を新しいブロックに移して分割し、eを入れてから
+        根を1段上の内部ノードにする(根はブロック0のまま)
+        """
+        left = self.tx.append(self.filename)
+        right = self.tx.append(self.filename)
+        self.tx.pin(left)
+        self.tx.pin(right)
+        try:
+            root.copy_to(left)
+            sep = BTreePage(self.tx, left).split(right)
+            _put(BTreePage(self.tx, left if e < sep else right), e, child)
+            root.format(root.level() + 1)
+            root.set_child0(left.blknum)
+            root.append_all([sep], [right.blknum])
+        finally:
+            self.tx.unpin(left)
+            self.tx.unpin(right)
+
+
+def _put(page: BTreePage, e: Entry, child: int) -> None:
+    """満杯でないノードの順序どおりの位置にエントリを入れる"""
+    if page.is_leaf():
+        page.insert(page.lower_bound(e), e)
+    else:
+        page.insert(page.upper_bound(e), e, child)
+
+
+def _chunks(items: list, n: int) -> Iterator[list]:
+    """itemsをn個ずつに分ける。最後が1個だけにならないように直前と分け直す"""
+    groups = [items[i : i + n] for i in range(0, len(items), n)]
+    if len(groups) > 1 and len(groups[-1]) < 2:
+        last = groups.pop()
+        prev = groups.pop()
+        both = prev + last
+        half = len(both) // 2
+        groups += [both[:half], both[half:]]
+    return iter(groups)
@@ -0,0 +1,113 @@
+"""
+トランザクションをワーカースレッドのプールで実行する。
+
+    with TxExecutor(db, workers=8) as ex:
+        futures = [ex.submit(transfer, a, b, 10) for a, b in pairs]
+        for f in futures:
+            f.result()
+
+submitした関数は新しいTransactionを第1引数に受け取る。返ったらコミットし、
+例外ならロールバックする。ロックやバッファを待ちきれずに中断された
+(LockAbortException/BufferAbortException)ときは、新しいトランザクションで
+最初からやり直す。やり直す前に指数バックオフ(ジッタ付き)で待つので、
+ぶつかったトランザクション同士が同じタイミングで再び衝突し続けることはない。
+"""
+
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, ClassVar, TypeVar
+
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.buffer import BufferAbortException
+from rdbms.storage.metrics import metrics
+from rdbms.transaction import LockAbortException, Transaction
+
+T = TypeVar("T")
+
+
+class RetryLimitExceeded(Exception):
+    """やり直しの回数を使い切った。__cause__に最後の中断の例外が入る"""
+
+
+@dataclass
+class TxExecutor:
+    db: SimpleDB
+    workers: int = 4
+    max_retries: int = 20
+    backoff: float = 0.001  # 1回目のやり直しまでの待ち時間(秒)
+    max_backoff: float = 0.1
+    committed: int = field(default=0, init=False)
+    retried: int = field(default=0, init=False)
+    failed: int = field(default=0, init=False)
+
+    RETRYABLE: ClassVar[tuple[type[Exception], ...]] = (
+        LockAbortException,
+        BufferAbortException,
+    )
+
+    def __post_init__(self):
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="tx"
+        )
+        self.lock = threading.Lock()  # 上の集計値を守る
+
+    def submit(
+        self,
+        fn: Callable[..., T],
+        *args,
+        read_only: bool = False,
+        **kwargs,
+    ) -> Future:
+        """fn(tx, *args, **kwargs)をプールで実行する。結果はFutureで返る"""
+        return self.pool.submit(self.run, fn, *args, read_only=read_only, **kwargs)
+
+    def run(self, fn: Callable[..., T], *args, read_only: bool = False, **kwargs) -> T:
+        """呼び出したスレッドで実行する。中断されたらやり直す"""
+        for attempt in range(self.max_retries + 1):
+            tx = self.db.new_tx(read_only=read_only)
+            try:
+                value = fn(tx, *args, **kwargs)
+                tx.commit()
+            except self.RETRYABLE as e:
+                tx.rollback()
+                if attempt == self.max_retries:
+                    self._count("failed")
+                    raise RetryLimitExceeded(
+                        f"gave up after {self.max_retries} retries"
+                    ) from e
+                self._count("retried")
+                time.sleep(self._delay(attempt))
+                continue
+            except BaseException:
+                tx.rollback()
+                self._count("failed")
+                raise
+            self._count("committed")
+            return value
+        raise AssertionError("unreachable")
+
+    def active_tx_numbers(self) -> list[int]:
+        """実行中のトランザクションの番号(このエンジン全体)"""
+        return Transaction.active_tx_numbers()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.pool.shutdown(wait=wait)
+
+    def __enter__(self) -> "TxExecutor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+    def _delay(self, attempt: int) -> float:
+        delay = min(self.max_backoff, self.backoff * (1 << attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def _count(self, name: str) -> None:
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+        if metrics.enabled:
+            metrics.inc(f"tx_{name}")
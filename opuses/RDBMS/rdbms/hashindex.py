@@ -0,0 +1,276 @@
+"""
+線形ハッシュ索引。等価検索だけを速くする。読み書きはすべてTransaction経由なので、
+ロックとログ(クラッシュ後のやり直しとロールバック)はB+木と同じ仕組みに乗る。
+
+ファイル:
+    <name>.hash  ブロック0がメタデータ[レベル][次に分割するバケット][初期バケット数]、
+                 ブロックb+1がバケットbの先頭ページ
+    <name>.ovf   あふれページ
+バケットのページ:
+    [エントリ数][次のあふれページ+1(0なら終わり)] の後に(キー, ブロック番号, スロット)
+
+挿入であふれページが必要になったら、そのバケットとは関係なく「次に分割する
+バケット」を1つだけ分割する。全体を作り直すことはなく、バケットは1つずつ増える。
+キーkのバケットは h(k) mod N*2^level で、それが分割済みのバケットなら
+h(k) mod N*2^(level+1)。
+"""
+
+from dataclasses import dataclass
+from typing import ClassVar
+
+from rdbms.record import RID
+from rdbms.storage.disk import BlockId
+from rdbms.transaction import Transaction
+
+Entry = tuple[int, int, int]  # (キー, ブロック番号, スロット)
+
+
+def hash_key(key: int) -> int:
+    """32ビットに混ぜたハッシュ値(murmur3の最終ミックス)。下位ビットも偏らない"""
+    h = key & 0xFFFFFFFF
+    h ^= h >> 16
+    h = (h * 0x85EBCA6B) & 0xFFFFFFFF
+    h ^= h >> 13
+    h = (h * 0xC2B2AE35) & 0xFFFFFFFF
+    return h ^ (h >> 16)
+
+
+@dataclass
+class BucketPage:
+    """バケットの1ページ(先頭ページかあふれページ)。ブロックはpinしておくこと"""
+
+    tx: Transaction
+    blk: BlockId
+
+    COUNT: ClassVar[int] = 0
+    OVERFLOW: ClassVar[int] = 4
+    HEADER: ClassVar[int] = 8
+    SLOT: ClassVar[int] = 12
+
+    def count(self) -> int:
+        return self.tx.get_int(self.blk, self.COUNT)
+
+    def overflow(self) -> int:
+        """次のあふれページのブロック番号。無ければ-1"""
+        return self.tx.get_int(self.blk, self.OVERFLOW) - 1
+
+    def capacity(self) -> int:
+        return (self.tx.block_size() - self.HEADER) // self.SLOT
+
+    def entry(self, i: int) -> Entry:
+        pos = self.HEADER + i * self.SLOT
+        get = self.tx.get_int
+        return get(self.blk, pos), get(self.blk, pos + 4), get(self.blk, pos + 8)
+
+    def entries(self) -> list[Entry]:
+        return [self.entry(i) for i in range(self.count())]
+
+    def set_overflow(self, blknum: int) -> None:
+        self._set(self.OVERFLOW, blknum + 1)
+
+    def set_entries(self, entries: list[Entry]) -> None:
+        for i, e in enumerate(entries):
+            self._write(i, e)
+        self._set(self.COUNT, len(entries))
+
+    def add(self, e: Entry) -> None:
+        n = self.count()
+        self._write(n, e)
+        self._set(self.COUNT, n + 1)
+
+    def remove(self, i: int) -> None:
+        """最後のエントリをiに移して詰める"""
+        n = self.count()
+        if i != n - 1:
+            self._write(i, self.entry(n - 1))
+        self._set(self.COUNT, n - 1)
+
+    def _write(self, i: int, e: Entry) -> None:
+        pos = self.HEADER + i * self.SLOT
+        for k, v in enumerate(e):
+            self._set(pos + 4 * k, v)
+
+    def _set(self, offset: int, val: int) -> None:
+        self.tx.set_int(self.blk, offset, val, True)
+
+
+@dataclass
+class HashIndex:
+    """
+    整数キーからRIDを引く線形ハッシュ索引。
+    メタデータのロックはバケットのロックを取ったら外す(分割したトランザクションは
+    書き込んだので終了まで持つ)。空いたあふれページはつないだまま再利用する。
+    """
+
+    tx: Transaction
+    name: str
+    initial_buckets: int = 4
+
+    LEVEL: ClassVar[int] = 0
+    NEXT: ClassVar[int] = 4
+    NBUCKETS: ClassVar[int] = 8
+
+    def __post_init__(self):
+        self.filename = self.name + ".hash"
+        self.ovffile = self.name + ".ovf"
+        self.meta = BlockId(self.filename, 0)
+        if self.tx.size(self.filename) == 0:
+            self.tx.append(self.filename)
+        # ファイルの追加はロールバックで戻らないので、作ったトランザクションが
+        # ロールバックしていればブロックはあってもバケット数が0のまま
+        self.tx.pin(self.meta)
+        try:
+            if self.tx.get_int(self.meta, self.NBUCKETS) == 0:
+                self.tx.set_int(self.meta, self.NBUCKETS, self.initial_buckets, True)
+                self._ensure_blocks(self.initial_buckets)
+            self.tx.unlock(self.meta)
+        finally:
+            self.tx.unpin(self.meta)
+
+    def search(self, key: int) -> list[RID]:
+        """keyを持つRIDの一覧"""
+        rids = []
+        for blk in self._chain(self._lock_bucket(key, exclusive=False)):
+            entries = self._read(blk, BucketPage.entries)
+            rids += [RID(b, s) for k, b, s in entries if k == key]
+        return rids
+
+    def insert(self, key: int, rid: RID) -> None:
+        e: Entry = (key, rid.blknum, rid.slot)
+        chain = self._chain(self._lock_bucket(key, exclusive=True))
+        for blk in chain:
+            if self._read(blk, lambda page: page.count() < page.capacity()):
+                self._read(blk, lambda page: page.add(e))
+                return
+        self._read(self._extend(chain[-1]), lambda page: page.add(e))
+        self._split()
+
+    def delete(self, key: int, rid: RID) -> bool:
+        """エントリを消す。見つからなければFalse"""
+        e: Entry = (key, rid.blknum, rid.slot)
+        for blk in self._chain(self._lock_bucket(key, exclusive=True)):
+            entries = self._read(blk, BucketPage.entries)
+            if e in entries:
+                self._read(blk, lambda page: page.remove(entries.index(e)))
+                return True
+        return False
+
+    def num_buckets(self) -> int:
+        self.tx.pin(self.meta)
+        try:
+            level, nxt, n0 = self._read_meta()
+        finally:
+            self.tx.unpin(self.meta)
+        return (n0 << level) + nxt
+
+    def _read_meta(self) -> tuple[int, int, int]:
+        get = self.tx.get_int
+        return (
+            get(self.meta, self.LEVEL),
+            get(self.meta, self.NEXT),
+            get(self.meta, self.NBUCKETS),
+        )
+
+    @staticmethod
+    def _address(key: int, level: int, nxt: int, n0: int) -> int:
+        h = hash_key(key)
+        b = h % (n0 << level)
+        if b < nxt:
+            b = h % (n0 << (level + 1))
+        return b
+
+    def _lock_bucket(self, key: int, exclusive: bool) -> BlockId:
+        """
+        メタデータからバケットを決め、その先頭ページをロックしてから
+        メタデータのロックを外す
+        """
+        self.tx.pin(self.meta)
+        try:
+            b = self._address(key, *self._read_meta())
+            blk = BlockId(self.filename, b + 1)
+            if exclusive:
+                self.tx.x_lock(blk)
+            else:
+                self.tx.pin(blk)
+                self.tx.get_int(blk, BucketPage.COUNT)  # 読んでSロックを取る
+                self.tx.unpin(blk)
+            self.tx.unlock(self.meta)
+        finally:
+            self.tx.unpin(self.meta)
+        return blk
+
+    def _read(self, blk: BlockId, fn):
+        """ブロックをpinしている間だけfn(BucketPage)を呼ぶ"""
+        self.tx.pin(blk)
+        try:
+            return fn(BucketPage(self.tx, blk))
+        finally:
+            self.tx.unpin(blk)
+
+    def _chain(self, blk: BlockId) -> list[BlockId]:
+        """バケットの先頭ページとあふれページのブロック"""
+        blks = [blk]
+        while (nxt := self._read(blk, BucketPage.overflow)) >= 0:
+            blk = BlockId(self.ovffile, nxt)
+            blks.append(blk)
+        return blks
+
+    def _ensure_blocks(self, nbuckets: int) -> None:
+        """
+        バケットnbuckets-1までの先頭ページを用意する。ロールバックしたトランザクションが
+        足したブロックが残っていれば(中身は元に戻っているので)そのまま使う
+        """
+        while self.tx.size(self.filename) <= nbuckets:
+            self.tx.append(self.filename)
+
+    def _extend(self, last: BlockId) -> BlockId:
+        """バケットの最後のページlastの後にあふれページを足す"""
+        blk = self.tx.append(self.ovffile)
+        self._read(last, lambda page: page.set_overflow(blk.blknum))
+        return blk
+
+    def _split(self) -> None:
+        """次に分割するバケットのエントリを、それと新しいバケットに分け直す"""
+        self.tx.x_lock(self.meta)
+        self.tx.pin(self.meta)
+        try:
+            level, nxt, n0 = self._read_meta()
+            newbucket = (n0 << level) + nxt
+            newblk = BlockId(self.filename, newbucket + 1)
+            self._ensure_blocks(newbucket + 1)
+            old = BlockId(self.filename, nxt + 1)
+            self.tx.x_lock(old)
+            oldchain = self._chain(old)
+            stay: list[Entry] = []
+            move: list[Entry] = []
+            for blk in oldchain:
+                for e in self._read(blk, BucketPage.entries):
+                    if hash_key(e[0]) % (n0 << (level + 1)) == nxt:
+                        stay.append(e)
+                    else:
+                        move.append(e)
+            self._fill(oldchain, stay)
+            self._fill([newblk], move)
+            if nxt + 1 == n0 << level:
+                self.tx.set_int(self.meta, self.LEVEL, level + 1, True)
+                self.tx.set_int(self.meta, self.NEXT, 0, True)
+            else:
+                self.tx.set_int(self.meta, self.NEXT, nxt + 1, True)
+        finally:
+            self.tx.unpin(self.meta)
+
+    def _fill(self, chain: list[BlockId], entries: list[Entry]) -> None:
+        """
+        バケットのページに先頭から詰め直す。足りなければあふれページを足し、
+        余ったページは空にしてつないだままにする
+        """
+        cap = (self.tx.block_size() - BucketPage.HEADER) // BucketPage.SLOT
+        i = 0
+        while True:
+            chunk, entries = entries[:cap], entries[cap:]
+            self._read(chain[i], lambda page: page.set_entries(chunk))
+            i += 1
+            if i == len(chain):
+                if not entries:
+                    return
+                chain.append(self._extend(chain[-1]))
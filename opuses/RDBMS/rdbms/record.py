@@ -0,0 +1,359 @@
+"""
+レコード管理。スキーマからレコードのレイアウトを決め、スロット付きページにレコードを置く。
+読み書きはすべてTransaction経由なので、ロックとログはトランザクションに任せる。
+
+スロット付きページ:
+    [スロット数][空き領域の終わり][削除済みスロット数][スロット0]...[スロットn-1]
+    ...空き... [レコード]...
+    スロットにはレコードのオフセットを入れ、削除したスロットは負にする。
+    レコードは固定長なので、削除したスロットの領域はそのスロットごと再利用する。
+    空き領域の終わりが0のページ(未初期化やロールバックで戻ったページ)は空とみなす。
+"""
+
+import threading
+from dataclasses import dataclass, field
+from typing import ClassVar, Iterator
+
+from rdbms.storage.buffer import BufferMgr
+from rdbms.storage.disk import BlockId, FileMgr, Page
+from rdbms.transaction import Transaction
+
+
+@dataclass
+class Schema:
+    """テーブルのフィールド名と型、文字列の最大長"""
+
+    INTEGER: ClassVar[int] = 4
+    VARCHAR: ClassVar[int] = 12
+
+    fields: list[str] = field(default_factory=list)
+    info: dict[str, tuple[int, int]] = field(default_factory=dict)
+
+    def add_field(self, fldname: str, fldtype: int, length: int = 0) -> None:
+        if fldtype not in (self.INTEGER, self.VARCHAR):
+            raise ValueError(f"unknown field type: {fldtype}")
+        self.fields.append(fldname)
+        self.info[fldname] = (fldtype, length)
+
+    def add_int_field(self, fldname: str) -> None:
+        self.add_field(fldname, self.INTEGER)
+
+    def add_string_field(self, fldname: str, length: int) -> None:
+        self.add_field(fldname, self.VARCHAR, length)
+
+    def has_field(self, fldname: str) -> bool:
+        return fldname in self.info
+
+    def type(self, fldname: str) -> int:
+        return self.info[fldname][0]
+
+    def length(self, fldname: str) -> int:
+        return self.info[fldname][1]
+
+
+@dataclass
+class Layout:
+    """各フィールドのレコード内オフセットとレコード長"""
+
+    schema: Schema
+    offsets: dict[str, int] = field(default_factory=dict)
+    slotsize: int = 0
+
+    def __post_init__(self):
+        if self.offsets:
+            return
+        pos = 0
+        for fldname in self.schema.fields:
+            self.offsets[fldname] = pos
+            if self.schema.type(fldname) == Schema.INTEGER:
+                pos += 4
+            else:
+                pos += Page.max_length(self.schema.length(fldname))
+        self.slotsize = pos
+
+    def offset(self, fldname: str) -> int:
+        return self.offsets[fldname]
+
+
+@dataclass(frozen=True, order=True)
+class RID:
+    """レコードの識別子(ブロック番号とスロット番号)"""
+
+    blknum: int
+    slot: int
+
+    def __str__(self) -> str:
+        return f"[{self.blknum}, {self.slot}]"
+
+
+@dataclass
+class RecordPage:
+    """1ブロック分のスロット付きページ。ブロックはpinしておくこと"""
+
+    tx: Transaction
+    blk: BlockId
+    layout: Layout
+
+    NSLOTS: ClassVar[int] = 0
+    FREE_END: ClassVar[int] = 4
+    NDELETED: ClassVar[int] = 8
+    HEADER: ClassVar[int] = 12
+    EMPTY: ClassVar[int] = -1
+
+    def get_int(self, slot: int, fldname: str) -> int:
+        return self.tx.get_int(self.blk, self._field_pos(slot, fldname))
+
+    def get_string(self, slot: int, fldname: str) -> str:
+        return self.tx.get_string(self.blk, self._field_pos(slot, fldname))
+
+    def set_int(self, slot: int, fldname: str, val: int) -> None:
+        self.tx.set_int(self.blk, self._field_pos(slot, fldname), val, True)
+
+    def set_string(self, slot: int, fldname: str, val: str) -> None:
+        if len(val) > self.layout.schema.length(fldname):
+            raise ValueError(f"too long for {fldname}: {val!r}")
+        self.tx.set_string(self.blk, self._field_pos(slot, fldname), val, True)
+
+    def delete(self, slot: int) -> None:
+        self._check_used(slot)
+        pos = self._slot_pos(slot)
+        self.tx.set_int(self.blk, pos, -self.tx.get_int(self.blk, pos), True)
+        ndeleted = self.tx.get_int(self.blk, self.NDELETED)
+        self.tx.set_int(self.blk, self.NDELETED, ndeleted + 1, True)
+
+    def is_used(self, slot: int) -> bool:
+        return 0 <= slot < self.num_slots() and self._slot_offset(slot) > 0
+
+    def next_after(self, slot: int) -> int:
+        """slotより後で使われているスロット。無ければEMPTY"""
+        for s in range(slot + 1, self.num_slots()):
+            if self._slot_offset(s) > 0:
+                return s
+        return self.EMPTY
+
+    def insert(self) -> int:
+        """
+        空きスロットを確保して番号を返す。入らなければEMPTY。
+        削除済みのスロットがあればその領域を使い、無ければスロットを1つ増やす
+        """
+        nslots = self.num_slots()
+        ndeleted = self.tx.get_int(self.blk, self.NDELETED)
+        if ndeleted > 0:
+            for s in range(nslots):
+                off = self._slot_offset(s)
+                if off < 0:
+                    self.tx.set_int(self.blk, self._slot_pos(s), -off, True)
+                    self.tx.set_int(self.blk, self.NDELETED, ndeleted - 1, True)
+                    return s
+        free_end = self._free_end()
+        recpos = free_end - self.layout.slotsize
+        if recpos < self._slot_pos(nslots + 1):
+            return self.EMPTY
+        self.tx.set_int(self.blk, self._slot_pos(nslots), recpos, True)
+        self.tx.set_int(self.blk, self.FREE_END, recpos, True)
+        self.tx.set_int(self.blk, self.NSLOTS, nslots + 1, True)
+        return nslots
+
+    def has_room(self) -> bool:
+        return has_room(self.layout, self.tx.block_size(), self._read_header)
+
+    def num_slots(self) -> int:
+        return self.tx.get_int(self.blk, self.NSLOTS)
+
+    def _read_header(self, offset: int) -> int:
+        return self.tx.get_int(self.blk, offset)
+
+    def _free_end(self) -> int:
+        return self.tx.get_int(self.blk, self.FREE_END) or self.tx.block_size()
+
+    def _slot_pos(self, slot: int) -> int:
+        return self.HEADER + 4 * slot
+
+    def _slot_offset(self, slot: int) -> int:
+        return self.tx.get_int(self.blk, self._slot_pos(slot))
+
+    def _check_used(self, slot: int) -> None:
+        if not self.is_used(slot):
+            raise KeyError(f"no record at slot {slot} of {self.blk}")
+
+    def _field_pos(self, slot: int, fldname: str) -> int:
+        self._check_used(slot)
+        return self._slot_offset(slot) + self.layout.offset(fldname)
+
+
+def has_room(layout: Layout, blocksize: int, get_int) -> bool:
+    """get_intで読めるページにもう1レコード入るか"""
+    if get_int(RecordPage.NDELETED) > 0:
+        return True
+    nslots = get_int(RecordPage.NSLOTS)
+    free_end = get_int(RecordPage.FREE_END) or blocksize
+    return free_end - layout.slotsize >= RecordPage.HEADER + 4 * (nslots + 1)
+
+
+@dataclass
+class FreeSpaceMap:
+    """
+    レコードを入れられるブロックの一覧。挿入先をファイルを走査せずにO(1)で選ぶ。
+    ヒントでしかないので、挿入する側はブロックをロックしてから空きを確かめ、
+    無ければmark_fullして次の候補を使う。
+    最初に使うときに一度だけファイルを走査して作り、以後はデータベース内で共有する。
+    """
+
+    blocks: list[int] = field(default_factory=list)  # 空きのあるブロックのスタック
+    room: set[int] = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    maps: ClassVar[dict[tuple[str, str], "FreeSpaceMap"]] = {}
+    maps_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    @classmethod
+    def get(
+        cls, fm: FileMgr, bm: BufferMgr, filename: str, layout: Layout
+    ) -> "FreeSpaceMap":
+        key = (fm.db_directory, filename)
+        with cls.maps_lock:
+            fsm = cls.maps.get(key)
+            if fsm is None:
+                fsm = cls.maps[key] = cls.build(fm, bm, filename, layout)
+            return fsm
+
+    @classmethod
+    def build(
+        cls, fm: FileMgr, bm: BufferMgr, filename: str, layout: Layout
+    ) -> "FreeSpaceMap":
+        """ロックを取らずにブロックのヘッダを読んで作る"""
+        fsm = cls()
+        for blknum in range(fm.length(filename)):
+            buff = bm.pin(BlockId(filename, blknum))
+            try:
+                if has_room(layout, fm.block_size(), buff.contents.get_int):
+                    fsm.mark_free(blknum)
+            finally:
+                bm.unpin(buff)
+        return fsm
+
+    def find(self) -> int:
+        """空きのありそうなブロック番号。無ければ-1"""
+        with self.lock:
+            while self.blocks and self.blocks[-1] not in self.room:
+                self.blocks.pop()
+            return self.blocks[-1] if self.blocks else -1
+
+    def mark_free(self, blknum: int) -> None:
+        with self.lock:
+            if blknum not in self.room:
+                self.room.add(blknum)
+                self.blocks.append(blknum)
+
+    def mark_full(self, blknum: int) -> None:
+        with self.lock:
+            self.room.discard(blknum)
+
+
+@dataclass
+class TableScan:
+    """
+    テーブルのレコードを順に辿るカーソル。RIDで直接移動もできる。
+    挿入先はFreeSpaceMapで選び、どのブロックにも入らなければブロックを追加する。
+    """
+
+    tx: Transaction
+    tblname: str
+    layout: Layout
+    rp: RecordPage | None = field(default=None, init=False)
+    currentslot: int = field(default=RecordPage.EMPTY, init=False)
+
+    def __post_init__(self):
+        self.filename = self.tblname + ".tbl"
+        self.fsm = FreeSpaceMap.get(self.tx.fm, self.tx.bm, self.filename, self.layout)
+        self.before_first()
+
+    def close(self) -> None:
+        if self.rp is not None:
+            self.tx.unpin(self.rp.blk)
+            self.rp = None
+
+    def before_first(self) -> None:
+        self._move_to_block(0)
+
+    def next(self) -> bool:
+        while True:
+            if self.rp is None:
+                return False
+            self.currentslot = self.rp.next_after(self.currentslot)
+            if self.currentslot != RecordPage.EMPTY:
+                return True
+            if self.rp.blk.blknum + 1 >= self.tx.size(self.filename):
+                return False
+            self._move_to_block(self.rp.blk.blknum + 1)
+
+    def __iter__(self) -> Iterator[RID]:
+        self.before_first()
+        while self.next():
+            yield self.get_rid()
+
+    def get_int(self, fldname: str) -> int:
+        return self.rp.get_int(self.currentslot, fldname)
+
+    def get_string(self, fldname: str) -> str:
+        return self.rp.get_string(self.currentslot, fldname)
+
+    def get_val(self, fldname: str) -> int | str:
+        if self.layout.schema.type(fldname) == Schema.INTEGER:
+            return self.get_int(fldname)
+        return self.get_string(fldname)
+
+    def has_field(self, fldname: str) -> bool:
+        return self.layout.schema.has_field(fldname)
+
+    def set_int(self, fldname: str, val: int) -> None:
+        self.rp.set_int(self.currentslot, fldname, val)
+
+    def set_string(self, fldname: str, val: str) -> None:
+        self.rp.set_string(self.currentslot, fldname, val)
+
+    def set_val(self, fldname: str, val: int | str) -> None:
+        if self.layout.schema.type(fldname) == Schema.INTEGER:
+            self.set_int(fldname, val)
+        else:
+            self.set_string(fldname, val)
+
+    def insert(self) -> RID:
+        """新しいレコードの場所を確保してそこへ移動する"""
+        while (blknum := self.fsm.find()) != -1:
+            if blknum < self.tx.size(self.filename):
+                self._move_to_block(blknum)
+                self.currentslot = self.rp.insert()
+                if self.currentslot != RecordPage.EMPTY:
+                    if not self.rp.has_room():
+                        self.fsm.mark_full(blknum)
+                    return self.get_rid()
+            self.fsm.mark_full(blknum)
+        blk = self.tx.append(self.filename)
+        self._move_to_block(blk.blknum)
+        self.currentslot = self.rp.insert()
+        if self.rp.has_room():
+            self.fsm.mark_free(blk.blknum)
+        return self.get_rid()
+
+    def delete(self) -> None:
+        self.rp.delete(self.currentslot)
+        self.fsm.mark_free(self.rp.blk.blknum)
+
+    def move_to_rid(self, rid: RID) -> None:
+        self._move_to_block(rid.blknum)
+        if not self.rp.is_used(rid.slot):
+            raise KeyError(f"no record at {rid}")
+        self.currentslot = rid.slot
+
+    def get_rid(self) -> RID:
+        return RID(self.rp.blk.blknum, self.currentslot)
+
+    def _move_to_block(self, blknum: int) -> None:
+        self.close()
+        self.currentslot = RecordPage.EMPTY
+        if blknum >= self.tx.size(self.filename):
+            return
+        blk = BlockId(self.filename, blknum)
+        self.tx.pin(blk)
+        self.rp = RecordPage(self.tx, blk, self.layout)
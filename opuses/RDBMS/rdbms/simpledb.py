@@ -0,0 +1,84 @@
+"""
+データベース1つ分の部品(FileMgr, LogMgr, BufferMgr)をまとめて起動する。
+
+    db = SimpleDB("studentdb", 400, 8)
+    tx = db.new_tx()
+    ...
+    tx.commit()
+    db.close()
+
+既存のディレクトリを開いたときは、最初にログからリカバリしてから使えるようにする。
+"""
+
+import logging
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.compress import Codec
+from rdbms.storage.disk import CompressedFileMgr, FileMgr
+from rdbms.transaction import Transaction
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SimpleDB:
+    dirname: str
+    blocksize: int = 400
+    buffsize: int = 8
+    policy: str = "lru"
+    durability: str = "deferred"
+    compression: str | None = None  # "zlib"か"lz4"ならブロックを圧縮して書く
+    compressed_cache: int = 0  # 追い出したページを圧縮して持つバイト数
+    fm: FileMgr = field(init=False)
+    lm: LogMgr = field(init=False)
+    bm: BufferMgr = field(init=False)
+
+    LOG_FILE: ClassVar[str] = "simpledb.log"
+
+    def __post_init__(self):
+        if self.compression is None:
+            self.fm = FileMgr(self.dirname, self.blocksize, durability=self.durability)
+        else:
+            self.fm = CompressedFileMgr(
+                self.dirname,
+                self.blocksize,
+                durability=self.durability,
+                codec=Codec(self.compression),
+            )
+        self.lm = LogMgr(self.fm, self.LOG_FILE)
+        self.bm = BufferMgr(
+            self.fm,
+            self.lm,
+            self.buffsize,
+            self.policy,
+            compressed_cache=self.compressed_cache,
+        )
+        if self.fm.is_new:
+            logger.info("creating new database: %s", self.dirname)
+        else:
+            logger.info("recovering existing database: %s", self.dirname)
+            tx = self.new_tx()
+            tx.recover()
+            tx.commit()
+
+    def file_mgr(self) -> FileMgr:
+        return self.fm
+
+    def log_mgr(self) -> LogMgr:
+        return self.lm
+
+    def buffer_mgr(self) -> BufferMgr:
+        return self.bm
+
+    def new_tx(self, read_only: bool = False) -> Transaction:
+        return Transaction(self.fm, self.lm, self.bm, read_only=read_only)
+
+    def close(self) -> None:
+        """汚れたバッファとログを書き出してファイルを閉じる"""
+        self.bm.flush_for_checkpoint()
+        self.lm.flush(self.lm.latest_lsn)
+        if self.bm.prefetcher is not None:
+            self.bm.prefetcher.shutdown()
+        self.fm.close()
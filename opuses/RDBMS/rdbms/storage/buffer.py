@@ -1,67 +1,385 @@
+import bisect
+import logging
+import re
+import threading
+import time
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from typing import ClassVar, Iterable
 
+from rdbms.storage.codec import get_varint, put_varint, varint_size
+from rdbms.storage.compress import CompressedCache
 from rdbms.storage.disk import BlockId, FileMgr, Page
+from rdbms.storage.metrics import metrics
+from rdbms.storage.replacer import Replacer, make_replacer
+
+logger = logging.getLogger(__name__)
 
 
 @dataclass
 class LogMgr:
+    """
+    LSNはログ内の位置(ブロック番号 * ブロックサイズ + ブロック末尾からのバイト数)。
+    追記するほど大きくなり、再起動しても続きから数えられる。
+
+    ログはsegment_blocksブロックずつのセグメントファイルに分ける。ファイル名は
+    "<logfile>.<先頭のLSN(16進16桁)>"なので、LSNからすぐにセグメントを引ける。
+    truncate()で不要になったセグメントはrecycle_segments個まで名前を変えて取っておき、
+    新しいセグメントに使い回す。ブロック番号はログ全体での通し番号。
+
+    ログブロックのレイアウト:
+        [境界][CRC32][辞書の終わり][ブロック番号][ファイル名辞書 ->] ... [<- レコード]
+    ブロック番号が合わないブロックは使い回したファイルに残った古い内容。
+    レコードは長さ(varint)+本体で、ブロック末尾から先頭に向かって詰める。
+    ファイル名辞書はブロックごとに持ち、レコードはファイル名の代わりに
+    辞書の番号を書く(encode(intern)を持つレコードを追記した場合)。
+    """
+
     fm: "FileMgr"
     logfile: str
     logpage: Page = None
-    current_blk: BlockId = None
+    current_blk: BlockId = None  # セグメントファイル内のブロック
+    current_gblk: int = 0  # ログ全体での通し番号
     latest_lsn: int = 0
     last_saved_lsn: int = 0
+    # グループコミット: 複数トランザクションのコミットを1回の書き込み+fsyncにまとめる
+    group_commit: bool = False
+    group_window: float = 0.002  # リーダーが後続のコミットを待つ最大時間(秒)
+    group_bytes: int = 4096  # 未フラッシュのログがこれを超えたら待たずに書く
+    checksum: bool = False  # 書き出すブロックにCRC32を付ける
+    segment_blocks: int = 256
+    recycle_segments: int = 2  # 使い回すために取っておくセグメント数
+    segments: list[int] = field(default_factory=list, init=False)  # 先頭ブロック
+    free_segments: list[str] = field(default_factory=list, init=False)
+    unflushed_bytes: int = field(default=0, init=False)
+    flushing: bool = field(default=False, init=False)
+    names: dict[str, int] = field(default_factory=dict, init=False)
+    lock: threading.Lock = field(init=False)
+    cond: threading.Condition = field(init=False)
+    HEADER: ClassVar[int] = 16
 
     def __post_init__(self):
-        self.logpage = Page(block_size=self.fm.block_size())
-        logsize = self.fm.length(self.logfile)
-        if logsize == 0:
-            self.current_blk = self._append_new_block()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.logpage = Page(self.fm.block_size())
+        segment = re.compile(re.escape(self.logfile) + r"\.([0-9a-f]{16})")
+        for filename in self.fm.list_files(self.logfile + "."):
+            if m := segment.fullmatch(filename):
+                self.segments.append(int(m[1], 16) // self.fm.block_size())
+            elif filename.startswith(self.logfile + ".recycle."):
+                self.free_segments.append(filename)
+        self.segments.sort()
+
+        if not self.segments:
+            self._new_segment(0)
+            self._init_block(0)
         else:
-            self.current_blk = BlockId(self.logfile, logsize - 1)
-            self.fm.read(self.current_blk, self.logpage)
+            start = self.segments[-1]
+            nblocks = self._valid_blocks(start)
+            if nblocks == 0:  # セグメントを作った直後に止まった
+                self._init_block(start)
+            else:
+                self.current_gblk = start + nblocks - 1
+                self.current_blk = self._block(self.current_gblk)
+                self.fm.read(self.current_blk, self.logpage)
+                if crc_ok(self.logpage):
+                    names = read_names(self.logpage)
+                    self.names = {name: i for i, name in enumerate(names)}
+                else:
+                    # 末尾のブロックの書き込みが途中で止まった。ログはその手前で終わる
+                    logger.warning("torn log block %s is discarded", self.current_blk)
+                    self._init_block(self.current_gblk)
+        self.latest_lsn = self._lsn(self.logpage.get_int(0))
+        self.last_saved_lsn = self.latest_lsn
 
     def flush(self, lsn: int) -> None:
-        if lsn >= self.last_saved_lsn:
-            self._flush()
+        """lsnまでのログを安定したストレージに書き出す"""
+        with self.lock:
+            # 書き込みはロックを持ったまま行うので、待ち中のグループもここで書ける
+            if lsn > self.last_saved_lsn:
+                self._flush()
+
+    def group_flush(self, lsn: int) -> None:
+        """
+        コミット用のflush。group_commitが有効なら、最初に来たトランザクションが
+        リーダーとしてgroup_windowだけ後続を待ち、まとめて1回で書き出す。
+        """
+        if not self.group_commit:
+            self.flush(lsn)
+            return
+
+        with self.lock:
+            while lsn > self.last_saved_lsn:
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                self.flushing = True
+                try:
+                    deadline = time.monotonic() + self.group_window
+                    while self.unflushed_bytes < self.group_bytes:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.cond.wait(remaining)
+                    if lsn > self.last_saved_lsn:
+                        self._flush()
+                finally:
+                    self.flushing = False
+                    self.cond.notify_all()
 
     def iterator(self) -> "LogIterator":
-        self._flush()
-        return LogIterator(self.fm, self.current_blk)
+        with self.lock:
+            self._flush()
+            gblk = self.current_gblk
+        return LogIterator(self, gblk)
+
+    def forward_iterator(
+        self,
+        start_lsn: int = 0,
+        end_lsn: int | None = None,
+        readahead: int = 8,
+        follow: bool = False,
+        timeout: float | None = None,
+    ) -> "ForwardLogIterator":
+        """start_lsnからend_lsnまでのレコードを古い順に返すイテレータ"""
+        if not follow:
+            with self.lock:
+                self._flush()
+        return ForwardLogIterator(self, start_lsn, end_lsn, readahead, follow, timeout)
+
+    def truncate(self, lsn: int) -> int:
+        """
+        LSNがlsnより前のレコードしか入っていないセグメントを捨て、捨てた数を返す。
+        書き込み中のセグメントは捨てない。
+        """
+        blocksize = self.fm.block_size()
+        removed = 0
+        with self.lock:
+            # セグメントiのレコードのLSNは次のセグメントの先頭アドレス以下
+            while len(self.segments) > 1 and self.segments[1] * blocksize < lsn:
+                start = self.segments.pop(0)
+                filename = self.segment_name(start)
+                if len(self.free_segments) < self.recycle_segments:
+                    free = f"{self.logfile}.recycle.{start * blocksize:016x}"
+                    self.fm.rename(filename, free)
+                    self.free_segments.append(free)
+                else:
+                    self.fm.remove(filename)
+                removed += 1
+        return removed
+
+    def segment_name(self, start: int) -> str:
+        """先頭ブロックがstartのセグメントのファイル名"""
+        return f"{self.logfile}.{start * self.fm.block_size():016x}"
 
-    def append(self, logrec: bytes) -> int:
-        boundary = self.logpage.get_int(0)
-        recsize = len(logrec)
-        bytesneeded = recsize + 4  # 4はInteger.BYTESに相当
+    def first_block(self) -> int:
+        """残っている最も古いログブロックの通し番号"""
+        with self.lock:
+            return self.segments[0]
 
-        if boundary - bytesneeded < 4:  # 収まらない場合
+    def locate(self, gblk: int) -> BlockId:
+        """通し番号のログブロックがあるセグメントファイル内の位置"""
+        with self.lock:
+            return self._block(gblk)
+
+    def append(self, logrec) -> int:
+        """
+        logrecはbytesか、encode(intern)でbytesを返すログレコード。
+        internはファイル名をこのブロックの辞書の番号に変換する。
+        """
+        with self.lock:
+            lsn = self._append(logrec)
+            self._notify_leader()
+            return lsn
+
+    def append_many(self, logrecs) -> int:
+        """ロックを1回だけ取ってまとめて追記し、最後のレコードのLSNを返す"""
+        with self.lock:
+            lsn = self.latest_lsn
+            for logrec in logrecs:
+                lsn = self._append(logrec)
+            self._notify_leader()
+            return lsn
+
+    def _append(self, logrec) -> int:
+        data, newnames = self._encode(logrec)
+        if not self._fits(data, newnames):
+            for name in newnames:
+                del self.names[name]
             self._flush()  # 次のブロックに移動
-            self.current_blk = self._append_new_block()
-            boundary = self.logpage.get_int(0)
+            self._append_new_block()
+            data, newnames = self._encode(logrec)
+            if not self._fits(data, newnames):
+                for name in newnames:
+                    del self.names[name]
+                raise ValueError("log record does not fit in a log block")
+
+        bb = self.logpage.contents()
+        dictend = self.logpage.get_int(8)
+        for name in newnames:
+            self.logpage.set_string(dictend, name)
+            dictend += Page.max_length(len(name))
+        self.logpage.set_int(8, dictend)
 
-        recpos = boundary - bytesneeded
-        self.logpage.set_bytes(recpos, logrec)
+        header = bytearray()
+        put_varint(header, len(data))
+        recpos = self.logpage.get_int(0) - len(header) - len(data)
+        bb[recpos : recpos + len(header)] = header
+        bb[recpos + len(header) : recpos + len(header) + len(data)] = data
         self.logpage.set_int(0, recpos)  # 新しい境界
-        self.latest_lsn += 1
+        self.latest_lsn = self._lsn(recpos)
+        self.unflushed_bytes += len(header) + len(data)
+        if metrics.enabled:
+            metrics.inc("log_appends")
+            metrics.inc("log_append_bytes", len(header) + len(data))
         return self.latest_lsn
 
-    def _append_new_block(self) -> BlockId:
-        blk = self.fm.append(self.logfile)
-        self.logpage.set_int(0, self.fm.block_size())
-        self.fm.write(blk, self.logpage)
-        return blk
+    def _encode(self, logrec) -> tuple[bytes, list[str]]:
+        """レコードを符号化し、辞書に新しく加えたファイル名と一緒に返す"""
+        if isinstance(logrec, (bytes, bytearray, memoryview)):
+            return logrec, []
+        newnames: list[str] = []
+
+        def intern(name: str) -> int:
+            i = self.names.get(name)
+            if i is None:
+                i = self.names[name] = len(self.names)
+                newnames.append(name)
+            return i
+
+        return logrec.encode(intern), newnames
+
+    def _fits(self, data: bytes, newnames: list[str]) -> bool:
+        recsize = varint_size(len(data)) + len(data)
+        namesize = sum(Page.max_length(len(name)) for name in newnames)
+        free = self.logpage.get_int(0) - self.logpage.get_int(8)
+        return recsize + namesize <= free
+
+    def _notify_leader(self) -> None:
+        if self.flushing and self.unflushed_bytes >= self.group_bytes:
+            self.cond.notify_all()  # 待っているリーダーに書き出させる
+
+    def _lsn(self, recpos: int) -> int:
+        """現在のブロックのrecposにあるレコードのLSN"""
+        blocksize = self.fm.block_size()
+        return self.current_gblk * blocksize + (blocksize - recpos)
+
+    def _block(self, gblk: int) -> BlockId:
+        i = bisect.bisect_right(self.segments, gblk) - 1
+        if i < 0:
+            raise ValueError(f"log block {gblk} has been truncated")
+        start = self.segments[i]
+        return BlockId(self.segment_name(start), gblk - start)
+
+    def _append_new_block(self) -> None:
+        gblk = self.current_gblk + 1
+        if gblk - self.segments[-1] >= self.segment_blocks:
+            self._new_segment(gblk)
+        self._init_block(gblk)
+
+    def _new_segment(self, start: int) -> None:
+        """startから始まるセグメントを作る。取っておいたファイルがあれば使い回す"""
+        if self.free_segments:
+            self.fm.rename(self.free_segments.pop(), self.segment_name(start))
+        self.segments.append(start)
+
+    def _init_block(self, gblk: int) -> None:
+        blocksize = self.fm.block_size()
+        self.current_gblk = gblk
+        self.current_blk = self._block(gblk)
+        self.logpage.contents()[:] = bytes(blocksize)
+        self.logpage.set_int(0, blocksize)
+        self.logpage.set_int(8, self.HEADER)
+        self.logpage.set_int(12, gblk)
+        self.names = {}
+        self.fm.write(self.current_blk, self.logpage)
+
+    def _valid_blocks(self, start: int) -> int:
+        """
+        セグメントの先頭から続く、このセグメントで書いたブロックの数。
+        ブロックは先頭から順に書くので二分探索できる。
+        """
+        filename = self.segment_name(start)
+        p = Page(self.fm.block_size())
+
+        def valid(i: int) -> bool:
+            self.fm.read(BlockId(filename, i), p)
+            return p.get_int(12) == start + i and valid_header(p)
+
+        lo, hi = 0, min(self.fm.length(filename), self.segment_blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if valid(mid):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
 
     def _flush(self) -> None:
+        """1回の書き込みと1回のfsyncでlatest_lsnまでを永続化する"""
+        if self.checksum:
+            self.logpage.contents()[4:8] = block_crc(self.logpage).to_bytes(4, "big")
         self.fm.write(self.current_blk, self.logpage)
+        self.fm.sync(self.current_blk.filename)
+        if metrics.enabled:
+            metrics.inc("log_flushes")
+            metrics.observe("log_flush_bytes", self.unflushed_bytes)
         self.last_saved_lsn = self.latest_lsn
+        self.unflushed_bytes = 0
+        self.cond.notify_all()  # ForwardLogIteratorのfollowに知らせる
+
+
+def read_names(p: Page) -> list[str]:
+    """ログブロックのファイル名辞書を読む"""
+    names = []
+    pos, dictend = LogMgr.HEADER, p.get_int(8)
+    while pos < dictend:
+        name = p.get_string(pos)
+        names.append(name)
+        pos += Page.max_length(len(name))
+    return names
+
+
+def valid_header(p: Page) -> bool:
+    """ゼロ埋めや書きかけでないログブロックか"""
+    dictend, boundary = p.get_int(8), p.get_int(0)
+    return LogMgr.HEADER <= dictend <= boundary <= len(p.contents())
+
+
+def check_block(p: Page, blk: BlockId) -> None:
+    """CRCが付いていれば検証する"""
+    if not crc_ok(p):
+        raise RuntimeError(f"log block {blk} is corrupted (CRC mismatch)")
+
+
+def crc_ok(p: Page) -> bool:
+    """CRCが付いていないか、付いていて合っているか"""
+    crc = int.from_bytes(p.contents()[4:8], "big")
+    return not crc or crc == block_crc(p)
+
+
+def block_crc(p: Page) -> int:
+    """CRC欄を除いたログブロックのCRC32。0は「CRCなし」に使うので1にずらす"""
+    bb = p.contents()
+    return zlib.crc32(bb[8:], zlib.crc32(bb[0:4])) or 1
 
 
 class LogIterator:
-    def __init__(self, fm: "FileMgr", blk: BlockId):
-        self.fm = fm
-        self.blk = blk
-        self.p = Page(block_size=fm.block_size())
-        self._move_to_block(blk)
+    """
+    ログを新しいレコードから順に返す。lsnは直前に返したレコードのLSN、
+    namesはそのレコードのブロックのファイル名辞書
+    """
+
+    def __init__(self, lm: LogMgr, gblk: int):
+        self.lm = lm
+        self.fm = lm.fm
+        self.gblk = gblk
+        self.p = Page(self.fm.block_size())
+        self.lsn = -1
+        self.names: list[str] = []
+        self._move_to_block(gblk)
 
     def __iter__(self):
         return self
@@ -71,22 +389,138 @@ class LogIterator:
             raise StopIteration
 
         if self.current_pos == self.fm.block_size():
-            self.blk = BlockId(self.blk.file_name, self.blk.number - 1)
-            self._move_to_block(self.blk)
+            self.gblk -= 1
+            self._move_to_block(self.gblk)
 
-        rec = self.p.get_bytes(self.current_pos)
-        self.current_pos += 4 + len(rec)  # 4はInteger.BYTESに相当
-        return rec
+        blocksize = self.fm.block_size()
+        self.lsn = self.gblk * blocksize + (blocksize - self.current_pos)
+        bb = self.p.contents()
+        length, pos = get_varint(bb, self.current_pos)
+        self.current_pos = pos + length
+        return bytes(bb[pos : self.current_pos])
 
     def has_next(self) -> bool:
-        return self.current_pos < self.fm.block_size() or self.blk.number > 0
+        return (
+            self.current_pos < self.fm.block_size() or self.gblk > self.lm.first_block()
+        )
 
-    def _move_to_block(self, blk: BlockId) -> None:
+    def _move_to_block(self, gblk: int) -> None:
+        blk = self.lm.locate(gblk)
         self.fm.read(blk, self.p)
+        check_block(self.p, blk)
+        self.names = read_names(self.p)
         self.boundary = self.p.get_int(0)
         self.current_pos = self.boundary
 
 
+class ForwardLogIterator:
+    """
+    start_lsn以降のレコードを古い順に返す。end_lsnを渡せばそこで止まる。
+    ブロックはreadaheadずつread_manyでまとめて読み、レコードはその読み込み
+    バッファを指すmemoryviewで返す(コピーしない)。lsnとnamesはLogIteratorと同じ。
+    followなら末尾に追いついた後も、新しくフラッシュされたレコードを待って
+    返し続ける(tail -f)。timeout秒来なければ終わる。close()で止められる。
+    """
+
+    def __init__(
+        self,
+        lm: LogMgr,
+        start_lsn: int = 0,
+        end_lsn: int | None = None,
+        readahead: int = 8,
+        follow: bool = False,
+        timeout: float | None = None,
+    ):
+        self.lm = lm
+        self.fm = lm.fm
+        self.end_lsn = end_lsn
+        self.readahead = max(1, readahead)
+        self.follow = follow
+        self.timeout = timeout
+        self.limit = lm.last_saved_lsn  # followでなければ作った時点の末尾まで
+        self.from_lsn = max(start_lsn, 1)  # まだ読み込んでいない最小のLSN
+        self.gblk = (self.from_lsn - 1) // self.fm.block_size()
+        self.pending: deque[tuple[int, list[str], memoryview]] = deque()
+        self.lsn = -1
+        self.names: list[str] = []
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> memoryview:
+        while not self.pending:
+            if not self._fill():
+                raise StopIteration
+        lsn, names, rec = self.pending[0]
+        if self.end_lsn is not None and lsn > self.end_lsn:
+            raise StopIteration
+        self.pending.popleft()
+        self.lsn, self.names = lsn, names
+        return rec
+
+    def close(self) -> None:
+        with self.lm.lock:
+            self.closed = True
+            self.lm.cond.notify_all()
+
+    def _fill(self) -> bool:
+        """次のブロック群を読み込む。返すレコードがもうなければFalse"""
+        limit = self._wait_for_records()
+        if limit is None:
+            return False
+        blocksize = self.fm.block_size()
+        last = (limit - 1) // blocksize
+        first = max(self.gblk, self.lm.first_block())
+        gblks = range(first, min(first + self.readahead, last + 1))
+        buf = memoryview(bytearray(len(gblks) * blocksize))
+        pages = [
+            Page(buf[i * blocksize : (i + 1) * blocksize]) for i in range(len(gblks))
+        ]
+        blks = [self.lm.locate(g) for g in gblks]
+        self.fm.read_many(blks, pages)
+
+        for gblk, blk, p in zip(gblks, blks, pages):
+            check_block(p, blk)
+            names = read_names(p)
+            bb = p.contents()
+            recs = []
+            pos = p.get_int(0)
+            while pos < blocksize:
+                lsn = gblk * blocksize + (blocksize - pos)
+                length, start = get_varint(bb, pos)
+                pos = start + length
+                if self.from_lsn <= lsn <= limit:
+                    recs.append((lsn, names, bb[start:pos]))
+            # ブロック内のレコードは新しいものから並んでいる
+            self.pending.extend(reversed(recs))
+        if self.pending:
+            self.from_lsn = self.pending[-1][0] + 1
+        if gblks[-1] == last:
+            # limitまでのレコードはすべて読んだ(末尾のブロックに何もなくても)
+            self.from_lsn = max(self.from_lsn, limit + 1)
+        # 末尾のブロックはまだ伸びるので次も読み直す
+        self.gblk = gblks[-1] if gblks[-1] == last else gblks[-1] + 1
+        return True
+
+    def _wait_for_records(self) -> int | None:
+        """from_lsn以降にレコードがあれば、読んでよい末尾のLSNを返す"""
+        if self.end_lsn is not None and self.from_lsn > self.end_lsn:
+            return None
+        if not self.follow:
+            return self.limit if self.from_lsn <= self.limit else None
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        with self.lm.lock:
+            while self.lm.last_saved_lsn < self.from_lsn:
+                if self.closed:
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.lm.cond.wait(remaining)
+            return self.lm.last_saved_lsn
+
+
 @dataclass
 class Buffer:
     fm: "FileMgr"
@@ -96,9 +530,16 @@ class Buffer:
     pins: int = 0
     txnum: int = -1
     lsn: int = -1
+    frame: int = -1  # バッファプール内の位置
+    loading: threading.Event | None = None  # 読み込み中ならセットされる
+    pin_lsn: int = -1  # ピンされ始めた時点のLogMgr.latest_lsn
+    replaced: BlockId | None = None  # 読み込み中のフレームに前に入っていたブロック
+    changed: bool = False  # 読み込んでから変更したか(圧縮キャッシュに入れ直すか)
 
     def __post_init__(self):
-        self.contents = Page(block_size=self.fm.block_size())
+        # mmapのバックエンドではブロックを割り当てるときにマッピングを参照する
+        if not self.fm.zero_copy:
+            self.contents = Page(self.fm.block_size())
 
     def block(self) -> BlockId:
         return self.blk
@@ -110,6 +551,7 @@ class Buffer:
         return self.txnum
 
     def set_modified(self, txnum: int, lsn: int) -> None:
+        self.changed = True
         self.txnum = txnum
         if lsn >= 0:
             self.lsn = lsn
@@ -117,14 +559,26 @@ class Buffer:
     def pin(self) -> None:
         self.pins += 1
 
-    def unpin(self) -> None:
-        self.pins -= 1
+    def unpin(self, n: int = 1) -> None:
+        self.pins -= n
 
-    def assign_to_block(self, b: BlockId) -> None:
-        self.flush()
-        self.blk = b
-        self.fm.read(self.blk, self.contents)
-        self.pins = 0
+    def load(self) -> None:
+        """
+        割り当てられたブロックを読み込む。前のブロックが汚れていれば先に書き戻す。
+        BufferMgrのロックの外で呼ぶ。
+        """
+        self.write_replaced()
+        self.lsn = -1
+        if self.fm.zero_copy:
+            self.contents = self.fm.page(self.blk)
+        else:
+            self.fm.read(self.blk, self.contents)
+
+    def write_replaced(self) -> None:
+        if self.txnum >= 0:
+            self.lm.flush(self.lsn)
+            self.fm.write(self.replaced, self.contents)
+            self.txnum = -1
 
     def flush(self) -> None:
         if self.txnum >= 0:
@@ -142,106 +596,525 @@ class BufferMgr:
     fm: "FileMgr"
     lm: "LogMgr"
     numbuffs: int
+    policy: str = "lru"  # lru, clock, lru-k (2q)
     bufferpool: list[Buffer] = None
     num_available: int = 0
     MAX_TIME: int = 10000  # 10秒
+    readahead: int = 0  # 順次アクセスを検出したら先読みするブロック数(0なら無効)
+    readahead_async: bool = False  # 先読みをバックグラウンドスレッドで行う
+    # 追い出したページを圧縮して持っておくバイト数(0なら無効)。
+    # 次にpinされたらディスクを読まずに展開する
+    compressed_cache: int = 0
+    ccache: CompressedCache | None = field(init=False)
+    replacer: Replacer = field(init=False)
+    buffer_table: dict[BlockId, Buffer] = field(init=False)
+    free_frames: list[int] = field(init=False)
+    lock: threading.Lock = field(init=False)
+    # 待ち手はnotify()を持つもの(threading.Conditionか、try_pinに渡されたwaiter)
+    waiters: deque[threading.Condition] = field(init=False)
 
     def __post_init__(self):
         self.bufferpool = []
         self.num_available = self.numbuffs
         for i in range(self.numbuffs):
-            self.bufferpool.append(Buffer(self.fm, self.lm))
+            self.bufferpool.append(Buffer(self.fm, self.lm, frame=i))
+        self.replacer = make_replacer(self.policy, self.numbuffs)
+        # ブロック -> バッファのハッシュ索引。pinのたびにプールを走査しない
+        self.buffer_table = {}
+        # 一度もブロックを割り当てていないフレーム。追い出しより先に使う
+        self.free_frames = list(reversed(range(self.numbuffs)))
+        # プールの状態はすべてlockで守る。待ち手は到着順に並べる
+        self.lock = threading.Lock()
+        self.waiters = deque()
+        # 先読み: ファイルごとに次に来ると予想するブロック番号と先読み済みの位置
+        self.next_expected: dict[str, int] = {}
+        self.readahead_upto: dict[str, int] = {}
+        self.prefetcher = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="readahead")
+            if self.readahead_async
+            else None
+        )
+        # mmapのバックエンドはページキャッシュを直接参照するので使わない
+        self.ccache = (
+            CompressedCache(self.compressed_cache)
+            if self.compressed_cache > 0 and not self.fm.zero_copy
+            else None
+        )
+        if self.ccache is not None:
+            # 消したファイルを作り直したときに古いページを返さない
+            self.fm.removal_hooks.append(self.ccache.discard_file)
 
     def available(self) -> int:
         return self.num_available
 
     def flush_all(self, txnum: int) -> None:
-        for buff in self.bufferpool:
-            if buff.modifying_tx() == txnum:
-                buff.flush()
+        self._wait_for_evictions()
+        with self.lock:
+            buffs = [
+                b
+                for b in self.bufferpool
+                if b.modifying_tx() == txnum and b.loading is None
+            ]
+            snapshots = self._snapshot(buffs)
+        if snapshots:
+            self._write_snapshots(snapshots, max(lsn for *_, lsn in snapshots))
 
-    def unpin(self, buff: Buffer) -> None:
-        buff.unpin()
-        if not buff.is_pinned():
-            self.num_available += 1
-            # JavaのnotifyAll()に相当するコードはPythonでは異なる実装が必要
-            # ここではシンプルな実装のため省略
+    def write_back(self, max_pages: int | None = None) -> int:
+        """
+        汚れていてピンされていないバッファをブロック順に書き出す。
+        追い出すときに同期的な書き込みが起きないよう、バックグラウンドで呼ぶ。
+        書き出したページ数を返す。
+        """
+        with self.lock:
+            buffs = [
+                b
+                for b in self.bufferpool
+                if b.txnum >= 0 and not b.is_pinned() and b.loading is None
+            ]
+            buffs.sort(key=lambda b: (b.blk.filename, b.blk.blknum))
+            snapshots = self._snapshot(buffs[:max_pages])
+        if snapshots:
+            self._write_snapshots(snapshots, max(lsn for *_, lsn in snapshots))
+        return len(snapshots)
 
-    def pin(self, blk: BlockId) -> Buffer:
-        import time
+    def flush_for_checkpoint(self) -> int:
+        """
+        ピン中のものも含めて汚れたバッファをすべて書き出し、リカバリで
+        redoを始めるべきLSNを返す。
+        その時点でピンされていないバッファの変更はすべて書き出しに含まれる。
+        ピン中のバッファへの変更はpin_lsnより後にログが書かれているので、
+        redoの開始点はそれらのpin_lsnの最小値までさかのぼれば十分。
+        ピン中のバッファは書き出しても汚れたままにしておく(_snapshotを参照)。
+        """
+        self._wait_for_evictions()
+        with self.lock:
+            redo_lsn = self.lm.latest_lsn
+            for b in self.bufferpool:
+                if b.is_pinned() and b.loading is None:
+                    redo_lsn = min(redo_lsn, b.pin_lsn)
+            buffs = [b for b in self.bufferpool if b.txnum >= 0 and b.loading is None]
+            buffs.sort(key=lambda b: (b.blk.filename, b.blk.blknum))
+            snapshots = self._snapshot(buffs)
+        # スナップショットに含まれる変更のログはすべてこれまでに追記されている
+        self._write_snapshots(snapshots, self.lm.latest_lsn)
+        # redo_lsnより前のログを捨てる前に、書き出したページを同期しておく
+        self.fm.sync_all()
+        return redo_lsn
 
-        timestamp = time.time() * 1000  # ミリ秒に変換
+    def _wait_for_evictions(self) -> None:
+        """追い出し中の汚れたページが書き戻されるまで待つ"""
+        while True:
+            with self.lock:
+                pending = [
+                    b.loading
+                    for b in self.bufferpool
+                    if b.loading is not None and b.txnum >= 0
+                ]
+            if not pending:
+                return
+            for loading in pending:
+                loading.wait()
 
-        buff = self._try_to_pin(blk)
-        while buff is None and not self._waiting_too_long(timestamp):
-            # Javaのwait()に相当するコードはPythonでは異なる実装が必要
-            # ここではシンプルに時間をチェックする
-            time.sleep(0.1)  # 100ミリ秒待機
-            buff = self._try_to_pin(blk)
+    def _snapshot(
+        self, buffs: list[Buffer]
+    ) -> list[tuple[Buffer, BlockId, bytes, int, int]]:
+        """
+        バッファの内容を写し取ってクリーンにし、書き終わるまでピンしておく。
+        (バッファ, ブロック, 内容, 変更したtx, ページのLSN)のリストを返す。
+        self.lockを保持して呼ぶこと。
+        ピン中のバッファはTransactionがself.lockなしで書き換えるので、写し取ってから
+        クリーンにするまでの間の変更を失わないよう、汚れたままにする。
+        """
+        snapshots = []
+        for buff in buffs:
+            data = bytes(buff.contents.contents())
+            snapshots.append((buff, buff.blk, data, buff.txnum, buff.lsn))
+            if not buff.is_pinned():
+                buff.txnum = -1
+                self.num_available -= 1
+                self.replacer.set_evictable(buff.frame, False)
+            buff.pin()
+        return snapshots
+
+    def _write_snapshots(self, snapshots, lsn: int) -> None:
+        ok = False
+        try:
+            if snapshots:
+                self.lm.flush(lsn)  # WAL: ページより先にログを書く
+                for _, blk, data, _, _ in snapshots:
+                    self.fm.write(blk, Page(data))
+            ok = True
+        finally:
+            with self.lock:
+                for buff, _, _, txnum, _ in snapshots:
+                    if not ok and buff.txnum < 0:
+                        buff.txnum = txnum  # 書けなかったので汚れたままにする
+                    self._unpin(buff)
+
+    def unpin(self, buff: Buffer) -> None:
+        with self.lock:
+            self._unpin(buff)
 
+    def unpin_many(
+        self, buffs: Iterable[Buffer], counts: Iterable[int] | None = None
+    ) -> None:
+        """
+        複数のバッファをロックを1回だけ取ってunpinする。
+        countsがあればそれぞれをその回数だけunpinする
+        """
+        with self.lock:
+            if counts is None:
+                for buff in buffs:
+                    self._unpin(buff)
+            else:
+                for buff, n in zip(buffs, counts):
+                    self._unpin(buff, n)
+
+    def pin(self, blk: BlockId) -> Buffer:
+        deadline = time.monotonic() + self.MAX_TIME / 1000
+        with self.lock:
+            # 既にプールにあるブロックは空きフレームを消費しないので待たせない
+            buff, claimed = self._find_existing_buffer(blk), False
+            if buff is not None or not self.waiters:
+                buff, claimed = self._try_to_pin(blk)
+            if buff is None:
+                buff, claimed = self._wait_to_pin(blk, deadline)
+            prefetch = self._after_pin(blk, buff, claimed)
         if buff is None:
             raise BufferAbortException()
+        return self.finish_pin(blk, buff, claimed, prefetch)
+
+    def try_pin(self, blk: BlockId, waiter) -> tuple | None:
+        """
+        スレッドを止めずにpinするための1段目。フレームを確保できたら
+        (buff, claimed, prefetch)を返すので、finish_pinに渡して読み込みを済ませる。
+        確保できなければwaiterを待ち行列に入れてNoneを返す。waiterは
+        notify()を持つオブジェクトで、順番が来たらself.lockを持ったまま
+        任意のスレッドから呼ばれるので、そのあとでまたtry_pinする。
+        やめるときはcancel_pinを呼ぶ
+        """
+        with self.lock:
+            if waiter in self.waiters:
+                if self.waiters[0] is not waiter:
+                    return None
+                buff, claimed = self._try_to_pin(blk)
+                if buff is None:
+                    return None
+                self._leave_queue(waiter)
+            else:
+                buff, claimed = self._find_existing_buffer(blk), False
+                if buff is not None or not self.waiters:
+                    buff, claimed = self._try_to_pin(blk)
+                if buff is None:
+                    self.waiters.append(waiter)
+                    return None
+            return buff, claimed, self._after_pin(blk, buff, claimed)
+
+    def cancel_pin(self, waiter) -> None:
+        """try_pinで待ち行列に入れたwaiterを外し、pinを諦める"""
+        with self.lock:
+            if waiter in self.waiters:
+                self._leave_queue(waiter)
+        if metrics.enabled:
+            metrics.inc("buffer_pin_aborts")
+
+    def finish_pin(
+        self,
+        blk: BlockId,
+        buff: Buffer,
+        claimed: bool,
+        prefetch: list[BlockId] | None,
+    ) -> Buffer:
+        """確保したフレームにロックの外でブロックを読み込む"""
+        if claimed:
+            self._load([buff])
+
+        if prefetch:
+            if self.prefetcher is not None:
+                self.prefetcher.submit(self._prefetch, prefetch)
+            else:
+                self._prefetch(prefetch)
+
+        loading = buff.loading
+        if loading is not None:
+            # 他のスレッドが読み込み中のブロックに当たったら完了を待つ
+            loading.wait()
+            if buff.block() != blk:  # 先読みが失敗していた
+                self.unpin(buff)
+                return self.pin(blk)
 
         return buff
 
-    def _waiting_too_long(self, starttime: int) -> bool:
-        import time
+    def _after_pin(
+        self, blk: BlockId, buff: Buffer | None, claimed: bool
+    ) -> list[BlockId] | None:
+        """pinの結果を数え、先読みするブロックを返す。self.lockを保持して呼ぶこと"""
+        if metrics.enabled:
+            if buff is None:
+                metrics.inc("buffer_pin_aborts")
+            else:
+                metrics.inc("buffer_misses" if claimed else "buffer_hits")
+        # mmapのバックエンドはOSの先読みに任せる
+        if buff is not None and self.readahead > 0 and not self.fm.zero_copy:
+            return self._plan_readahead(blk)
+        return None
+
+    def _leave_queue(self, waiter) -> None:
+        """self.lockを保持して呼ぶこと。空きが残っていれば次の待ち手に順番を回す"""
+        self.waiters.remove(waiter)
+        if self.waiters and self.num_available > 0:
+            self.waiters[0].notify()
+
+    def _unpin(self, buff: Buffer, n: int = 1) -> None:
+        """self.lockを保持して呼ぶこと"""
+        buff.unpin(n)
+        if not buff.is_pinned():
+            self.num_available += 1
+            self.replacer.set_evictable(buff.frame, True)
+            # JavaのnotifyAll()に相当。先頭の待ち手だけを起こす
+            if self.waiters:
+                self.waiters[0].notify()
+
+    def _plan_readahead(self, blk: BlockId) -> list[BlockId] | None:
+        """
+        順次アクセスを検出したら先読みするブロックを返す。self.lockを保持して呼ぶこと。
+        先読み済みの残りがreadaheadの半分を切ったら次の窓を読む。
+        """
+        filename, blknum = blk.filename, blk.blknum
+        sequential = self.next_expected.get(filename) == blknum
+        self.next_expected[filename] = blknum + 1
+        if not sequential:
+            return None
+        upto = self.readahead_upto.get(filename, 0)
+        if upto - (blknum + 1) >= self.readahead // 2:
+            return None
+        start = max(blknum + 1, upto)
+        end = min(blknum + 1 + self.readahead, self.fm.length(filename))
+        if start >= end:
+            return None
+        self.readahead_upto[filename] = end
+        return [BlockId(filename, n) for n in range(start, end)]
+
+    def _prefetch(self, blks: list[BlockId]) -> None:
+        """
+        空いているフレームにブロックをまとめて読み込む。
+        読み込み中のフレームはピンしておき、ロックを持たずにread_manyする。
+        """
+        claimed: list[Buffer] = []
+        with self.lock:
+            if self.waiters:
+                return  # フレームを待っているpinを優先する
+            for blk in blks:
+                if blk in self.buffer_table:
+                    continue
+                buff = self._claim(blk)
+                if buff is None:
+                    break
+                buff.pins = 1
+                self.num_available -= 1
+                claimed.append(buff)
+        if claimed:
+            self._load(claimed, unpin=True)
+
+    def _claim(self, blk: BlockId) -> Buffer | None:
+        """
+        blkのためにフレームを1つ確保し、読み込み中にする。self.lockを保持して呼ぶこと。
+        前のブロックは書き戻しが終わるまでbuffer_tableに残しておき、
+        そこに当たったpinにもloadingを待たせる。
+        """
+        buff = self._choose_unpinned_buffer()
+        if buff is None:
+            return None
+        buff.replaced = buff.block()
+        if metrics.enabled and buff.replaced is not None:
+            metrics.inc("buffer_evictions")
+        buff.blk = blk
+        buff.loading = threading.Event()
+        self.buffer_table[blk] = buff
+        return buff
+
+    def _load(self, buffs: list[Buffer], unpin: bool = False) -> None:
+        """
+        _claimしたフレームをロックの外で書き戻し・読み込みする。
+        連続するブロックはread_manyでまとめて読む。
+        """
+        ok = False
+        try:
+            if self.ccache is not None:
+                self._load_through_cache(buffs)
+            elif self.fm.zero_copy or len(buffs) == 1:
+                for buff in buffs:
+                    buff.load()
+            else:
+                dirty = [b for b in buffs if b.txnum >= 0]
+                if dirty:
+                    self.lm.flush(max(b.lsn for b in dirty))
+                for buff in dirty:
+                    buff.write_replaced()
+                self.fm.read_many([b.blk for b in buffs], [b.contents for b in buffs])
+                for buff in buffs:
+                    buff.lsn = -1
+            ok = True
+        finally:
+            with self.lock:
+                for buff in buffs:
+                    self._finish_load(buff, ok)
+                    if unpin or not ok:
+                        self._unpin(buff)
+
+    def _load_through_cache(self, buffs: list[Buffer]) -> None:
+        """
+        前のブロックを書き戻してから圧縮キャッシュに入れ、読み込むブロックは
+        キャッシュにあればそこから展開する。なかったものだけディスクから読む。
+        キャッシュにはディスクと同じ内容しか入れないので、読み込んでから
+        変更していないページは圧縮し直さずにそのまま残す
+        """
+        dirty = [b for b in buffs if b.txnum >= 0]
+        if dirty:
+            self.lm.flush(max(b.lsn for b in dirty))
+        for buff in buffs:
+            buff.write_replaced()
+            if buff.replaced is not None and (
+                buff.changed or not self.ccache.touch(buff.replaced)
+            ):
+                self.ccache.put(buff.replaced, buff.contents.contents())
+            buff.lsn = -1
+            buff.changed = False
+        missing = [
+            b for b in buffs if not self.ccache.get(b.blk, b.contents.contents())
+        ]
+        if len(missing) == 1:
+            self.fm.read(missing[0].blk, missing[0].contents)
+        elif missing:
+            self.fm.read_many([b.blk for b in missing], [b.contents for b in missing])
+
+    def _finish_load(self, buff: Buffer, ok: bool) -> None:
+        """self.lockを保持して呼ぶこと"""
+        if not ok:
+            del self.buffer_table[buff.blk]
+            buff.blk = None
+        if buff.replaced is not None:
+            if buff.txnum >= 0 and buff.blk is None:
+                buff.blk = buff.replaced  # 書き戻せなかったので元のブロックに戻す
+            elif self.buffer_table.get(buff.replaced) is buff:
+                del self.buffer_table[buff.replaced]
+        buff.replaced = None
+        loading, buff.loading = buff.loading, None
+        loading.set()
 
-        return (time.time() * 1000) - starttime > self.MAX_TIME
+    def _wait_to_pin(self, blk: BlockId, deadline: float) -> tuple[Buffer | None, bool]:
+        """空きフレームを到着順(FIFO)で待つ。self.lockを保持して呼ぶこと"""
+        cond = threading.Condition(self.lock)
+        self.waiters.append(cond)
+        buff, claimed = None, False
+        start = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            while True:
+                if self.waiters[0] is cond:
+                    buff, claimed = self._try_to_pin(blk)
+                    if buff is not None:
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+        finally:
+            self._leave_queue(cond)
+            if metrics.enabled:
+                metrics.inc("buffer_pin_waits")
+                metrics.observe("buffer_pin_wait_seconds", time.perf_counter() - start)
+        return buff, claimed
 
-    def _try_to_pin(self, blk: BlockId) -> Buffer | None:
-        buff = self._find_existing_buffer(blk)
+    def _try_to_pin(self, blk: BlockId) -> tuple[Buffer | None, bool]:
+        """
+        self.lockを保持して呼ぶこと。プールになければフレームを確保するだけで
+        読み込みはしない。確保したかどうかを一緒に返すので、呼び出し側が
+        ロックを放してから_loadする。
+        """
+        buff, claimed = self._find_existing_buffer(blk), False
         if buff is None:
-            buff = self._choose_unpinned_buffer()
+            buff = self._claim(blk)
             if buff is None:
-                return None
-            buff.assign_to_block(blk)
+                return None, False
+            claimed = True
 
         if not buff.is_pinned():
             self.num_available -= 1
+            self.replacer.set_evictable(buff.frame, False)
+            buff.pin_lsn = self.lm.latest_lsn
 
         buff.pin()
-        return buff
+        self.replacer.record_access(buff.frame)
+        return buff, claimed
 
     def _find_existing_buffer(self, blk: BlockId) -> Buffer | None:
-        for buff in self.bufferpool:
-            b = buff.block()
-            if b is not None and b == blk:
-                return buff
-        return None
+        return self.buffer_table.get(blk)
 
     def _choose_unpinned_buffer(self) -> Buffer | None:
-        for buff in self.bufferpool:
-            if not buff.is_pinned():
-                return buff
-        return None
+        if self.free_frames:
+            return self.bufferpool[self.free_frames.pop()]
+        frame = self.replacer.victim()
+        if frame is None:
+            return None
+        return self.bufferpool[frame]
+
+
+class BackgroundWriter(threading.Thread):
+    """汚れたバッファを定期的に少しずつ書き出すスレッド"""
+
+    def __init__(self, bm: BufferMgr, interval: float = 0.2, max_pages: int = 32):
+        super().__init__(name="bgwriter", daemon=True)
+        self.bm = bm
+        self.interval = interval
+        self.max_pages = max_pages
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.bm.write_back(self.max_pages)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
 
 
 # BufferListクラス
 @dataclass
 class BufferList:
+    """
+    トランザクションがpinしているバッファ。同じブロックを何度pinしても
+    ブロックごとの回数で数えるので、unpinもunpin_allもpinの数に比例しない。
+    """
+
     bm: "BufferMgr"
     buffers: dict[BlockId, Buffer] = field(default_factory=dict)
-    pins: list[BlockId] = field(default_factory=list)
+    pins: Counter[BlockId] = field(default_factory=Counter)
 
     def get_buffer(self, blk: BlockId) -> Buffer:
         return self.buffers.get(blk)
 
     def pin(self, blk: BlockId) -> None:
-        buff = self.bm.pin(blk)
+        self.add(blk, self.bm.pin(blk))
+
+    def add(self, blk: BlockId, buff: Buffer) -> None:
+        """別の経路(BufferMgr.try_pinなど)でpinしたバッファを数える"""
         self.buffers[blk] = buff
-        self.pins.append(blk)
+        self.pins[blk] += 1
 
     def unpin(self, blk: BlockId) -> None:
         buff = self.buffers.get(blk)
         self.bm.unpin(buff)
-        self.pins.remove(blk)
-        if blk not in self.pins:
+        n = self.pins[blk] - 1
+        if n > 0:
+            self.pins[blk] = n
+        else:
+            del self.pins[blk]
             del self.buffers[blk]
 
     def unpin_all(self) -> None:
-        for blk in self.pins:
-            buff = self.buffers.get(blk)
-            self.bm.unpin(buff)
+        blks = list(self.pins)
+        self.bm.unpin_many(
+            [self.buffers[blk] for blk in blks], [self.pins[blk] for blk in blks]
+        )
         self.buffers.clear()
         self.pins.clear()
@@ -0,0 +1,53 @@
+"""
+ログレコード用のコンパクトな符号化。
+整数はLEB128の可変長(varint)、負になりうる値はzigzagしてからvarintにする。
+"""
+
+CHARSET = "ascii"
+
+
+def varint_size(n: int) -> int:
+    """put_varintで書いたときのバイト数"""
+    return max(1, (n.bit_length() + 6) // 7)
+
+
+def put_varint(buf: bytearray, n: int) -> None:
+    """非負整数を追加"""
+    while n >= 0x80:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def get_varint(buf, pos: int) -> tuple[int, int]:
+    """posから非負整数を読み、(値, 次の位置)を返す"""
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def put_svarint(buf: bytearray, n: int) -> None:
+    """符号付き整数を追加(0, -1, 1, -2, ... の順に小さく符号化される)"""
+    put_varint(buf, n << 1 if n >= 0 else ((-n) << 1) - 1)
+
+
+def get_svarint(buf, pos: int) -> tuple[int, int]:
+    z, pos = get_varint(buf, pos)
+    return (z >> 1) ^ -(z & 1), pos
+
+
+def put_str(buf: bytearray, s: str) -> None:
+    """長さ(varint)と本体を追加"""
+    b = s.encode(CHARSET)
+    put_varint(buf, len(b))
+    buf += b
+
+
+def get_str(buf, pos: int) -> tuple[str, int]:
+    n, pos = get_varint(buf, pos)
+    return bytes(buf[pos : pos + n]).decode(CHARSET), pos + n
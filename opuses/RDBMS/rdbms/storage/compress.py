@@ -0,0 +1,117 @@
+"""
+ブロックの圧縮。CompressedFileMgr(ファイルに圧縮して書く)とCompressedCache
+(BufferMgrから追い出したページを圧縮して持っておく)で使う。
+zlibは標準ライブラリ、lz4はオプション(pip install lz4)。
+"""
+
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import ClassVar, Hashable
+
+from rdbms.storage.metrics import metrics
+
+try:
+    import lz4.block as lz4_block
+except ImportError:  # lz4はオプション
+    lz4_block = None
+
+
+@dataclass(frozen=True)
+class Codec:
+    """nameは"zlib"か"lz4"。levelはzlibの圧縮レベル(1が最も速い)"""
+
+    name: str = "zlib"
+    level: int = 1
+
+    NAMES: ClassVar[tuple[str, ...]] = ("zlib", "lz4")
+
+    def __post_init__(self):
+        if self.name not in self.NAMES:
+            raise ValueError(f"unknown codec: {self.name}")
+        if self.name == "lz4" and lz4_block is None:
+            raise RuntimeError("lz4 is required for the lz4 codec")
+
+    def compress(self, data) -> bytes:
+        if self.name == "lz4":
+            return lz4_block.compress(data, store_size=False)
+        return zlib.compress(data, self.level)
+
+    def decompress_into(self, data: bytes, out: bytearray) -> None:
+        """outと同じ大きさに展開して書き込む"""
+        if self.name == "lz4":
+            out[:] = lz4_block.decompress(data, uncompressed_size=len(out))
+        else:
+            out[:] = zlib.decompress(data)
+
+
+@dataclass
+class CompressedCache:
+    """
+    ディスクと同じ内容(書き戻し済み)のページを圧縮して持つLRUキャッシュ。
+    capacityは圧縮後のバイト数の上限。持っているのはいつでも捨ててよい複製なので、
+    入らなければ古いものから捨てるだけで書き戻しはしない
+    """
+
+    capacity: int
+    codec: Codec = field(default_factory=Codec)
+    size: int = field(default=0, init=False)
+    entries: OrderedDict[Hashable, bytes] = field(
+        default_factory=OrderedDict, init=False
+    )
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def put(self, key: Hashable, data) -> None:
+        packed = self.codec.compress(data)
+        if len(packed) > self.capacity:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = packed
+            self.size += len(packed)
+            evicted = 0
+            while self.size > self.capacity:
+                _, victim = self.entries.popitem(last=False)
+                self.size -= len(victim)
+                evicted += 1
+        if evicted and metrics.enabled:
+            metrics.inc("ccache_evictions", evicted)
+
+    def get(self, key: Hashable, out: bytearray) -> bool:
+        """あればoutに展開してTrue。なければFalse"""
+        with self.lock:
+            packed = self.entries.get(key)
+            if packed is not None:
+                self.entries.move_to_end(key)
+        if metrics.enabled:
+            metrics.inc("ccache_hits" if packed is not None else "ccache_misses")
+        if packed is None:
+            return False
+        self.codec.decompress_into(packed, out)
+        return True
+
+    def touch(self, key: Hashable) -> bool:
+        """持っていれば最近使ったことにしてTrue(入れ直す代わりに使う)"""
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+    def discard(self, key: Hashable) -> None:
+        with self.lock:
+            packed = self.entries.pop(key, None)
+            if packed is not None:
+                self.size -= len(packed)
+
+    def discard_file(self, filename: str) -> None:
+        """ファイルのページをすべて捨てる(キーはBlockId)"""
+        with self.lock:
+            for key in [k for k in self.entries if k.filename == filename]:
+                self.size -= len(self.entries.pop(key))
+
+    def __len__(self) -> int:
+        return len(self.entries)
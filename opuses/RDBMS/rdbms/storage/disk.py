@@ -1,15 +1,109 @@
-import io
+import ctypes
+import errno
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
 from dataclasses import dataclass, field
+from datetime import date
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, ClassVar
+
+from rdbms.storage.compress import Codec
+from rdbms.storage.metrics import metrics
+
+try:
+    import numpy as np
+except ImportError:  # numpyはオプション
+    np = None
+
+_INT = struct.Struct(">i")
+_LONG = struct.Struct(">q")
+_DOUBLE = struct.Struct(">d")
+_BOOL = struct.Struct(">?")
+_MAP_ENTRY = struct.Struct(">QII")  # CompressedFileMgrのブロック対応表の1件
+
+
+@lru_cache(maxsize=256)
+def _array_struct(fmt: str, n: int) -> struct.Struct:
+    """同じ型がn個並んだ配列のStruct"""
+    return struct.Struct(f">{n}{fmt}")
+
+
+# ファイルサイズを変えずに領域だけ確保するfallocate(Linux)。なければNone
+FALLOC_FL_KEEP_SIZE = 1
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+except (OSError, AttributeError):
+    _fallocate = None
 
 
-@dataclass
 class BlockId:
-    """A reference to a specific block of a specific file."""
+    """
+    A reference to a specific block of a specific file.
+    辞書のキーとして頻繁に作られて比べられるので、__slots__で持ってハッシュを
+    作成時に計算しておく。ファイル名はinternし、最近作ったものはキャッシュして
+    同じブロックなら同じオブジェクトを返す(辞書の比較が同一性で済む)。
+    キャッシュは複数のスレッドから使うので、追加と追い出しはロックの中で行う。
+    """
 
+    __slots__ = ("filename", "blknum", "_hash")
     filename: str
     blknum: int
 
+    CACHE_SIZE: ClassVar[int] = 4096
+    _cache: ClassVar[dict[tuple[str, int], "BlockId"]] = {}
+    _cache_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __new__(cls, filename: str, blknum: int) -> "BlockId":
+        key = (filename, blknum)
+        blk = cls._cache.get(key)
+        if blk is not None:
+            return blk
+        blk = object.__new__(cls)
+        filename = sys.intern(filename)
+        object.__setattr__(blk, "filename", filename)
+        object.__setattr__(blk, "blknum", blknum)
+        object.__setattr__(blk, "_hash", hash(key))
+        with cls._cache_lock:
+            cache = cls._cache
+            other = cache.get(key)
+            if other is not None:  # 別のスレッドが先に作った
+                return other
+            if len(cache) >= cls.CACHE_SIZE:
+                # 古いものから捨てる
+                del cache[next(iter(cache))]
+            cache[key] = blk
+        return blk
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"BlockId is immutable: cannot set {name}")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"BlockId is immutable: cannot delete {name}")
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, BlockId):
+            return NotImplemented
+        return self.blknum == other.blknum and self.filename == other.filename
+
+    def __reduce__(self):
+        return BlockId, (self.filename, self.blknum)
+
+    def __repr__(self) -> str:
+        return f"BlockId(filename={self.filename!r}, blknum={self.blknum})"
+
     def __str__(self) -> str:
         return f"[file {self.filename}, block {self.blknum}]"
 
@@ -33,45 +127,103 @@ class Page:
     def __init__(self, blocksize_or_bytes=None):
         """
         Page can be initialized either with a blocksize (for data buffers)
-        or with a bytearray (for log pages)
+        or with a bytearray (for log pages).
+        memoryviewを渡すとコピーせずにその領域を直接参照する
         """
         if isinstance(blocksize_or_bytes, int):
             self.blocksize = blocksize_or_bytes
             self.bb = bytearray(self.blocksize)
+        elif isinstance(blocksize_or_bytes, memoryview):
+            self.blocksize = len(blocksize_or_bytes)
+            self.bb = blocksize_or_bytes
         elif isinstance(blocksize_or_bytes, (bytearray, bytes)):
             self.blocksize = len(blocksize_or_bytes)
             self.bb = bytearray(blocksize_or_bytes)
 
+    # 値はビッグエンディアン。struct.Structで中間のbytesを作らずに読み書きする
     def get_int(self, offset: int) -> int:
         """指定されたオフセットから整数を取得"""
-        return int.from_bytes(
-            self.bb[offset : offset + 4], byteorder="big", signed=True
-        )
+        return _INT.unpack_from(self.bb, offset)[0]
 
     def set_int(self, offset: int, n: int) -> None:
         """指定されたオフセットに整数を設定"""
-        self.bb[offset : offset + 4] = n.to_bytes(4, byteorder="big", signed=True)
+        _INT.pack_into(self.bb, offset, n)
+
+    def get_long(self, offset: int) -> int:
+        """64ビット整数を取得"""
+        return _LONG.unpack_from(self.bb, offset)[0]
+
+    def set_long(self, offset: int, n: int) -> None:
+        _LONG.pack_into(self.bb, offset, n)
+
+    def get_double(self, offset: int) -> float:
+        """倍精度浮動小数点数を取得"""
+        return _DOUBLE.unpack_from(self.bb, offset)[0]
+
+    def set_double(self, offset: int, x: float) -> None:
+        _DOUBLE.pack_into(self.bb, offset, x)
+
+    def get_bool(self, offset: int) -> bool:
+        """1バイトの真偽値を取得"""
+        return _BOOL.unpack_from(self.bb, offset)[0]
+
+    def set_bool(self, offset: int, b: bool) -> None:
+        _BOOL.pack_into(self.bb, offset, b)
+
+    def get_date(self, offset: int) -> date:
+        """日付を取得。グレゴリオ暦の序数(date.toordinal)を整数で持つ"""
+        return date.fromordinal(self.get_int(offset))
+
+    def set_date(self, offset: int, d: date) -> None:
+        self.set_int(offset, d.toordinal())
 
     def get_bytes(self, offset: int) -> bytes:
         """指定されたオフセットからバイト配列を取得"""
-        length = self.get_int(offset)
+        length = _INT.unpack_from(self.bb, offset)[0]
         return bytes(self.bb[offset + 4 : offset + 4 + length])
 
     def set_bytes(self, offset: int, b: bytes) -> None:
         """指定されたオフセットにバイト配列を設定"""
-        self.set_int(offset, len(b))
+        _INT.pack_into(self.bb, offset, len(b))
         self.bb[offset + 4 : offset + 4 + len(b)] = b
 
     def get_string(self, offset: int) -> str:
-        """指定されたオフセットから文字列を取得"""
-        b = self.get_bytes(offset)
-        return b.decode(self.CHARSET)
+        """指定されたオフセットから文字列を取得(コピーせずにデコードする)"""
+        length = _INT.unpack_from(self.bb, offset)[0]
+        return str(memoryview(self.bb)[offset + 4 : offset + 4 + length], self.CHARSET)
 
     def set_string(self, offset: int, s: str) -> None:
         """指定されたオフセットに文字列を設定"""
         b = s.encode(self.CHARSET)
         self.set_bytes(offset, b)
 
+    def get_array(self, offset: int, fmt: str, n: int) -> tuple:
+        """
+        structの型文字fmt("i", "q", "d", "?"など)の固定長フィールドが
+        n個並んだ配列を1回で読む
+        """
+        return _array_struct(fmt, n).unpack_from(self.bb, offset)
+
+    def set_array(self, offset: int, fmt: str, values) -> None:
+        """固定長フィールドの配列を1回で書く"""
+        _array_struct(fmt, len(values)).pack_into(self.bb, offset, *values)
+
+    def get_ints(self, offset: int, n: int) -> tuple[int, ...]:
+        return self.get_array(offset, "i", n)
+
+    def set_ints(self, offset: int, values) -> None:
+        self.set_array(offset, "i", values)
+
+    def ndarray(self, offset: int, dtype: str, n: int):
+        """
+        ページの領域をコピーせずに参照するNumPy配列(numpyが必要)。
+        dtypeはバイトオーダーを除いた型("i4", "i8", "f8"など)で、ビッグエンディアンで
+        解釈する。書き込み可能なページなら配列への書き込みはページに反映される。
+        """
+        if np is None:
+            raise RuntimeError("numpy is required for Page.ndarray")
+        return np.frombuffer(self.bb, dtype=">" + dtype, count=n, offset=offset)
+
     @staticmethod
     def max_length(strlen: int) -> int:
         """文字列の最大長（バイト数）を計算"""
@@ -84,19 +236,96 @@ class Page:
         return self.bb
 
 
+class MappedPage(Page):
+    """
+    mmapした領域をコピーせずに参照する読み取り専用のページ。
+    最初に書き込んだときに私的なコピーへ切り替えるので、変更がログより先に
+    ファイルへ反映されることはない(書き戻しはBuffer.flushでLogMgr.flushの後)。
+    """
+
+    def __init__(self, view: memoryview):
+        super().__init__(view)
+
+    def is_mapped(self) -> bool:
+        return isinstance(self.bb, memoryview)
+
+    def set_int(self, offset: int, n: int) -> None:
+        self._privatize()
+        super().set_int(offset, n)
+
+    def set_long(self, offset: int, n: int) -> None:
+        self._privatize()
+        super().set_long(offset, n)
+
+    def set_double(self, offset: int, x: float) -> None:
+        self._privatize()
+        super().set_double(offset, x)
+
+    def set_bool(self, offset: int, b: bool) -> None:
+        self._privatize()
+        super().set_bool(offset, b)
+
+    def set_bytes(self, offset: int, b: bytes) -> None:
+        self._privatize()
+        super().set_bytes(offset, b)
+
+    def set_array(self, offset: int, fmt: str, values) -> None:
+        self._privatize()
+        super().set_array(offset, fmt, values)
+
+    def _privatize(self) -> None:
+        if isinstance(self.bb, memoryview):
+            self.bb = bytearray(self.bb)
+
+
 @dataclass
 class FileMgr:
     """
     The file manager handles interactions with the files that
     comprise a database.
+    ファイルは生のfdで開き、pread/pwriteで位置を指定して読み書きするので
+    複数スレッドから同時に使える。ロックはファイルを開くときとファイル長の更新だけ。
+
+    durability:
+        none      -- OSのページキャッシュに書くだけで同期しない
+        fdatasync -- 書き込みのたびにfdatasyncする
+        deferred  -- 書き込んだファイルを覚えておき、sync()/sync_all()でまとめて同期する
+    direct_io: O_DIRECTで開き、アラインされたバッファ経由で読み書きする
+    prealloc_blocks: ファイルを伸ばすときにまとめて確保するブロック数(0なら無効)
+        ファイルサイズを変えずに確保するので、閉じずに終了してもファイル長は
+        書いたブロック数のまま。fallocateを使えない環境では確保しない
     """
 
     db_directory: str
     blocksize: int
+    durability: str = "deferred"
+    direct_io: bool = False
+    prealloc_blocks: int = 0
     is_new: bool = field(init=False)
-    open_files: dict[str, io.BufferedRandom] = field(default_factory=dict, init=False)
+    open_files: dict[str, int] = field(default_factory=dict, init=False)
+    lengths: dict[str, int] = field(default_factory=dict, init=False)
+    allocated: dict[str, int] = field(default_factory=dict, init=False)
+    dirty: set[str] = field(default_factory=set, init=False)
+    direct_files: set[str] = field(default_factory=set, init=False)
+    # remove/renameで中身が消えたり置き換わったりしたファイル名を受け取る
+    removal_hooks: list[Callable[[str], None]] = field(default_factory=list, init=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+    DURABILITY_MODES: ClassVar[tuple[str, ...]] = ("none", "fdatasync", "deferred")
+    DIRECT_IO_ALIGNMENT: ClassVar[int] = 512
+    zero_copy: ClassVar[bool] = False  # page()でコピーなしのページを返せるか
+    IOV_MAX: ClassVar[int] = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 16
 
     def __post_init__(self):
+        if self.durability not in self.DURABILITY_MODES:
+            raise ValueError(f"unknown durability mode: {self.durability}")
+        if self.direct_io and self.blocksize % self.DIRECT_IO_ALIGNMENT != 0:
+            raise ValueError(
+                f"direct I/O needs a multiple of {self.DIRECT_IO_ALIGNMENT}"
+                f" as block size: {self.blocksize}"
+            )
+        # O_DIRECT用のバウンスバッファはスレッドごとに持つ
+        self.local = threading.local()
+
         # ディレクトリパスを作成
         db_dir = Path(self.db_directory)
         self.is_new = not db_dir.exists()
@@ -111,50 +340,612 @@ class FileMgr:
 
     def read(self, blk: BlockId, p: Page) -> None:
         """ブロックの内容をページに読み込む"""
+        start = time.perf_counter() if metrics.enabled else 0.0
         try:
-            f = self._get_file(blk.filename)
-            f.seek(blk.blknum * self.blocksize)
-            f.readinto(p.contents())
+            fd = self._get_file(blk.filename)
+            offset = blk.blknum * self.blocksize
+            if blk.filename in self.direct_files:
+                buf = self._aligned_buf()
+                n = os.preadv(fd, [buf], offset)
+                p.contents()[:n] = buf[:n]
+            else:
+                # Pageのbytearrayへ直接読み込む
+                os.preadv(fd, [p.contents()], offset)
         except Exception as e:
             raise RuntimeError(f"cannot read block {blk}: {e}")
+        if metrics.enabled:
+            metrics.io("read", 1, self.blocksize, start)
+
+    def read_many(self, blocks: list[BlockId], pages: list[Page]) -> None:
+        """
+        複数のブロックをそれぞれ対応するページに読み込む。
+        同じファイルで隣り合うブロックは1回のpreadvにまとめる。
+        """
+        order = sorted(
+            range(len(blocks)), key=lambda i: (blocks[i].filename, blocks[i].blknum)
+        )
+        run: list[int] = []
+        for i in order:
+            if run:
+                last = blocks[run[-1]]
+                blk = blocks[i]
+                if (
+                    blk.filename != last.filename
+                    or blk.blknum != last.blknum + 1
+                    or len(run) >= self.IOV_MAX
+                ):
+                    self._read_run([blocks[j] for j in run], [pages[j] for j in run])
+                    run = []
+            run.append(i)
+        if run:
+            self._read_run([blocks[j] for j in run], [pages[j] for j in run])
 
     def write(self, blk: BlockId, p: Page) -> None:
         """ページの内容をブロックに書き込む"""
+        start = time.perf_counter() if metrics.enabled else 0.0
         try:
-            f = self._get_file(blk.filename)
-            f.seek(blk.blknum * self.blocksize)
-            f.write(p.contents())
-            f.flush()  # 即時ディスクに書き込む
+            fd = self._get_file(blk.filename)
+            self._write_block(fd, blk, p.contents())
+            if blk.blknum >= self.lengths[blk.filename]:
+                with self.lock:
+                    self._extend(blk.filename, blk.blknum + 1)
+            self._written(blk.filename, fd)
         except Exception as e:
             raise RuntimeError(f"cannot write block {blk}: {e}")
+        if metrics.enabled:
+            metrics.io("written", 1, self.blocksize, start)
 
     def append(self, filename: str) -> BlockId:
         """新しいブロックをファイルに追加"""
-        newblknum = self.length(filename)
-        blk = BlockId(filename, newblknum)
-        b = bytearray(self.blocksize)
+        fd = self._get_file(filename)
+        with self.lock:
+            # ブロック番号の払い出しはスレッド間で重ならないようにする
+            newblknum = self.lengths[filename]
+            blk = BlockId(filename, newblknum)
+            try:
+                if self.prealloc_blocks > 0 and newblknum >= self.allocated[filename]:
+                    self._preallocate(fd, filename)
+                # 確保済みの領域への書き込みはファイルサイズを伸ばすだけで済む
+                self._write_block(fd, blk, bytes(self.blocksize))
+                self._extend(filename, newblknum + 1)
+            except Exception as e:
+                raise RuntimeError(f"cannot append block {blk}: {e}")
+        self._written(filename, fd)
+        return blk
+
+    def sync(self, filename: str) -> None:
+        """ファイルの内容を安定したストレージまで書き出す"""
+        if filename not in self.dirty:
+            return
         try:
-            f = self._get_file(filename)
-            f.seek(blk.blknum * self.blocksize)
-            f.write(b)
-            f.flush()
+            # 同期中の書き込みが再びdirtyにできるよう、先に外しておく
+            self.dirty.discard(filename)
+            self._datasync(self._get_file(filename))
         except Exception as e:
-            raise RuntimeError(f"cannot append block {blk}: {e}")
-        return blk
+            self.dirty.add(filename)
+            raise RuntimeError(f"cannot sync {filename}: {e}")
+
+    def sync_all(self) -> None:
+        """deferredモードで溜まっている書き込みをすべて同期する"""
+        for filename in list(self.dirty):
+            self.sync(filename)
+
+    def close(self) -> None:
+        """同期してファイルを閉じる。プリアロケーションした余りは切り詰める"""
+        self.sync_all()
+        with self.lock:
+            for filename, fd in self.open_files.items():
+                if self.allocated[filename] > self.lengths[filename]:
+                    os.ftruncate(fd, self.lengths[filename] * self.blocksize)
+                os.close(fd)
+            self.open_files.clear()
+            self.lengths.clear()
+            self.allocated.clear()
+            self.direct_files.clear()
+
+    def remove(self, filename: str) -> None:
+        """ファイルを閉じて削除する"""
+        with self.lock:
+            self._forget(filename)
+        try:
+            (Path(self.db_directory) / filename).unlink(missing_ok=True)
+        except Exception as e:
+            raise RuntimeError(f"cannot remove {filename}: {e}")
+        for hook in self.removal_hooks:
+            hook(filename)
+
+    def rename(self, src: str, dst: str) -> None:
+        """ファイルを閉じて名前を変える。dstが既にあれば置き換える"""
+        with self.lock:
+            self._forget(src)
+            self._forget(dst)
+        db_dir = Path(self.db_directory)
+        try:
+            os.replace(db_dir / src, db_dir / dst)
+        except Exception as e:
+            raise RuntimeError(f"cannot rename {src} to {dst}: {e}")
+        for hook in self.removal_hooks:
+            hook(src)
+            hook(dst)
+
+    def list_files(self, prefix: str) -> list[str]:
+        """名前がprefixで始まるファイルの一覧"""
+        return sorted(p.name for p in Path(self.db_directory).glob(f"{prefix}*"))
+
+    def block_size(self) -> int:
+        return self.blocksize
 
     def length(self, filename: str) -> int:
         """ファイル内のブロック数を返す"""
         try:
-            f = self._get_file(filename)
-            return int(f.tell() / self.blocksize)
+            self._get_file(filename)
+            return self.lengths[filename]
         except Exception as e:
             raise RuntimeError(f"cannot access {filename}: {e}")
 
-    def _get_file(self, filename: str):
+    def _get_file(self, filename: str) -> int:
         """ファイルを取得またはオープン"""
-        if filename not in self.open_files:
+        fd = self.open_files.get(filename)
+        if fd is not None:
+            return fd
+        with self.lock:
+            if filename in self.open_files:
+                return self.open_files[filename]
             filepath = Path(self.db_directory) / filename
-            self.open_files[filename] = open(
-                filepath, "a+b"
-            )  # バイナリモードで追加と読み取り
-        return self.open_files[filename]
+            flags = os.O_RDWR | os.O_CREAT
+            fd = -1
+            if self.direct_io and hasattr(os, "O_DIRECT"):
+                try:
+                    fd = os.open(filepath, flags | os.O_DIRECT)
+                    self.direct_files.add(filename)
+                except OSError:
+                    pass  # tmpfsなどO_DIRECTを使えないファイルシステム
+            if fd < 0:
+                fd = os.open(filepath, flags)
+            nblocks = self._open_length(filename, fd)
+            self.lengths[filename] = nblocks
+            self.allocated[filename] = nblocks
+            self.open_files[filename] = fd
+            return fd
+
+    def _open_length(self, filename: str, fd: int) -> int:
+        """開いたファイルのブロック数。self.lockを保持して呼ぶこと"""
+        return os.fstat(fd).st_size // self.blocksize
+
+    def _read_run(self, blocks: list[BlockId], pages: list[Page]) -> None:
+        """連続するブロックを1回のシステムコールで読み込む"""
+        first = blocks[0]
+        if first.filename in self.direct_files:
+            for blk, p in zip(blocks, pages):
+                self.read(blk, p)
+            return
+        start = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            fd = self._get_file(first.filename)
+            os.preadv(fd, [p.contents() for p in pages], first.blknum * self.blocksize)
+        except Exception as e:
+            raise RuntimeError(f"cannot read blocks {first}..{blocks[-1]}: {e}")
+        if metrics.enabled:
+            metrics.io("read", len(blocks), len(blocks) * self.blocksize, start)
+
+    def _write_block(self, fd: int, blk: BlockId, data) -> None:
+        if blk.filename in self.direct_files:
+            buf = self._aligned_buf()
+            buf[:] = data
+            data = buf
+        os.pwrite(fd, data, blk.blknum * self.blocksize)
+
+    def _aligned_buf(self) -> mmap.mmap:
+        buf = getattr(self.local, "aligned_buf", None)
+        if buf is None:
+            # 匿名mmapはページ境界にアラインされる
+            buf = self.local.aligned_buf = mmap.mmap(-1, self.blocksize)
+        return buf
+
+    def _forget(self, filename: str) -> None:
+        """開いているファイルを同期せずに閉じる。self.lockを保持して呼ぶこと"""
+        fd = self.open_files.pop(filename, None)
+        if fd is None:
+            return
+        if self.allocated[filename] > self.lengths[filename]:
+            os.ftruncate(fd, self.lengths[filename] * self.blocksize)
+        os.close(fd)
+        self.lengths.pop(filename)
+        self.allocated.pop(filename)
+        self.dirty.discard(filename)
+        self.direct_files.discard(filename)
+
+    def _extend(self, filename: str, nblocks: int) -> None:
+        """ファイル長を伸ばす。self.lockを保持して呼ぶこと"""
+        if nblocks > self.lengths[filename]:
+            self.lengths[filename] = nblocks
+        if nblocks > self.allocated[filename]:
+            self.allocated[filename] = nblocks
+
+    def _preallocate(self, fd: int, filename: str) -> None:
+        """
+        prealloc_blocksぶんの領域を1回のシステムコールで確保する。
+        ファイルサイズ(=論理的なファイル長)は変えない。
+        """
+        if _fallocate is None:
+            return
+        start = self.allocated[filename] * self.blocksize
+        size = self.prealloc_blocks * self.blocksize
+        if _fallocate(fd, FALLOC_FL_KEEP_SIZE, start, size) != 0:
+            err = ctypes.get_errno()
+            if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+                return  # 対応していないファイルシステム
+            raise OSError(err, os.strerror(err))
+        self.allocated[filename] += self.prealloc_blocks
+
+    def _written(self, filename: str, fd: int) -> None:
+        if self.durability == "fdatasync":
+            self._datasync(fd)
+        elif self.durability == "deferred":
+            self.dirty.add(filename)
+
+    @staticmethod
+    def _datasync(fd: int) -> None:
+        if metrics.enabled:
+            metrics.inc("file_syncs")
+        if hasattr(os, "fdatasync"):
+            os.fdatasync(fd)
+        else:
+            os.fsync(fd)
+
+
+@dataclass
+class MMapFileMgr(FileMgr):
+    """
+    データファイルをmmapし、page()でマッピングを直接参照するページを返すFileMgr。
+    ファイルはchunk_blocksごとに読み取り専用でマップし、書き込みは通常どおりpwriteで
+    行う(Linuxではページキャッシュを共有するのでマッピングにもそのまま見える)。
+    ファイルが伸びたチャンクは次のアクセスでマップし直す。古いマッピングは
+    参照しているページがなくなった時点で解放される。
+    """
+
+    chunk_blocks: int = 1024
+    zero_copy: ClassVar[bool] = True
+
+    def __post_init__(self):
+        if self.direct_io:
+            raise ValueError("mmap backend does not support direct I/O")
+        super().__post_init__()
+        # チャンクの大きさはブロックサイズとmmapのオフセット境界の両方の倍数にする
+        unit = math.lcm(self.blocksize, mmap.ALLOCATIONGRANULARITY)
+        chunk_bytes = -(-self.chunk_blocks * self.blocksize // unit) * unit
+        self.blocks_per_chunk = chunk_bytes // self.blocksize
+        # ファイル名 -> チャンク番号 -> (マッピング, マップ済みのブロック数)
+        self.mappings: dict[str, dict[int, tuple[mmap.mmap, int]]] = {}
+
+    def page(self, blk: BlockId) -> Page:
+        """ブロックをコピーせずに参照するページを返す"""
+        if blk.blknum >= self.length(blk.filename):
+            return Page(self.blocksize)  # ファイルの外はゼロ埋めのページ
+        idx, pos = divmod(blk.blknum, self.blocks_per_chunk)
+        try:
+            m = self._mapping(blk.filename, idx, pos + 1)
+        except Exception as e:
+            raise RuntimeError(f"cannot map block {blk}: {e}")
+        offset = pos * self.blocksize
+        return MappedPage(memoryview(m)[offset : offset + self.blocksize])
+
+    def close(self) -> None:
+        with self.lock:
+            for chunks in self.mappings.values():
+                for m, _ in chunks.values():
+                    try:
+                        m.close()
+                    except BufferError:
+                        pass  # まだ参照しているページがあればGCに任せる
+            self.mappings.clear()
+        super().close()
+
+    def _forget(self, filename: str) -> None:
+        for m, _ in self.mappings.pop(filename, {}).values():
+            try:
+                m.close()
+            except BufferError:
+                pass
+        super()._forget(filename)
+
+    def _mapping(self, filename: str, idx: int, nblocks: int) -> mmap.mmap:
+        """チャンクidxの先頭nblocksブロックを含むマッピングを返す"""
+        chunk = self.mappings.get(filename, {}).get(idx)
+        if chunk is not None and chunk[1] >= nblocks:
+            return chunk[0]
+        fd = self._get_file(filename)
+        with self.lock:
+            chunk = self.mappings.setdefault(filename, {}).get(idx)
+            if chunk is not None and chunk[1] >= nblocks:
+                return chunk[0]
+            # ファイルの実サイズを超えてはマップできないので、今ある分だけマップする
+            start = idx * self.blocks_per_chunk
+            available = os.fstat(fd).st_size // self.blocksize - start
+            mapped = min(self.blocks_per_chunk, available)
+            m = mmap.mmap(
+                fd,
+                mapped * self.blocksize,
+                access=mmap.ACCESS_READ,
+                offset=start * self.blocksize,
+            )
+            self.mappings[filename][idx] = (m, mapped)
+            return m
+
+
+@dataclass
+class CompressedFileMgr(FileMgr):
+    """
+    ブロックを圧縮して書くFileMgr。ブロックごとの置き場所は対応表で引くので、
+    圧縮後の大きさがばらばらでもブロック番号で直接読み書きできる。
+
+    対応表はデータディレクトリの.cmap/<ファイル名>に置き、ブロックnの
+    [ファイル内の位置][格納した長さ][確保した長さ]をn*16バイト目に持つ。
+        格納した長さが0     一度も書いていないブロック(ゼロ埋め)
+        blocksizeと同じ     縮まなかったので圧縮せずに格納した
+    置き場所はslot_sizeの倍数で確保する。大きくなったら前の2倍を確保する
+    (少しずつ埋まっていくログのページが何度も確保し直さないように)。
+
+    書き込みは対応表が指している領域を上書きせず、いつも別の領域に書く。
+    対応表は中身を同期してから書き換えるので(deferredならsync()のとき)、
+    途中で落ちてもディスク上の対応表は前の版か新しい版のどちらかを正しく指す。
+    前の版の領域は、ディスク上の対応表がそれを指さなくなってから再利用する。
+    """
+
+    codec: Codec = field(default_factory=Codec)
+    slot_size: int = 512
+    MAP_DIR: ClassVar[str] = ".cmap"
+    ZERO_ENTRY: ClassVar[tuple[int, int, int]] = (0, 0, 0)
+
+    def __post_init__(self):
+        if self.direct_io:
+            raise ValueError("compressed files do not support direct I/O")
+        if self.prealloc_blocks:
+            raise ValueError("compressed files do not support preallocation")
+        super().__post_init__()
+        self.map_dir = Path(self.db_directory) / self.MAP_DIR
+        self.map_dir.mkdir(exist_ok=True)
+        for filename in self.map_dir.glob("temp*"):
+            filename.unlink()  # 消された一時テーブルの対応表
+        self.max_cap = -(-self.blocksize // self.slot_size) * self.slot_size
+        self.maps: dict[str, list[tuple[int, int, int]]] = {}
+        self.map_fds: dict[str, int] = {}
+        self.ends: dict[str, int] = {}  # ファイル名 -> 確保済みの末尾
+        # ファイル名 -> 確保した長さ -> 空いている領域の位置
+        self.free: dict[str, dict[int, list[int]]] = {}
+        # ディスク上の対応表にまだ書いていないブロックと、書いたら空く領域
+        self.unsaved: dict[str, set[int]] = {}
+        self.releasing: dict[str, list[tuple[int, int]]] = {}
+        self.frees = 0  # 領域を空けた回数(読み込み中に再利用されなかったかの確認用)
+        self.save_lock = threading.Lock()  # 対応表の保存を1つずつ行う
+
+    def read(self, blk: BlockId, p: Page) -> None:
+        start = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            fd = self._get_file(blk.filename)
+            entries = self.maps[blk.filename]
+            while True:
+                frees = self.frees
+                entry = entries[blk.blknum] if blk.blknum < len(entries) else None
+                offset, stored, _ = entry or self.ZERO_ENTRY
+                data = os.pread(fd, stored, offset) if stored else b""
+                # 読んでいる間に前の版の領域が空いて書き直されたら読み直す
+                if self.frees == frees:
+                    break
+            out = p.contents()
+            if stored == 0:
+                out[:] = bytes(self.blocksize)
+            elif stored == self.blocksize:
+                out[:] = data
+            else:
+                self.codec.decompress_into(data, out)
+        except Exception as e:
+            raise RuntimeError(f"cannot read block {blk}: {e}")
+        if metrics.enabled:
+            metrics.io("read", 1, stored, start)
+
+    def write(self, blk: BlockId, p: Page) -> None:
+        start = time.perf_counter() if metrics.enabled else 0.0
+        try:
+            fd = self._get_file(blk.filename)
+            data = self.codec.compress(p.contents())
+            if len(data) >= self.blocksize:
+                data = bytes(p.contents())
+            with self.lock:
+                offset, cap = self._allocate(blk, len(data))
+            # 新しい領域に中身を書いてから対応表を切り替える
+            os.pwrite(fd, data, offset)
+            with self.lock:
+                self._switch(blk, (offset, len(data), cap))
+            if self.durability != "deferred":
+                self._save_map(blk.filename)
+        except Exception as e:
+            raise RuntimeError(f"cannot write block {blk}: {e}")
+        if metrics.enabled:
+            metrics.io("written", 1, len(data), start)
+
+    def append(self, filename: str) -> BlockId:
+        """新しいブロックを追加する。ゼロのブロックは対応表に載せるだけで書かない"""
+        self._get_file(filename)
+        with self.lock:
+            blk = BlockId(filename, self.lengths[filename])
+            self.maps[filename].append(self.ZERO_ENTRY)
+            self._extend(filename, blk.blknum + 1)
+            try:
+                # どの領域も指さないので、中身より先にディスクに届いても困らない
+                self._write_entry(filename, blk.blknum, self.ZERO_ENTRY)
+            except Exception as e:
+                raise RuntimeError(f"cannot append block {blk}: {e}")
+        self._written(filename, self.map_fds[filename])
+        return blk
+
+    def sync(self, filename: str) -> None:
+        if filename not in self.dirty:
+            return
+        try:
+            self.dirty.discard(filename)
+            self._save_map(filename)
+        except Exception as e:
+            self.dirty.add(filename)
+            raise RuntimeError(f"cannot sync {filename}: {e}")
+
+    def close(self) -> None:
+        super().close()
+        with self.lock:
+            for fd in self.map_fds.values():
+                os.close(fd)
+            self.map_fds.clear()
+            self.maps.clear()
+            self.ends.clear()
+            self.free.clear()
+            self.unsaved.clear()
+            self.releasing.clear()
+
+    def remove(self, filename: str) -> None:
+        super().remove(filename)
+        (self.map_dir / filename).unlink(missing_ok=True)
+
+    def rename(self, src: str, dst: str) -> None:
+        self.sync(src)  # まだ書いていない対応表を名前を変える前に書く
+        super().rename(src, dst)
+        try:
+            if (self.map_dir / src).exists():
+                os.replace(self.map_dir / src, self.map_dir / dst)
+            else:
+                (self.map_dir / dst).unlink(missing_ok=True)
+        except Exception as e:
+            raise RuntimeError(f"cannot rename {src} to {dst}: {e}")
+
+    def stored_bytes(self, filename: str) -> int:
+        """ファイルが実際に使っているバイト数(対応表を除く)"""
+        self._get_file(filename)
+        return self.ends[filename]
+
+    def free_bytes(self, filename: str) -> int:
+        """ファイルの中で空いている(再利用を待っている)バイト数"""
+        self._get_file(filename)
+        with self.lock:
+            free = sum(
+                cap * len(offsets) for cap, offsets in self.free[filename].items()
+            )
+            return free + sum(cap for _, cap in self.releasing[filename])
+
+    def _open_length(self, filename: str, fd: int) -> int:
+        map_fd = os.open(self.map_dir / filename, os.O_RDWR | os.O_CREAT)
+        raw = os.pread(map_fd, os.fstat(map_fd).st_size, 0)
+        entries = list(_MAP_ENTRY.iter_unpack(raw[: len(raw) // 16 * 16]))
+        self.map_fds[filename] = map_fd
+        self.maps[filename] = entries
+        self.free[filename] = {}
+        self.unsaved[filename] = set()
+        self.releasing[filename] = []
+        # 対応表から指されていない隙間は、書き換えの途中で落ちた残りなので空ける
+        end = 0
+        for offset, _, cap in sorted(e for e in entries if e[2]):
+            while end < offset:
+                size = min(offset - end, self.max_cap)
+                self.free[filename].setdefault(size, []).append(end)
+                end += size
+            end = max(end, offset + cap)
+        self.ends[filename] = end
+        return len(entries)
+
+    def _forget(self, filename: str) -> None:
+        map_fd = self.map_fds.pop(filename, None)
+        if map_fd is not None:
+            os.close(map_fd)
+        for table in (self.maps, self.ends, self.free, self.unsaved, self.releasing):
+            table.pop(filename, None)
+        super()._forget(filename)
+
+    def _read_run(self, blocks: list[BlockId], pages: list[Page]) -> None:
+        # 圧縮したブロックはファイル上で連続していないので1つずつ読む
+        for blk, p in zip(blocks, pages):
+            self.read(blk, p)
+
+    def _allocate(self, blk: BlockId, stored: int) -> tuple[int, int]:
+        """
+        storedバイトを書く領域(位置, 確保した長さ)を決める。今の版の領域は使わない。
+        self.lockを保持して呼ぶこと
+        """
+        filename = blk.filename
+        entries = self.maps[filename]
+        if blk.blknum >= len(entries):
+            entries.extend([self.ZERO_ENTRY] * (blk.blknum + 1 - len(entries)))
+            self._extend(filename, blk.blknum + 1)
+        cap = entries[blk.blknum][2]
+        if stored > cap:
+            need = -(-max(stored, 2 * cap) // self.slot_size) * self.slot_size
+            cap = min(need, self.max_cap)
+        free = self.free[filename]
+        for size in sorted(s for s, offsets in free.items() if s >= cap and offsets):
+            offset = free[size].pop()
+            if size > cap:  # 大きい領域を分けて残りを空きに戻す
+                free.setdefault(size - cap, []).append(offset + cap)
+            return offset, cap
+        offset = self.ends[filename]
+        self.ends[filename] += cap
+        return offset, cap
+
+    def _switch(self, blk: BlockId, entry: tuple[int, int, int]) -> None:
+        """
+        対応表(メモリ上)をentryに切り替える。前の版の領域は、ディスク上の対応表が
+        まだそれを指しているなら保存したときに、指していなければすぐ空ける。
+        self.lockを保持して呼ぶこと
+        """
+        filename = blk.filename
+        entries = self.maps[filename]
+        offset, _, cap = entries[blk.blknum]
+        entries[blk.blknum] = entry
+        unsaved = self.unsaved[filename]
+        if cap:
+            if blk.blknum in unsaved:
+                self._free(filename, offset, cap)
+            else:
+                self.releasing[filename].append((offset, cap))
+        unsaved.add(blk.blknum)
+        if self.durability == "deferred":
+            self.dirty.add(filename)
+
+    def _save_map(self, filename: str) -> None:
+        """
+        中身を同期してから、書き換えたブロックの対応表をディスクに書いて同期し、
+        前の版の領域を空ける
+        """
+        with self.save_lock:
+            with self.lock:
+                if filename not in self.maps:
+                    return
+                blknums = sorted(self.unsaved[filename])
+                entries = [self.maps[filename][n] for n in blknums]
+                released = self.releasing[filename]
+                self.unsaved[filename] = set()
+                self.releasing[filename] = []
+                fd, map_fd = self.open_files[filename], self.map_fds[filename]
+            try:
+                if self.durability != "none":
+                    self._datasync(fd)
+                for blknum, entry in zip(blknums, entries):
+                    self._write_entry(filename, blknum, entry)
+                if self.durability != "none":
+                    self._datasync(map_fd)
+            except Exception:
+                with self.lock:
+                    if filename in self.maps:
+                        self.unsaved[filename].update(blknums)
+                        self.releasing[filename] += released
+                raise
+            with self.lock:
+                if filename in self.maps:
+                    for offset, cap in released:
+                        self._free(filename, offset, cap)
+
+    def _free(self, filename: str, offset: int, cap: int) -> None:
+        """self.lockを保持して呼ぶこと"""
+        self.free[filename].setdefault(cap, []).append(offset)
+        self.frees += 1
+
+    def _write_entry(
+        self, filename: str, blknum: int, entry: tuple[int, int, int]
+    ) -> None:
+        os.pwrite(self.map_fds[filename], _MAP_ENTRY.pack(*entry), blknum * 16)
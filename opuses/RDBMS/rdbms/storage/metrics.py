@@ -0,0 +1,161 @@
+"""
+ストレージエンジンの計測値。カウンタとヒストグラムをモジュールのmetricsに集める。
+
+既定では無効で、呼び出し側は `if metrics.enabled:` を確かめてから記録するので
+無効なら属性を1つ読むだけで済む(時刻も取らない)。
+
+    metrics.enable()
+    ...
+    metrics.snapshot()       # dictで取り出す
+    metrics.to_prometheus()  # Prometheusのテキスト形式
+"""
+
+import bisect
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import ClassVar
+
+# 秒単位のレイテンシのバケット(上限)
+LATENCY_BUCKETS = (
+    1e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0,
+)  # fmt: skip
+# バイト数のバケット
+SIZE_BUCKETS = tuple(float(1 << n) for n in range(8, 25, 2))
+
+
+@dataclass
+class Histogram:
+    """上限ごとの度数と合計。Prometheusと同じく上限以下を数える"""
+
+    bounds: tuple[float, ...]
+    counts: list[int] = field(default_factory=list)
+    total: float = 0.0
+    count: int = 0
+
+    def __post_init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)  # 最後は+Inf
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        cumulative, buckets = 0, []
+        for bound, n in zip((*self.bounds, float("inf")), self.counts):
+            cumulative += n
+            buckets.append((bound, cumulative))
+        return {"count": self.count, "sum": self.total, "buckets": buckets}
+
+
+@dataclass
+class Metrics:
+    enabled: bool = False
+    counters: dict[str, int] = field(default_factory=dict)
+    histograms: dict[str, Histogram] = field(default_factory=dict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    # 記録するものの一覧(snapshotで0のものも出す)
+    COUNTERS: ClassVar[dict[str, str]] = {
+        "file_blocks_read": "blocks read from data and log files",
+        "file_blocks_written": "blocks written to data and log files",
+        "file_bytes_read": "bytes read from data and log files",
+        "file_bytes_written": "bytes written to data and log files",
+        "file_syncs": "fdatasync calls",
+        "buffer_hits": "pins served from the buffer pool",
+        "buffer_misses": "pins that had to load a block",
+        "buffer_evictions": "frames reused for another block",
+        "buffer_pin_waits": "pins that waited for a free frame",
+        "buffer_pin_aborts": "pins that gave up waiting",
+        "ccache_hits": "evicted pages reloaded from the compressed cache",
+        "ccache_misses": "loads that were not in the compressed cache",
+        "ccache_evictions": "pages dropped from the compressed cache",
+        "log_appends": "log records appended",
+        "log_append_bytes": "bytes of log records appended",
+        "log_flushes": "log flushes that wrote a block",
+        "lock_waits": "lock requests that had to wait",
+        "lock_timeouts": "lock waits that timed out",
+        "lock_deadlocks": "transactions aborted to avoid or break a deadlock",
+        "tx_committed": "transactions committed by the executor",
+        "tx_retried": "executor transactions retried after an abort",
+        "tx_failed": "executor transactions that raised or ran out of retries",
+    }
+    HISTOGRAMS: ClassVar[dict[str, tuple[tuple[float, ...], str]]] = {
+        "file_read_seconds": (LATENCY_BUCKETS, "latency of a block read call"),
+        "file_write_seconds": (LATENCY_BUCKETS, "latency of a block write call"),
+        "buffer_pin_wait_seconds": (LATENCY_BUCKETS, "time waiting for a frame"),
+        "log_flush_bytes": (SIZE_BUCKETS, "log bytes written per flush"),
+        "lock_wait_seconds": (LATENCY_BUCKETS, "time waiting for a lock"),
+    }
+
+    def __post_init__(self):
+        self.reset()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.histograms = {
+                name: Histogram(bounds) for name, (bounds, _) in self.HISTOGRAMS.items()
+            }
+
+    def inc(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name: str, value: float) -> None:
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    def io(self, kind: str, nblocks: int, nbytes: int, start: float) -> None:
+        """ファイルの読み書き1回分。kindは"read"か"written"で、startはperf_counter"""
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.counters[f"file_blocks_{kind}"] += nblocks
+            self.counters[f"file_bytes_{kind}"] += nbytes
+            op = "read" if kind == "read" else "write"
+            self.histograms[f"file_{op}_seconds"].observe(elapsed)
+
+    def snapshot(self) -> dict:
+        """今の値のコピー。buffer_hit_ratioはpinのうちプールにあった割合"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {n: h.snapshot() for n, h in self.histograms.items()}
+        pins = counters["buffer_hits"] + counters["buffer_misses"]
+        return {
+            "counters": counters,
+            "histograms": histograms,
+            "buffer_hit_ratio": counters["buffer_hits"] / pins if pins else None,
+        }
+
+    def to_prometheus(self, prefix: str = "rdbms_") -> str:
+        """Prometheusのテキスト形式(exposition format)にする"""
+        snap = self.snapshot()
+        lines = []
+        for name, value in snap["counters"].items():
+            metric = f"{prefix}{name}_total"
+            lines.append(f"# HELP {metric} {self.COUNTERS[name]}")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, h in snap["histograms"].items():
+            metric = prefix + name
+            lines.append(f"# HELP {metric} {self.HISTOGRAMS[name][1]}")
+            lines.append(f"# TYPE {metric} histogram")
+            for bound, n in h["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{metric}_bucket{{le="{le}"}} {n}')
+            lines.append(f"{metric}_sum {h['sum']!r}")
+            lines.append(f"{metric}_count {h['count']}")
+        if snap["buffer_hit_ratio"] is not None:
+            lines.append(f"# TYPE {prefix}buffer_hit_ratio gauge")
+            lines.append(f"{prefix}buffer_hit_ratio {snap['buffer_hit_ratio']!r}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
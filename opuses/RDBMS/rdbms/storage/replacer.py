@@ -0,0 +1,156 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class Replacer(ABC):
+    """
+    Buffer replacement policy.
+    バッファプール内のフレームをフレーム番号で管理し、追い出す候補を選ぶ。
+    """
+
+    def __init__(self, numframes: int):
+        self.numframes = numframes
+
+    @abstractmethod
+    def record_access(self, frame: int) -> None:
+        """フレームがピンされたことを記録"""
+
+    @abstractmethod
+    def set_evictable(self, frame: int, evictable: bool) -> None:
+        """フレームを追い出し候補に加える(またはそこから外す)"""
+
+    @abstractmethod
+    def victim(self) -> int | None:
+        """追い出すフレームを選んで候補から外す。候補がなければNone"""
+
+    @abstractmethod
+    def size(self) -> int:
+        """追い出し候補のフレーム数"""
+
+
+class LRUReplacer(Replacer):
+    """最後にアンピンされてから最も時間が経ったフレームを追い出す"""
+
+    def __init__(self, numframes: int):
+        super().__init__(numframes)
+        self.candidates: OrderedDict[int, None] = OrderedDict()
+
+    def record_access(self, frame: int) -> None:
+        pass  # ピン中のフレームは候補に入っていないので何もしない
+
+    def set_evictable(self, frame: int, evictable: bool) -> None:
+        if evictable:
+            self.candidates[frame] = None
+            self.candidates.move_to_end(frame)
+        else:
+            self.candidates.pop(frame, None)
+
+    def victim(self) -> int | None:
+        if not self.candidates:
+            return None
+        frame, _ = self.candidates.popitem(last=False)
+        return frame
+
+    def size(self) -> int:
+        return len(self.candidates)
+
+
+class ClockReplacer(Replacer):
+    """参照ビットを使ったLRUの近似(second chance)"""
+
+    def __init__(self, numframes: int):
+        super().__init__(numframes)
+        self.refbits = [False] * numframes
+        self.evictable = [False] * numframes
+        self.num_evictable = 0
+        self.hand = 0
+
+    def record_access(self, frame: int) -> None:
+        self.refbits[frame] = True
+
+    def set_evictable(self, frame: int, evictable: bool) -> None:
+        if self.evictable[frame] != evictable:
+            self.evictable[frame] = evictable
+            self.num_evictable += 1 if evictable else -1
+
+    def victim(self) -> int | None:
+        if self.num_evictable == 0:
+            return None
+        # 参照ビットを落としながら最大2周すれば必ず見つかる
+        while True:
+            frame = self.hand
+            self.hand = (self.hand + 1) % self.numframes
+            if not self.evictable[frame]:
+                continue
+            if self.refbits[frame]:
+                self.refbits[frame] = False
+                continue
+            self.evictable[frame] = False
+            self.num_evictable -= 1
+            return frame
+
+    def size(self) -> int:
+        return self.num_evictable
+
+
+class LRUKReplacer(Replacer):
+    """
+    LRU-K (K=2がデフォルト) を2Qと同じ2本のキューで近似する。
+    アクセス回数がK未満のフレームは履歴キューに、K回以上のフレームは
+    キャッシュキューに置き、追い出しは履歴キューを優先する。
+    一度だけ読まれるスキャンのページがホットなページを押し出さない。
+    キューには追い出し候補のフレームだけを、候補になった順に入れるので
+    victim()はO(1)。
+    """
+
+    def __init__(self, numframes: int, k: int = 2):
+        super().__init__(numframes)
+        self.k = k
+        self.counts = [0] * numframes
+        self.history: OrderedDict[int, None] = OrderedDict()
+        self.cache: OrderedDict[int, None] = OrderedDict()
+
+    def record_access(self, frame: int) -> None:
+        self.counts[frame] += 1
+        if frame in self.history and self.counts[frame] >= self.k:
+            del self.history[frame]
+            self.cache[frame] = None
+        elif frame in self.cache:
+            self.cache.move_to_end(frame)
+
+    def set_evictable(self, frame: int, evictable: bool) -> None:
+        if not evictable:
+            self.history.pop(frame, None)
+            self.cache.pop(frame, None)
+        elif frame not in self.history and frame not in self.cache:
+            # 先読みされただけでアクセスのないフレームは履歴キューに入る
+            queue = self.cache if self.counts[frame] >= self.k else self.history
+            queue[frame] = None
+
+    def victim(self) -> int | None:
+        for queue in (self.history, self.cache):
+            if queue:
+                frame, _ = queue.popitem(last=False)
+                self.counts[frame] = 0
+                return frame
+        return None
+
+    def size(self) -> int:
+        return len(self.history) + len(self.cache)
+
+
+REPLACERS: dict[str, type[Replacer]] = {
+    "lru": LRUReplacer,
+    "clock": ClockReplacer,
+    "lru-k": LRUKReplacer,
+    "2q": LRUKReplacer,
+}
+
+
+def make_replacer(policy: str, numframes: int) -> Replacer:
+    """ポリシー名からReplacerを作る"""
+    try:
+        cls = REPLACERS[policy]
+    except KeyError:
+        raise ValueError(f"unknown replacement policy: {policy}")
+    return cls(numframes)
@@ -1,13 +1,34 @@
+import logging
+import threading
+import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
-from typing import ClassVar
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, ClassVar, Sequence
 
-from rdbms.storage.buffer import Buffer, BufferMgr, FileMgr, LogMgr
+from rdbms.storage.buffer import Buffer, BufferList, BufferMgr, FileMgr, LogMgr
+from rdbms.storage.codec import (
+    get_str,
+    get_svarint,
+    get_varint,
+    put_str,
+    put_svarint,
+    put_varint,
+)
 from rdbms.storage.disk import BlockId, Page
+from rdbms.storage.metrics import metrics
+
+logger = logging.getLogger(__name__)
 
 
 # LogRecord関連クラス
 class LogRecord(ABC):
+    """
+    ログレコードはencode(intern)で[op(1バイト)][varintのフィールド...]に符号化する。
+    internはファイル名をログブロックの辞書の番号に変換する(LogMgr.append参照)。
+    """
+
     # 定数
     CHECKPOINT = 0
     START = 1
@@ -28,24 +49,204 @@ class LogRecord(ABC):
     def undo(self, tx) -> None:
         pass
 
+    @abstractmethod
+    def encode(self, intern: Callable[[str], int]) -> bytes:
+        pass
+
+    def redo(self, buff: Buffer) -> None:
+        """更新レコードだけがバッファに変更後の値を書き直す"""
+        pass
+
+    @staticmethod
+    def create_log_record(bytes_data: bytes, names: Sequence[str] = ()) -> "LogRecord":
+        """namesはレコードが書かれていたログブロックのファイル名辞書"""
+        op = bytes_data[0]
+        if op == LogRecord.CHECKPOINT:
+            return CheckpointRecord.decode(bytes_data)
+        elif op == LogRecord.START:
+            return StartRecord.decode(bytes_data)
+        elif op == LogRecord.COMMIT:
+            return CommitRecord.decode(bytes_data)
+        elif op == LogRecord.ROLLBACK:
+            return RollbackRecord.decode(bytes_data)
+        elif op == LogRecord.SETINT:
+            return SetIntRecord.decode(bytes_data, names)
+        elif op == LogRecord.SETSTRING:
+            return SetStringRecord.decode(bytes_data, names)
+        raise ValueError(f"unknown log record type: {op}")
+
+
+@dataclass
+class CheckpointRecord(LogRecord):
+    """
+    チェックポイント。これより前に書かれたページはすべてディスクにあるので、
+    redoはredo_lsnより後のレコードだけ、undoはactive_txsに挙がっている
+    トランザクションだけをさかのぼればよい。
+    """
+
+    redo_lsn: int = 0
+    active_txs: list[int] = field(default_factory=list)
+
+    @classmethod
+    def decode(cls, data: bytes) -> "CheckpointRecord":
+        redo_lsn, pos = get_svarint(data, 1)
+        n, pos = get_varint(data, pos)
+        active_txs = []
+        for _ in range(n):
+            txnum, pos = get_varint(data, pos)
+            active_txs.append(txnum)
+        return cls(redo_lsn, active_txs)
+
+    def op(self) -> int:
+        return LogRecord.CHECKPOINT
+
+    def tx_number(self) -> int:
+        return -1  # ダミー
+
+    def undo(self, tx) -> None:
+        pass
+
+    def encode(self, intern: Callable[[str], int]) -> bytes:
+        buf = bytearray((LogRecord.CHECKPOINT,))
+        put_svarint(buf, self.redo_lsn)
+        put_varint(buf, len(self.active_txs))
+        for txnum in self.active_txs:
+            put_varint(buf, txnum)
+        return buf
+
+    def __str__(self) -> str:
+        return f"<CHECKPOINT {self.redo_lsn} {self.active_txs}>"
+
     @staticmethod
-    def create_log_record(bytes_data: bytes) -> "LogRecord":
-        # 実装略
-        return None
+    def write_to_log(lm, redo_lsn: int, active_txs: list[int]) -> int:
+        return lm.append(CheckpointRecord(redo_lsn, list(active_txs)))
+
+
+@dataclass
+class TxRecord(LogRecord):
+    """トランザクション番号だけを持つレコード(START/COMMIT/ROLLBACK)"""
+
+    txnum: int = 0
+    OP: ClassVar[int]
+    NAME: ClassVar[str]
+
+    @classmethod
+    def decode(cls, data: bytes) -> "TxRecord":
+        txnum, _ = get_varint(data, 1)
+        return cls(txnum)
+
+    def op(self) -> int:
+        return self.OP
+
+    def tx_number(self) -> int:
+        return self.txnum
+
+    def undo(self, tx) -> None:
+        pass
+
+    def encode(self, intern: Callable[[str], int]) -> bytes:
+        buf = bytearray((self.OP,))
+        put_varint(buf, self.txnum)
+        return buf
+
+    def __str__(self) -> str:
+        return f"<{self.NAME} {self.txnum}>"
+
+    @classmethod
+    def write_to_log(cls, lm, txnum: int) -> int:
+        return lm.append(cls(txnum))
+
+
+@dataclass
+class StartRecord(TxRecord):
+    OP: ClassVar[int] = LogRecord.START
+    NAME: ClassVar[str] = "START"
+
+
+@dataclass
+class CommitRecord(TxRecord):
+    OP: ClassVar[int] = LogRecord.COMMIT
+    NAME: ClassVar[str] = "COMMIT"
+
+
+@dataclass
+class RollbackRecord(TxRecord):
+    OP: ClassVar[int] = LogRecord.ROLLBACK
+    NAME: ClassVar[str] = "ROLLBACK"
+
+
+@dataclass
+class SetIntRecord(LogRecord):
+    txnum: int = 0
+    offset: int = 0
+    val: int = 0  # 変更前の値(undo用)
+    newval: int = 0  # 変更後の値(redo用)
+    blk: BlockId | None = None
+
+    @classmethod
+    def decode(cls, data: bytes, names: Sequence[str]) -> "SetIntRecord":
+        txnum, pos = get_varint(data, 1)
+        fileid, pos = get_varint(data, pos)
+        blknum, pos = get_varint(data, pos)
+        offset, pos = get_varint(data, pos)
+        val, pos = get_svarint(data, pos)
+        newval, pos = get_svarint(data, pos)
+        return cls(txnum, offset, val, newval, BlockId(names[fileid], blknum))
+
+    def op(self) -> int:
+        return LogRecord.SETINT
+
+    def tx_number(self) -> int:
+        return self.txnum
+
+    def undo(self, tx) -> None:
+        # 取り消しもログに書く(補償レコード)ので、redoが歴史をそのまま繰り返せる
+        tx.pin(self.blk)
+        tx.set_int(self.blk, self.offset, self.val, True)
+        tx.unpin(self.blk)
+
+    def redo(self, buff: Buffer) -> None:
+        buff.contents.set_int(self.offset, self.newval)
+
+    def encode(self, intern: Callable[[str], int]) -> bytes:
+        buf = bytearray((LogRecord.SETINT,))
+        put_varint(buf, self.txnum)
+        put_varint(buf, intern(self.blk.filename))
+        put_varint(buf, self.blk.blknum)
+        put_varint(buf, self.offset)
+        put_svarint(buf, self.val)
+        put_svarint(buf, self.newval)
+        return buf
+
+    def __str__(self) -> str:
+        return (
+            f"<SETINT {self.txnum} {self.blk} {self.offset} {self.val} {self.newval}>"
+        )
+
+    @staticmethod
+    def write_to_log(
+        lm, txnum: int, blk: BlockId, offset: int, val: int, newval: int
+    ) -> int:
+        return lm.append(SetIntRecord(txnum, offset, val, newval, blk))
 
 
 @dataclass
 class SetStringRecord(LogRecord):
     txnum: int = 0
     offset: int = 0
-    val: str = ""
+    val: str = ""  # 変更前の値(undo用)
+    newval: str = ""  # 変更後の値(redo用)
     blk: BlockId | None = None
 
-    def __init__(self, p: Page | None = None):
-        if p is not None:
-            # データからフィールド抽出
-            # 実装略
-            pass
+    @classmethod
+    def decode(cls, data: bytes, names: Sequence[str]) -> "SetStringRecord":
+        txnum, pos = get_varint(data, 1)
+        fileid, pos = get_varint(data, pos)
+        blknum, pos = get_varint(data, pos)
+        offset, pos = get_varint(data, pos)
+        val, pos = get_str(data, pos)
+        newval, pos = get_str(data, pos)
+        return cls(txnum, offset, val, newval, BlockId(names[fileid], blknum))
 
     def op(self) -> int:
         return LogRecord.SETSTRING
@@ -55,14 +256,73 @@ class SetStringRecord(LogRecord):
 
     def undo(self, tx) -> None:
         tx.pin(self.blk)
-        tx.set_string(self.blk, self.offset, self.val, False)
+        tx.set_string(self.blk, self.offset, self.val, True)
         tx.unpin(self.blk)
 
+    def redo(self, buff: Buffer) -> None:
+        buff.contents.set_string(self.offset, self.newval)
+
+    def encode(self, intern: Callable[[str], int]) -> bytes:
+        buf = bytearray((LogRecord.SETSTRING,))
+        put_varint(buf, self.txnum)
+        put_varint(buf, intern(self.blk.filename))
+        put_varint(buf, self.blk.blknum)
+        put_varint(buf, self.offset)
+        put_str(buf, self.val)
+        put_str(buf, self.newval)
+        return buf
+
+    def __str__(self) -> str:
+        return (
+            f"<SETSTRING {self.txnum} {self.blk} {self.offset}"
+            f" {self.val} {self.newval}>"
+        )
+
+    @staticmethod
+    def write_to_log(
+        lm, txnum: int, blk: BlockId, offset: int, val: str, newval: str
+    ) -> int:
+        return lm.append(SetStringRecord(txnum, offset, val, newval, blk))
+
+
+class Checkpointer(threading.Thread):
+    """
+    定期的にチェックポイントを取るスレッド。
+    汚れたバッファをすべて書き出してからCHECKPOINTレコードを書くので、
+    recover()がさかのぼるログの量はおおむね1周期ぶんに収まる。
+    """
+
+    def __init__(self, bm: "BufferMgr", lm: "LogMgr", interval: float = 30.0):
+        super().__init__(name="checkpointer", daemon=True)
+        self.bm = bm
+        self.lm = lm
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.checkpoint()
+
+    def checkpoint(self) -> int:
+        redo_lsn = self.bm.flush_for_checkpoint()
+        # 書き出しの後に取るので、書き出しに含まれた未コミットの変更のtxは必ず載る
+        active_txs = Transaction.active_tx_numbers()
+        lsn = CheckpointRecord.write_to_log(self.lm, redo_lsn, active_txs)
+        self.lm.flush(lsn)
+        self.truncate_log(self.lm, redo_lsn)
+        return lsn
+
     @staticmethod
-    def write_to_log(lm, txnum: int, blk: BlockId, offset: int, val: str) -> int:
-        # ログ書き込み実装
-        # 実装略
-        return 0
+    def truncate_log(lm: "LogMgr", redo_lsn: int) -> int:
+        """
+        redo_lsnと、実行中のトランザクションのSTARTより前だけのセグメントを捨てる。
+        リカバリもロールバックもそれより前はさかのぼらない。
+        """
+        return lm.truncate(min(redo_lsn, Transaction.oldest_begin_lsn(redo_lsn)))
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
 
 
 # ロック関連クラス
@@ -70,23 +330,231 @@ class LockAbortException(Exception):
     pass
 
 
+@dataclass
+class LockEntry:
+    """1ブロックぶんのロックの状態"""
+
+    cond: threading.Condition
+    holders: dict[int, str] = field(default_factory=dict)  # txnum -> "S" / "X"
+    waiting: deque[tuple[int, str]] = field(default_factory=deque)
+    # スレッドを止めずに待っている要求(poll)を起こすコールバック。起こしたら空にする
+    wakeups: list[Callable[[], None]] = field(default_factory=list)
+
+
 class LockTable:
+    """
+    ブロック単位の共有(S)/排他(X)ロック。
+    待ちは到着順(FIFO)で、S→Xの昇格要求は待ち行列の先頭に入る。
+
+    deadlock:
+        detect     -- 待つたびにwait-forグラフをたどり、閉路を作った側をアボート
+        wait-die   -- 古いトランザクションだけが待ち、新しい方はその場でアボート
+        wound-wait -- 古いトランザクションは新しい保持者をアボートさせてから待つ
+        timeout    -- 検出せずMAX_TIMEまで待ってアボート
+    txnumが小さいほど古いトランザクションとみなす。
+    """
+
     MAX_TIME = 10000  # 10秒
+    DEADLOCK_POLICIES = ("detect", "wait-die", "wound-wait", "timeout")
 
-    def __init__(self):
-        self.locks = {}
+    def __init__(self, deadlock: str = "detect"):
+        if deadlock not in self.DEADLOCK_POLICIES:
+            raise ValueError(f"unknown deadlock policy: {deadlock}")
+        self.deadlock = deadlock
+        self.lock = threading.Lock()
+        self.locks: dict[BlockId, LockEntry] = {}
+        self.waiting_on: dict[int, tuple[LockEntry, str]] = {}
+        self.wounded: set[int] = set()
 
-    def s_lock(self, blk: BlockId) -> None:
-        # 実装略
-        pass
+    def s_lock(self, blk: BlockId, txnum: int) -> None:
+        self._acquire(blk, txnum, "S")
 
-    def x_lock(self, blk: BlockId) -> None:
-        # 実装略
-        pass
+    def x_lock(self, blk: BlockId, txnum: int) -> None:
+        self._acquire(blk, txnum, "X")
 
-    def unlock(self, blk: BlockId) -> None:
-        # 実装略
-        pass
+    def unlock(self, blk: BlockId, txnum: int) -> None:
+        with self.lock:
+            entry = self.locks.get(blk)
+            if entry is None:
+                return
+            entry.holders.pop(txnum, None)
+            if not entry.holders and not entry.waiting:
+                del self.locks[blk]
+            else:
+                self._notify(entry)
+
+    def end(self, txnum: int) -> None:
+        """トランザクションの終了時に呼ぶ"""
+        with self.lock:
+            self.wounded.discard(txnum)
+
+    def request(self, blk: BlockId, txnum: int, mode: str) -> LockEntry | None:
+        """
+        スレッドを止めずにロックを取るための1段目。待ち行列に並び、その
+        エントリを返す(既に持っていればNone)。続けてpollを呼び、取れなかった
+        ときはwakeupが呼ばれるのを待ってまたpollする。やめるときはcancelを呼ぶ
+        """
+        with self.lock:
+            self._check_wounded(txnum)
+            return self._enqueue(blk, txnum, mode)
+
+    def poll(
+        self,
+        blk: BlockId,
+        entry: LockEntry,
+        txnum: int,
+        mode: str,
+        wakeup: Callable[[], None],
+    ) -> bool:
+        """
+        取れたらTrue。取れなければ状態が変わったときに呼ぶwakeupを登録してFalse。
+        アボートすべきときは待ち行列から外してLockAbortExceptionを投げる。
+        wakeupはself.lockを持ったまま任意のスレッドから呼ばれる
+        """
+        with self.lock:
+            try:
+                self._check_wounded(txnum)
+                if self._grant(entry, txnum, mode):
+                    self._dequeue(blk, entry, txnum, mode)
+                    return True
+            except LockAbortException:
+                self._dequeue(blk, entry, txnum, mode)
+                raise
+            entry.wakeups.append(wakeup)
+            return False
+
+    def cancel(self, blk: BlockId, entry: LockEntry, txnum: int, mode: str) -> None:
+        """requestした要求を取り下げる(待ちきれなかったときなど)"""
+        with self.lock:
+            if self.waiting_on.get(txnum, (None,))[0] is entry:
+                self._dequeue(blk, entry, txnum, mode)
+
+    def _acquire(self, blk: BlockId, txnum: int, mode: str) -> None:
+        deadline = time.monotonic() + self.MAX_TIME / 1000
+        with self.lock:
+            self._check_wounded(txnum)
+            entry = self._enqueue(blk, txnum, mode)
+            if entry is None:
+                return
+            start = None
+            try:
+                while not self._grant(entry, txnum, mode):
+                    if start is None and metrics.enabled:
+                        start = time.perf_counter()
+                        metrics.inc("lock_waits")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if metrics.enabled:
+                            metrics.inc("lock_timeouts")
+                        raise LockAbortException(f"lock wait timeout on {blk}")
+                    entry.cond.wait(remaining)
+                    self._check_wounded(txnum)
+            finally:
+                if start is not None:
+                    metrics.observe("lock_wait_seconds", time.perf_counter() - start)
+                self._dequeue(blk, entry, txnum, mode)
+
+    def _enqueue(self, blk: BlockId, txnum: int, mode: str) -> LockEntry | None:
+        """self.lockを保持して呼ぶこと。既に持っているロックならNone"""
+        entry = self.locks.get(blk)
+        if entry is None:
+            entry = self.locks[blk] = LockEntry(threading.Condition(self.lock))
+        held = entry.holders.get(txnum)
+        if held == "X" or held == mode:
+            return None
+        if held == "S":
+            entry.waiting.appendleft((txnum, mode))  # 昇格は優先する
+        else:
+            entry.waiting.append((txnum, mode))
+        self.waiting_on[txnum] = (entry, mode)
+        return entry
+
+    def _grant(self, entry: LockEntry, txnum: int, mode: str) -> bool:
+        """
+        self.lockを保持して呼ぶこと。妨げがなければロックを与えてTrue。
+        待つことになるならその前にデッドロック対策を行う
+        """
+        blockers = self._blockers(entry, txnum, mode)
+        if not blockers:
+            entry.holders[txnum] = mode
+            return True
+        self._resolve(txnum, blockers)
+        return False
+
+    def _dequeue(self, blk: BlockId, entry: LockEntry, txnum: int, mode: str) -> None:
+        """self.lockを保持して呼ぶこと"""
+        entry.waiting.remove((txnum, mode))
+        del self.waiting_on[txnum]
+        if not entry.holders and not entry.waiting:
+            del self.locks[blk]
+        else:
+            # 後ろに並んでいた待ち手が進めるかもしれない
+            self._notify(entry)
+
+    @staticmethod
+    def _notify(entry: LockEntry) -> None:
+        """self.lockを保持して呼ぶこと"""
+        entry.cond.notify_all()
+        wakeups, entry.wakeups = entry.wakeups, []
+        for wakeup in wakeups:
+            wakeup()
+
+    def _blockers(self, entry: LockEntry, txnum: int, mode: str) -> set[int]:
+        """txnumの要求を妨げている保持者と、先に並んでいる待ち手"""
+        blockers = {
+            h
+            for h, m in entry.holders.items()
+            if h != txnum and (mode == "X" or m == "X")
+        }
+        for w, m in entry.waiting:
+            if w == txnum:
+                break
+            if mode == "X" or m == "X":
+                blockers.add(w)
+        return blockers
+
+    def _resolve(self, txnum: int, blockers: set[int]) -> None:
+        """待つ前にデッドロック対策を行う。アボートすべきなら例外を投げる"""
+        if self.deadlock == "detect":
+            if self._reaches(blockers, txnum):
+                self._count_deadlock()
+                raise LockAbortException(f"deadlock detected for tx {txnum}")
+        elif self.deadlock == "wait-die":
+            if any(b < txnum for b in blockers):
+                self._count_deadlock()
+                raise LockAbortException(f"tx {txnum} dies waiting for an older tx")
+        elif self.deadlock == "wound-wait":
+            for b in blockers:
+                if b > txnum and b not in self.wounded:
+                    self.wounded.add(b)
+                    if b in self.waiting_on:
+                        self._notify(self.waiting_on[b][0])
+
+    def _reaches(self, start: set[int], target: int) -> bool:
+        """wait-forグラフでstartからtargetにたどり着けるか"""
+        stack = list(start)
+        seen = set()
+        while stack:
+            t = stack.pop()
+            if t == target:
+                return True
+            if t in seen or t not in self.waiting_on:
+                continue
+            seen.add(t)
+            entry, mode = self.waiting_on[t]
+            stack.extend(self._blockers(entry, t, mode))
+        return False
+
+    def _check_wounded(self, txnum: int) -> None:
+        if txnum in self.wounded:
+            self.wounded.discard(txnum)
+            self._count_deadlock()
+            raise LockAbortException(f"tx {txnum} wounded by an older tx")
+
+    @staticmethod
+    def _count_deadlock() -> None:
+        if metrics.enabled:
+            metrics.inc("lock_deadlocks")
 
 
 @dataclass
@@ -100,59 +568,317 @@ class ConcurrencyMgr:
 
     def s_lock(self, blk: BlockId) -> None:
         if blk not in self.locks:
-            self.locktbl.s_lock(blk)
+            self.locktbl.s_lock(blk, self.txnum)
             self.locks[blk] = "S"
 
     def x_lock(self, blk: BlockId) -> None:
         if not self.has_xlock(blk):
             self.s_lock(blk)
-            self.locktbl.x_lock(blk)
+            self.locktbl.x_lock(blk, self.txnum)
             self.locks[blk] = "X"
 
+    def unlock(self, blk: BlockId) -> None:
+        """トランザクションの終了を待たずにロックを外す"""
+        if self.locks.pop(blk, None) is not None:
+            self.locktbl.unlock(blk, self.txnum)
+
     def release(self) -> None:
         for blk in list(self.locks.keys()):
-            self.locktbl.unlock(blk)
+            self.locktbl.unlock(blk, self.txnum)
         self.locks.clear()
+        self.locktbl.end(self.txnum)
 
     def has_xlock(self, blk: BlockId) -> bool:
         locktype = self.locks.get(blk)
         return locktype is not None and locktype == "X"
 
 
+# MVCC関連クラス
+class VersionStore:
+    """
+    スナップショット読み取りのための旧版(ビフォーイメージ)の置き場所。
+
+    書き込み側は従来どおりXロックを取り、ブロックを最初に変更する前に
+    そのページの内容を保存する。コミットすると保存した内容は
+    「コミット番号cより前のスナップショット向けの版」として版チェーンに入る。
+    スナップショットはその時点のコミット番号sで、
+    - s < c となる最も古い版があればそれを、
+    - なければ未コミットの書き込み中のビフォーイメージを、
+    - それもなければバッファの現在の内容を読む。
+    どのスナップショットからも見えなくなった版は、最も古いスナップショットが
+    進んだ時点で捨てる。
+
+    スナップショットがひとつもない間はページを写さず、書き換える範囲の前の値
+    (undo)だけを覚えておく。スナップショットが始まるか、書き込み側がブロックの
+    pinを外すときに、現在のページにundoを逆順に当ててビフォーイメージを作る。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commit_ts = 0
+        self.pending: dict[int, dict[BlockId, bytes]] = {}  # txnum -> ビフォーイメージ
+        self.writers: dict[BlockId, bytes] = {}  # 書き込み中のブロック
+        self.chains: dict[BlockId, deque[tuple[int, bytes]]] = {}
+        self.snapshots: Counter[int] = Counter()
+        # txnum -> ブロック -> (書き込み中のページ, [(オフセット, 前の値)])
+        self.undos: dict[int, dict[BlockId, tuple[Page, list[tuple[int, bytes]]]]] = {}
+
+    def begin_snapshot(self) -> int:
+        with self.lock:
+            for txnum in list(self.undos):
+                for blk in list(self.undos[txnum]):
+                    self._materialize(txnum, blk)
+            self.snapshots[self.commit_ts] += 1
+            return self.commit_ts
+
+    def end_snapshot(self, snapshot: int) -> None:
+        with self.lock:
+            self.snapshots[snapshot] -= 1
+            if self.snapshots[snapshot] == 0:
+                del self.snapshots[snapshot]
+                self._collect(list(self.chains))
+
+    def before_write(
+        self, txnum: int, blk: BlockId, p: Page, offset: int, length: int
+    ) -> None:
+        """
+        ページのoffsetからlengthバイトを変更する前に呼ぶ。
+        ビフォーイメージはトランザクションごとに最初の1回だけ保存する
+        """
+        images = self.pending.get(txnum)
+        if images is not None and blk in images:
+            return
+        with self.lock:
+            if self.snapshots:
+                # スナップショット中はundoを持っていない(begin_snapshotで作る)
+                image = bytes(p.contents())
+                self.pending.setdefault(txnum, {})[blk] = image
+                self.writers[blk] = image
+                return
+            _, undo = self.undos.setdefault(txnum, {}).setdefault(blk, (p, []))
+            undo.append((offset, bytes(p.contents()[offset : offset + length])))
+
+    def release(self, txnum: int, blk: BlockId) -> None:
+        """
+        書き込み中のブロックのpinを外す前に呼ぶ。
+        外した後はページが別のブロックに使われうるので、ここでビフォーイメージを作る
+        """
+        with self.lock:
+            if blk in self.undos.get(txnum, ()):
+                self._materialize(txnum, blk)
+
+    def _materialize(self, txnum: int, blk: BlockId) -> None:
+        """undoからビフォーイメージを作る。self.lockを保持して呼ぶこと"""
+        undos = self.undos[txnum]
+        p, undo = undos.pop(blk)
+        if not undos:
+            del self.undos[txnum]
+        # 書き込み側はundoを追加してからページを書き換えるので、最後の書き換えが
+        # まだページに届いていなくても前の値を当てれば同じ結果になる
+        image = bytearray(p.contents())
+        for offset, old in reversed(undo):
+            image[offset : offset + len(old)] = old
+        image = bytes(image)
+        self.pending.setdefault(txnum, {})[blk] = image
+        self.writers[blk] = image
+
+    def commit(self, txnum: int) -> None:
+        with self.lock:
+            # undoだけのブロックはどのスナップショットからも読まれない
+            self.undos.pop(txnum, None)
+            images = self.pending.pop(txnum, None)
+            if not images:
+                return
+            self.commit_ts += 1
+            for blk, image in images.items():
+                del self.writers[blk]
+                self.chains.setdefault(blk, deque()).append((self.commit_ts, image))
+            self._collect(list(images))
+
+    def abort(self, txnum: int) -> None:
+        """ロールバックでページを元に戻した後に呼ぶ"""
+        with self.lock:
+            self.undos.pop(txnum, None)
+            for blk in self.pending.pop(txnum, {}):
+                del self.writers[blk]
+
+    def read(self, blk: BlockId, snapshot: int, current: Page, getter):
+        """スナップショットから見えるページに対してgetterを呼ぶ"""
+        with self.lock:
+            image = None
+            for ts, version in self.chains.get(blk, ()):
+                if ts > snapshot:
+                    image = version
+                    break
+            if image is None:
+                image = self.writers.get(blk)
+            if image is None:
+                return getter(current)
+        return getter(Page(memoryview(image)))
+
+    def _collect(self, blks) -> None:
+        """self.lockを保持して呼ぶこと"""
+        oldest = min(self.snapshots) if self.snapshots else self.commit_ts
+        for blk in blks:
+            chain = self.chains.get(blk)
+            if chain is None:
+                continue
+            while chain and chain[0][0] <= oldest:
+                chain.popleft()
+            if not chain:
+                del self.chains[blk]
+
+
 # リカバリ関連クラス
 @dataclass
 class RecoveryMgr:
+    """
+    undo/redoログによるリカバリ。コミット時にページを書き出さない(no-force)。
+    更新レコードは変更前と変更後の両方の値を持つ。
+    """
+
     tx: "Transaction"
     txnum: int
     lm: "LogMgr"
     bm: "BufferMgr"
+    begin_lsn: int
+    REDO_WORKERS: ClassVar[int] = 4
 
     def __init__(self, tx: "Transaction", txnum: int, lm: "LogMgr", bm: "BufferMgr"):
         self.tx = tx
         self.txnum = txnum
         self.lm = lm
         self.bm = bm
-        # StartRecordの書き込み略
+        # これより後のログは自分のもの。再起動後はtxnumが以前のtxと重なりうる
+        self.begin_lsn = self.lm.latest_lsn
+        if not tx.read_only:
+            StartRecord.write_to_log(self.lm, self.txnum)
 
     def commit(self) -> None:
-        # 実装略
-        pass
+        if self.tx.read_only:
+            return
+        lsn = CommitRecord.write_to_log(self.lm, self.txnum)
+        self.lm.group_flush(lsn)
 
     def rollback(self) -> None:
-        # 実装略
-        pass
+        if self.tx.read_only:
+            return
+        self._do_rollback()
+        lsn = RollbackRecord.write_to_log(self.lm, self.txnum)
+        self.lm.flush(lsn)
 
-    def recover(self) -> None:
-        # 実装略
-        pass
+    def recover(self, workers: int | None = None) -> None:
+        """
+        再起動時のリカバリ。
+        1. 分析: ログを末尾からさかのぼり、直近のチェックポイントのredo_lsnと、
+           そこで実行中だったトランザクションの開始レコードまでを読む
+        2. redo: redo_lsnより後の更新をブロックごとに分け、ブロック内では
+           ログの順に、ブロック間はワーカースレッドで並列に再実行する
+        3. undo: 終わっていないトランザクションの更新を新しい順に取り消す
+        最後にチェックポイントを取り、次回のリカバリがここから始まるようにする。
+        """
+        records, redo_lsn = self._analyze()
+        finished = {
+            rec.tx_number()
+            for _, rec in records
+            if rec.op() in (LogRecord.COMMIT, LogRecord.ROLLBACK)
+        }
+        losers = {rec.tx_number() for _, rec in records} - finished
+
+        updates = [
+            (lsn, rec)
+            for lsn, rec in reversed(records)
+            if lsn > redo_lsn and rec.op() in (LogRecord.SETINT, LogRecord.SETSTRING)
+        ]
+        self._redo(updates, workers or self.REDO_WORKERS)
+
+        for _, rec in records:
+            if rec.tx_number() in losers:
+                rec.undo(self.tx)
+        self.lm.append_many(RollbackRecord(txnum) for txnum in sorted(losers))
+
+        redo_lsn = self.bm.flush_for_checkpoint()
+        lsn = CheckpointRecord.write_to_log(self.lm, redo_lsn, [])
+        self.lm.flush(lsn)
+        Checkpointer.truncate_log(self.lm, redo_lsn)
 
     def set_int(self, buff: Buffer, offset: int, newval: int) -> int:
-        # 実装略
-        return 0
+        oldval = buff.contents.get_int(offset)
+        blk = buff.block()
+        return SetIntRecord.write_to_log(
+            self.lm, self.txnum, blk, offset, oldval, newval
+        )
 
     def set_string(self, buff: Buffer, offset: int, newval: str) -> int:
-        # 実装略
-        return 0
+        oldval = buff.contents.get_string(offset)
+        blk = buff.block()
+        return SetStringRecord.write_to_log(
+            self.lm, self.txnum, blk, offset, oldval, newval
+        )
+
+    def _do_rollback(self) -> None:
+        it = self.lm.iterator()
+        for bytes_data in it:
+            rec = LogRecord.create_log_record(bytes_data, it.names)
+            if rec.tx_number() == self.txnum:
+                if rec.op() == LogRecord.START:
+                    return
+                rec.undo(self.tx)
+
+    def _analyze(self) -> tuple[list[tuple[int, LogRecord]], int]:
+        """
+        リカバリに必要なレコードを(LSN, レコード)の新しい順のリストで返す。
+        チェックポイントがなければログ全体を読み、redo_lsnは-1になる。
+        """
+        records: list[tuple[int, LogRecord]] = []
+        checkpoint: CheckpointRecord | None = None
+        finished: set[int] = set()
+        need_start: set[int] = set()  # 開始レコードをまだ見ていない未終了のtx
+        it = self.lm.iterator()
+        for bytes_data in it:
+            rec = LogRecord.create_log_record(bytes_data, it.names)
+            lsn = it.lsn
+            if lsn > self.begin_lsn:
+                continue
+            if rec.op() == LogRecord.CHECKPOINT:
+                if checkpoint is None:
+                    checkpoint = rec
+                    need_start |= set(rec.active_txs) - finished
+                continue
+            if checkpoint is not None and lsn <= checkpoint.redo_lsn and not need_start:
+                break
+            records.append((lsn, rec))
+            txnum = rec.tx_number()
+            if rec.op() in (LogRecord.COMMIT, LogRecord.ROLLBACK):
+                finished.add(txnum)
+            elif rec.op() == LogRecord.START:
+                need_start.discard(txnum)
+            elif txnum not in finished:
+                need_start.add(txnum)
+        redo_lsn = checkpoint.redo_lsn if checkpoint is not None else -1
+        return records, redo_lsn
+
+    def _redo(self, updates: list[tuple[int, LogRecord]], workers: int) -> None:
+        by_block: dict[BlockId, list[tuple[int, LogRecord]]] = {}
+        for lsn, rec in updates:
+            by_block.setdefault(rec.blk, []).append((lsn, rec))
+
+        def replay(blk: BlockId, recs: list[tuple[int, LogRecord]]) -> None:
+            buff = self.bm.pin(blk)
+            try:
+                for lsn, rec in recs:
+                    # ページLSN以下のレコードは既にバッファに反映されている
+                    if buff.lsn >= lsn:
+                        continue
+                    rec.redo(buff)
+                    buff.set_modified(rec.tx_number(), lsn)
+            finally:
+                self.bm.unpin(buff)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="redo") as ex:
+            futures = [ex.submit(replay, blk, recs) for blk, recs in by_block.items()]
+            for f in futures:
+                f.result()
 
 
 # トランザクションクラス
@@ -165,34 +891,79 @@ class Transaction:
     recovery_mgr: RecoveryMgr | None = None
     concur_mgr: ConcurrencyMgr | None = None
     mybuffers: BufferList | None = None
+    # 読み取り専用のトランザクションはロックを取らずスナップショットを読む
+    read_only: bool = False
+    snapshot: int = -1
+    written: set[BlockId] = field(default_factory=set, init=False)
 
     # クラス変数
     _next_tx_num: ClassVar[int] = 0
+    _active_txs: ClassVar[dict[int, int]] = {}  # txnum -> 開始時のlatest_lsn
+    _active_lock: ClassVar[threading.Lock] = threading.Lock()  # 採番と上の辞書を守る
+    versions: ClassVar[VersionStore] = VersionStore()
     END_OF_FILE: ClassVar[int] = -1
 
     def __post_init__(self):
-        self.txnum = self.next_tx_number()
+        # 採番と登録を同じロックの中で行うので、番号が重ならず、
+        # 登録前の番号をチェックポイントが見落とすこともない。
+        # STARTを書く前に登録するので、チェックポイントがSTARTより後を切り捨てない
+        with self._active_lock:
+            self.txnum = self._take_tx_number()
+            self._active_txs[self.txnum] = self.lm.latest_lsn
+        logger.debug("new transaction: %d", self.txnum)
         self.recovery_mgr = RecoveryMgr(self, self.txnum, self.lm, self.bm)
         self.concur_mgr = ConcurrencyMgr(self.txnum)
         self.mybuffers = BufferList(self.bm)
+        if self.read_only:
+            self.snapshot = self.versions.begin_snapshot()
 
     @classmethod
     def next_tx_number(cls) -> int:
+        with cls._active_lock:
+            return cls._take_tx_number()
+
+    @classmethod
+    def _take_tx_number(cls) -> int:
+        """_active_lockを持って呼ぶこと"""
         cls._next_tx_num += 1
-        print(f"new transaction: {cls._next_tx_num}")
         return cls._next_tx_num
 
+    @classmethod
+    def active_tx_numbers(cls) -> list[int]:
+        with cls._active_lock:
+            return sorted(cls._active_txs)
+
+    @classmethod
+    def oldest_begin_lsn(cls, default: int) -> int:
+        """実行中のトランザクションが始まった時点のLSNのうち最も古いもの"""
+        with cls._active_lock:
+            return min(cls._active_txs.values(), default=default)
+
     def commit(self) -> None:
         self.recovery_mgr.commit()
+        self._end_versions(committed=True)
         self.concur_mgr.release()
         self.mybuffers.unpin_all()
-        print(f"transaction {self.txnum} committed")
+        with self._active_lock:
+            self._active_txs.pop(self.txnum, None)
+        logger.debug("transaction %d committed", self.txnum)
 
     def rollback(self) -> None:
         self.recovery_mgr.rollback()
+        self._end_versions(committed=False)
         self.concur_mgr.release()
         self.mybuffers.unpin_all()
-        print(f"transaction {self.txnum} rolled back")
+        with self._active_lock:
+            self._active_txs.pop(self.txnum, None)
+        logger.debug("transaction %d rolled back", self.txnum)
+
+    def _end_versions(self, committed: bool) -> None:
+        if self.read_only:
+            self.versions.end_snapshot(self.snapshot)
+        elif committed:
+            self.versions.commit(self.txnum)
+        else:
+            self.versions.abort(self.txnum)
 
     def recover(self) -> None:
         self.bm.flush_all(self.txnum)
@@ -202,44 +973,76 @@ class Transaction:
         self.mybuffers.pin(blk)
 
     def unpin(self, blk: BlockId) -> None:
+        if blk in self.written and self.mybuffers.pins[blk] == 1:
+            self.versions.release(self.txnum, blk)
         self.mybuffers.unpin(blk)
 
     def get_int(self, blk: BlockId, offset: int) -> int:
-        self.concur_mgr.s_lock(blk)
         buff = self.mybuffers.get_buffer(blk)
-        return buff.contents().get_int(offset)
+        if self.read_only:
+            return self.versions.read(
+                blk, self.snapshot, buff.contents, lambda p: p.get_int(offset)
+            )
+        self.concur_mgr.s_lock(blk)
+        return buff.contents.get_int(offset)
 
     def get_string(self, blk: BlockId, offset: int) -> str:
-        self.concur_mgr.s_lock(blk)
         buff = self.mybuffers.get_buffer(blk)
-        return buff.contents().get_string(offset)
+        if self.read_only:
+            return self.versions.read(
+                blk, self.snapshot, buff.contents, lambda p: p.get_string(offset)
+            )
+        self.concur_mgr.s_lock(blk)
+        return buff.contents.get_string(offset)
 
     def set_int(self, blk: BlockId, offset: int, val: int, ok_to_log: bool) -> None:
+        self._check_writable()
         self.concur_mgr.x_lock(blk)
         buff = self.mybuffers.get_buffer(blk)
+        self.versions.before_write(self.txnum, blk, buff.contents, offset, 4)
+        self.written.add(blk)
         lsn = -1
         if ok_to_log:
             lsn = self.recovery_mgr.set_int(buff, offset, val)
-        p = buff.contents()
+        p = buff.contents
         p.set_int(offset, val)
         buff.set_modified(self.txnum, lsn)
 
     def set_string(self, blk: BlockId, offset: int, val: str, ok_to_log: bool) -> None:
+        self._check_writable()
         self.concur_mgr.x_lock(blk)
         buff = self.mybuffers.get_buffer(blk)
+        length = Page.max_length(len(val))
+        self.versions.before_write(self.txnum, blk, buff.contents, offset, length)
+        self.written.add(blk)
         lsn = -1
         if ok_to_log:
             lsn = self.recovery_mgr.set_string(buff, offset, val)
-        p = buff.contents()
+        p = buff.contents
         p.set_string(offset, val)
         buff.set_modified(self.txnum, lsn)
 
+    def x_lock(self, blk: BlockId) -> None:
+        """書き込む前からXロックを取る(索引を下りるときのロックカップリング用)"""
+        self._check_writable()
+        self.concur_mgr.x_lock(blk)
+
+    def unlock(self, blk: BlockId) -> None:
+        """
+        書き込んでいないブロックのロックを早めに外す。
+        書き込んだブロックはロールバックで前の値に戻すので終了まで外さない
+        """
+        if not self.read_only and blk not in self.written:
+            self.concur_mgr.unlock(blk)
+
     def size(self, filename: str) -> int:
-        dummyblk = BlockId(filename, self.END_OF_FILE)
-        self.concur_mgr.s_lock(dummyblk)
+        if not self.read_only:
+            dummyblk = BlockId(filename, self.END_OF_FILE)
+            self.concur_mgr.s_lock(dummyblk)
         return self.fm.length(filename)
 
     def append(self, filename: str) -> BlockId:
+        self._check_writable()
         dummyblk = BlockId(filename, self.END_OF_FILE)
         self.concur_mgr.x_lock(dummyblk)
         return self.fm.append(filename)
@@ -247,5 +1050,9 @@ class Transaction:
     def block_size(self) -> int:
         return self.fm.block_size()
 
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise RuntimeError(f"transaction {self.txnum} is read-only")
+
     def available_buffs(self) -> int:
         return self.bm.available()
@@ -0,0 +1,214 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from rdbms.aio import AsyncDB
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.buffer import BufferAbortException
+from rdbms.storage.disk import BlockId
+from rdbms.transaction import ConcurrencyMgr, LockAbortException, LockTable
+
+
+@pytest.fixture
+def locktbl(monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+
+
+def open_db(tmp_path, buffs: int = 8) -> SimpleDB:
+    return SimpleDB(str(tmp_path / "aiotest"), 400, buffs, durability="none")
+
+
+def test_commit_and_read_back(tmp_path, locktbl):
+    db = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+
+    async def main():
+        adb = AsyncDB(db, io_workers=2)
+        async with await adb.begin() as tx:
+            await tx.pin(blk)
+            await tx.set_int(blk, 0, 42, True)
+            await tx.set_string(blk, 20, "async", True)
+        async with await adb.begin() as tx:
+            await tx.pin(blk)
+            assert await tx.get_int(blk, 0) == 42
+            assert await tx.get_string(blk, 20) == "async"
+        await adb.close()
+
+    asyncio.run(main())
+
+
+def test_writes_append_log_off_the_loop(tmp_path, locktbl, monkeypatch):
+    db = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+    threads = set()
+    append = db.lm.append
+
+    def recording_append(logrec) -> int:
+        threads.add(threading.get_ident())
+        return append(logrec)
+
+    monkeypatch.setattr(db.lm, "append", recording_append)
+
+    async def main():
+        adb = AsyncDB(db, io_workers=2)
+        async with await adb.begin() as tx:
+            await tx.pin(blk)
+            await tx.set_int(blk, 0, 1, True)
+            await tx.set_string(blk, 20, "off loop", True)
+        await adb.close()
+
+    asyncio.run(main())
+    assert threads and threading.get_ident() not in threads
+
+
+def test_exception_rolls_back(tmp_path, locktbl):
+    db = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+
+    async def main():
+        adb = AsyncDB(db, io_workers=2)
+        with pytest.raises(ValueError):
+            async with await adb.begin() as tx:
+                await tx.pin(blk)
+                await tx.set_int(blk, 0, 7, True)
+                raise ValueError
+        async with await adb.begin(read_only=True) as tx:
+            await tx.pin(blk)
+            assert await tx.get_int(blk, 0) == 0
+        await adb.close()
+
+    asyncio.run(main())
+
+
+def test_lock_wait_does_not_block_the_loop(tmp_path, locktbl):
+    db = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+    holder = db.new_tx()
+    holder.pin(blk)
+    holder.set_int(blk, 0, 5, True)
+
+    async def main():
+        adb = AsyncDB(db, io_workers=1)
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.001)
+
+        t = asyncio.create_task(ticker())
+        tx = await adb.begin()
+        await tx.pin(blk)
+        # 別スレッドの保持者が少し後でコミットする
+        threading.Timer(0.1, holder.commit).start()
+        assert await tx.get_int(blk, 0) == 5
+        await tx.commit()
+        t.cancel()
+        await adb.close()
+        return ticks
+
+    assert asyncio.run(main()) > 10
+
+
+def test_async_deadlock_is_detected(tmp_path, locktbl):
+    db = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+
+    async def main():
+        adb = AsyncDB(db, io_workers=2)
+        both_read = asyncio.Barrier(2)
+
+        async def increment():
+            tx = await adb.begin()
+            try:
+                await tx.pin(blk)
+                n = await tx.get_int(blk, 0)
+                await both_read.wait()  # どちらもSロックを持ってから格上げする
+                await tx.set_int(blk, 0, n + 1, True)
+            except LockAbortException:
+                await tx.rollback()
+                return "aborted"
+            await tx.commit()
+            return "committed"
+
+        results = await asyncio.gather(increment(), increment())
+        await adb.close()
+        return sorted(results)
+
+    assert asyncio.run(main()) == ["aborted", "committed"]
+
+
+def test_lock_wait_times_out(tmp_path, monkeypatch):
+    lt = LockTable("timeout")
+    lt.MAX_TIME = 50
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", lt)
+    db = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+    holder = db.new_tx()
+    holder.pin(blk)
+    holder.set_int(blk, 0, 5, True)
+
+    async def main():
+        adb = AsyncDB(db, io_workers=1)
+        tx = await adb.begin()
+        await tx.pin(blk)
+        with pytest.raises(LockAbortException):
+            await tx.get_int(blk, 0)
+        await tx.rollback()
+        await adb.close()
+
+    asyncio.run(main())
+    assert lt.locks[blk].holders == {holder.txnum: "X"}
+    assert not lt.locks[blk].waiting and not lt.waiting_on
+    holder.rollback()
+
+
+def test_many_sessions_share_few_buffers_and_threads(tmp_path, locktbl):
+    db = open_db(tmp_path, buffs=4)
+    blks = [db.fm.append("testfile") for _ in range(300)]
+    before = threading.active_count()
+    threads = []
+
+    async def main():
+        adb = AsyncDB(db, io_workers=4)
+
+        async def session(blk: BlockId) -> None:
+            async with await adb.begin() as tx:
+                await tx.pin(blk)
+                await asyncio.sleep(0.001)  # pinしたまま他のセッションに譲る
+                await tx.set_int(blk, 0, blk.blknum + 1, True)
+            threads.append(threading.active_count())
+
+        await asyncio.gather(*(session(blk) for blk in blks))
+        async with await adb.begin(read_only=True) as tx:
+            for blk in blks:
+                await tx.pin(blk)
+                assert await tx.get_int(blk, 0) == blk.blknum + 1
+                tx.unpin(blk)
+        await adb.close()
+
+    asyncio.run(main())
+    assert max(threads) <= before + 4
+
+
+def test_buffer_wait_times_out(tmp_path, locktbl):
+    db = open_db(tmp_path, buffs=1)
+    db.bm.MAX_TIME = 50
+    held = db.bm.pin(BlockId("testfile", 0))
+
+    async def main():
+        adb = AsyncDB(db, io_workers=1)
+        tx = await adb.begin()
+        start = time.monotonic()
+        with pytest.raises(BufferAbortException):
+            await tx.pin(BlockId("testfile", 1))
+        assert time.monotonic() - start < 1
+        await tx.rollback()
+        await adb.close()
+
+    asyncio.run(main())
+    assert not db.bm.waiters
+    db.bm.unpin(held)
@@ -0,0 +1,174 @@
+import random
+import threading
+
+import pytest
+
+from rdbms.btree import BTreeIndex, BTreePage
+from rdbms.record import RID
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.disk import BlockId, FileMgr
+from rdbms.transaction import (
+    ConcurrencyMgr,
+    LockAbortException,
+    LockTable,
+    Transaction,
+)
+
+
+@pytest.fixture(autouse=True)
+def locktbl(monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+
+
+def open_db(path, blocksize: int = 100) -> tuple[FileMgr, LogMgr, BufferMgr]:
+    # ブロックを小さくして分割が何段も起きるようにする
+    fm = FileMgr(str(path / "btreetest"), blocksize)
+    lm = LogMgr(fm, "logfile")
+    return fm, lm, BufferMgr(fm, lm, 16)
+
+
+def height(tx: Transaction) -> int:
+    blk = BlockId("idx.idx", 0)
+    tx.pin(blk)
+    level = BTreePage(tx, blk).level()
+    tx.unpin(blk)
+    return level
+
+
+def test_insert_search_and_range(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    rng = random.Random(1)
+    keys = [rng.randrange(200) for _ in range(400)]
+    for i, key in enumerate(keys):
+        idx.insert(key, RID(i, 0))
+    assert height(tx) >= 3
+
+    for key in (0, 57, 199, 500):
+        assert sorted(idx.search(key)) == sorted(
+            RID(i, 0) for i, k in enumerate(keys) if k == key
+        )
+    assert [k for k, _ in idx.range()] == sorted(keys)
+    assert [k for k, _ in idx.range(50, 60)] == sorted(k for k in keys if 50 <= k <= 60)
+    tx.commit()
+
+
+def test_delete(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    for i in range(200):
+        idx.insert(i % 50, RID(i, 1))
+    for i in range(0, 200, 2):
+        assert idx.delete(i % 50, RID(i, 1))
+    assert not idx.delete(0, RID(0, 1))
+    assert list(idx.range()) == sorted((i % 50, RID(i, 1)) for i in range(1, 200, 2))
+    # 空になった葉を越えても見つかる
+    for i in range(1, 200, 2):
+        assert idx.delete(i % 50, RID(i, 1))
+    assert list(idx.range()) == []
+    tx.commit()
+
+
+def test_bulk_load(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    entries = [(i // 3, RID(i, 2)) for i in range(500)]
+    idx.bulk_load(iter(entries))
+    assert height(tx) >= 2
+    assert list(idx.range()) == entries
+    assert idx.search(100) == [RID(300, 2), RID(301, 2), RID(302, 2)]
+    # 読み込んだあとも普通に挿入できる
+    idx.insert(100, RID(0, 0))
+    assert idx.search(100)[0] == RID(0, 0)
+    with pytest.raises(RuntimeError):
+        idx.bulk_load([(1, RID(0, 0))])
+    tx.commit()
+
+
+def test_bulk_load_small_and_unsorted(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "small")
+    idx.bulk_load([(1, RID(0, 0)), (2, RID(0, 1))])
+    assert idx.search(2) == [RID(0, 1)]
+    with pytest.raises(ValueError):
+        BTreeIndex(tx, "unsorted").bulk_load([(2, RID(0, 0)), (1, RID(0, 0))])
+    tx.commit()
+
+
+def test_rollback_undoes_splits(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    for i in range(10):
+        idx.insert(i, RID(i, 0))
+    tx.commit()
+
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    for i in range(10, 300):
+        idx.insert(i, RID(i, 0))
+    tx.rollback()
+
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    assert [k for k, _ in idx.range()] == list(range(10))
+    tx.commit()
+
+
+def test_insert_releases_locks_on_safe_ancestors(tmp_path):
+    fm, lm, bm = open_db(tmp_path, blocksize=400)
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    idx.bulk_load([(i, RID(i, 0)) for i in range(0, 2000, 2)], fill=0.5)
+    tx.commit()
+
+    tx = Transaction(fm, lm, bm)
+    idx = BTreeIndex(tx, "idx")
+    idx.insert(501, RID(0, 0))
+    # 根は満杯でなく書き込まれてもいないのでロックは残らない
+    assert BlockId("idx.idx", 0) not in tx.concur_mgr.locks
+    assert sum(m == "X" for m in tx.concur_mgr.locks.values()) == 1
+
+    # 別のトランザクションは根を通って他の葉に書ける
+    other = Transaction(fm, lm, bm)
+    BTreeIndex(other, "idx").insert(1501, RID(1, 0))
+    other.commit()
+    tx.commit()
+
+
+def test_concurrent_inserts(tmp_path):
+    fm, lm, bm = open_db(tmp_path, blocksize=400)
+    tx = Transaction(fm, lm, bm)
+    BTreeIndex(tx, "idx")
+    tx.commit()
+    errors = []
+
+    def worker(start: int) -> None:
+        for key in range(start, 400, 4):
+            while True:
+                tx = Transaction(fm, lm, bm)
+                try:
+                    BTreeIndex(tx, "idx").insert(key, RID(key, 0))
+                    tx.commit()
+                    break
+                except LockAbortException:
+                    tx.rollback()
+                except Exception as e:
+                    errors.append(e)
+                    tx.rollback()
+                    return
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+    tx = Transaction(fm, lm, bm)
+    assert [k for k, _ in BTreeIndex(tx, "idx").range()] == list(range(400))
+    tx.commit()
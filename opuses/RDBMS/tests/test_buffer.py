@@ -0,0 +1,417 @@
+import threading
+import time
+
+import pytest
+
+from rdbms.storage.buffer import (
+    BackgroundWriter,
+    BufferAbortException,
+    BufferList,
+    BufferMgr,
+    LogMgr,
+)
+from rdbms.storage.disk import BlockId, FileMgr, MMapFileMgr, Page
+from rdbms.storage.replacer import ClockReplacer, LRUKReplacer, LRUReplacer
+
+
+def make_bm(tmp_path, numbuffs: int, policy: str = "lru", **kwargs) -> BufferMgr:
+    fm = FileMgr(str(tmp_path / "buffertest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, numbuffs, policy, **kwargs)
+    bm.MAX_TIME = 0  # 空きを待たずにすぐ諦める
+    return bm
+
+
+@pytest.mark.parametrize("policy", ["lru", "clock", "lru-k", "2q"])
+def test_pin_existing_block_reuses_buffer(tmp_path, policy):
+    bm = make_bm(tmp_path, 3, policy)
+    b1 = bm.pin(BlockId("testfile", 1))
+    b2 = bm.pin(BlockId("testfile", 1))
+    assert b1 is b2
+    assert bm.available() == 2
+
+    bm.unpin(b1)
+    bm.unpin(b2)
+    assert bm.available() == 3
+
+
+@pytest.mark.parametrize("policy", ["lru", "clock", "lru-k"])
+def test_pin_aborts_when_all_buffers_pinned(tmp_path, policy):
+    bm = make_bm(tmp_path, 2, policy)
+    bm.pin(BlockId("testfile", 0))
+    bm.pin(BlockId("testfile", 1))
+    with pytest.raises(BufferAbortException):
+        bm.pin(BlockId("testfile", 2))
+
+
+def test_buffer_list_counts_pins(tmp_path):
+    bm = make_bm(tmp_path, 3)
+    bl = BufferList(bm)
+    blk0, blk1 = BlockId("testfile", 0), BlockId("testfile", 1)
+    for blk in (blk0, blk0, blk0, blk1):
+        bl.pin(blk)
+    assert bl.pins == {blk0: 3, blk1: 1}
+    assert bm.available() == 1
+
+    bl.unpin(blk0)
+    assert bl.pins[blk0] == 2 and bl.get_buffer(blk0) is not None
+    bl.unpin(blk1)
+    assert blk1 not in bl.pins and bl.get_buffer(blk1) is None
+    bl.unpin_all()
+    assert not bl.pins and not bl.buffers
+    assert bm.available() == 3
+
+
+def test_unpin_many_takes_the_lock_once(tmp_path):
+    bm = make_bm(tmp_path, 4)
+    buffs = [bm.pin(BlockId("testfile", n)) for n in range(3)]
+    bm.pin(BlockId("testfile", 0))
+
+    class CountingLock:
+        def __init__(self, lock):
+            self.lock, self.acquired = lock, 0
+
+        def __enter__(self):
+            self.acquired += 1
+            return self.lock.__enter__()
+
+        def __exit__(self, *exc):
+            return self.lock.__exit__(*exc)
+
+    bm.lock = counting = CountingLock(bm.lock)
+    bm.unpin_many(buffs, [2, 1, 1])
+    assert counting.acquired == 1
+    assert bm.available() == 4
+
+
+def test_lru_evicts_least_recently_unpinned(tmp_path):
+    bm = make_bm(tmp_path, 3)
+    buffs = [bm.pin(BlockId("testfile", i)) for i in range(3)]
+    for i in (1, 0, 2):
+        bm.unpin(buffs[i])
+
+    bm.pin(BlockId("testfile", 3))
+    assert bm._find_existing_buffer(BlockId("testfile", 1)) is None
+    assert bm._find_existing_buffer(BlockId("testfile", 0)) is buffs[0]
+
+
+def wait_for_waiters(bm: BufferMgr, n: int) -> None:
+    while len(bm.waiters) < n:
+        time.sleep(0.001)
+
+
+def test_unpin_wakes_waiter(tmp_path):
+    bm = make_bm(tmp_path, 1)
+    bm.MAX_TIME = 10000
+    buff = bm.pin(BlockId("testfile", 0))
+
+    result = []
+    t = threading.Thread(target=lambda: result.append(bm.pin(BlockId("testfile", 1))))
+    t.start()
+    wait_for_waiters(bm, 1)
+    bm.unpin(buff)
+    t.join(timeout=5)
+
+    assert result and result[0].block() == BlockId("testfile", 1)
+    assert not bm.waiters
+
+
+def test_waiters_are_served_in_fifo_order(tmp_path):
+    bm = make_bm(tmp_path, 1)
+    bm.MAX_TIME = 10000
+    buff = bm.pin(BlockId("testfile", 0))
+
+    order = []
+
+    def worker(blknum: int) -> None:
+        b = bm.pin(BlockId("testfile", blknum))
+        order.append(blknum)
+        bm.unpin(b)
+
+    threads = []
+    for i, blknum in enumerate((1, 2, 3)):
+        t = threading.Thread(target=worker, args=(blknum,))
+        t.start()
+        threads.append(t)
+        wait_for_waiters(bm, i + 1)
+
+    bm.unpin(buff)
+    for t in threads:
+        t.join(timeout=5)
+
+    assert order == [1, 2, 3]
+
+
+def test_miss_does_not_block_hits(tmp_path):
+    bm = make_bm(tmp_path, 4)
+    for _ in range(3):
+        bm.fm.append("testfile")
+    dirty(bm, 0, 10)
+    bm.unpin(bm.pin(BlockId("testfile", 1)))
+
+    release = threading.Event()
+    reading = threading.Event()
+    read = bm.fm.read
+
+    def slow_read(blk, p):
+        if blk.blknum == 2:
+            reading.set()
+            release.wait(5)
+        read(blk, p)
+
+    bm.fm.read = slow_read
+    t = threading.Thread(target=lambda: bm.pin(BlockId("testfile", 2)))
+    result = []
+    t.start()
+    reading.wait(5)
+    # 読み込み中でもロックは空いているので、プールにあるブロックはすぐピンできる
+    start = time.monotonic()
+    buff = bm.pin(BlockId("testfile", 1))
+    result.append(time.monotonic() - start)
+    bm.unpin(buff)
+    release.set()
+    t.join(5)
+
+    assert result[0] < 1
+    assert bm._find_existing_buffer(BlockId("testfile", 2)).contents.get_int(0) == 0
+
+
+def test_evicted_dirty_page_is_written_before_reload(tmp_path):
+    bm = make_bm(tmp_path, 1)
+    for _ in range(2):
+        bm.fm.append("testfile")
+    dirty(bm, 0, 42)
+    bm.unpin(bm.pin(BlockId("testfile", 1)))  # 0を追い出す
+    assert read_int(bm, 0) == 42
+    buff = bm.pin(BlockId("testfile", 0))
+    assert buff.contents.get_int(0) == 42
+
+
+@pytest.mark.parametrize("readahead_async", [False, True])
+def test_sequential_scan_reads_ahead(tmp_path, readahead_async):
+    bm = make_bm(tmp_path, 16, readahead=8, readahead_async=readahead_async)
+    for n in range(32):
+        blk = bm.fm.append("testfile")
+        p = bm.bufferpool[0].contents
+        p.set_int(0, n)
+        bm.fm.write(blk, p)
+
+    single_reads = []
+    read = bm.fm.read
+    bm.fm.read = lambda blk, p: (single_reads.append(blk), read(blk, p))
+
+    for n in range(32):
+        buff = bm.pin(BlockId("testfile", n))
+        assert buff.contents.get_int(0) == n
+        bm.unpin(buff)
+
+    assert len(single_reads) < 32
+
+
+@pytest.mark.parametrize("policy", ["lru", "clock", "lru-k"])
+def test_prefetched_frames_can_be_evicted(tmp_path, policy):
+    bm = make_bm(tmp_path, 4, policy, readahead=3)
+    for _ in range(8):
+        bm.fm.append("testfile")
+    for n in (0, 1):  # 2番目で順次アクセスとみなして先読みする
+        bm.unpin(bm.pin(BlockId("testfile", n)))
+    assert len(bm.buffer_table) == 4
+
+    buffs = [bm.pin(BlockId("testfile", n)) for n in (5, 6, 7)]
+    assert [b.block().blknum for b in buffs] == [5, 6, 7]
+    assert bm.available() == 1
+
+
+def test_random_access_does_not_read_ahead(tmp_path):
+    bm = make_bm(tmp_path, 8, readahead=4)
+    for _ in range(8):
+        bm.fm.append("testfile")
+    for n in (5, 1, 7, 3):
+        bm.unpin(bm.pin(BlockId("testfile", n)))
+    assert len(bm.buffer_table) == 4
+
+
+def test_mmap_buffer_flushes_log_before_page(tmp_path):
+    fm = MMapFileMgr(str(tmp_path / "buffertest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 1)
+    fm.append("testfile")
+    fm.append("testfile")
+
+    events = []
+    flush, write = lm.flush, fm.write
+    lm.flush = lambda lsn: (events.append("log"), flush(lsn))
+    fm.write = lambda blk, p: (events.append(blk.filename), write(blk, p))
+
+    buff = bm.pin(BlockId("testfile", 0))
+    buff.contents.set_int(0, 123)
+    buff.set_modified(1, lm.append(b"update"))
+    bm.unpin(buff)
+    bm.unpin(bm.pin(BlockId("testfile", 1)))  # 追い出して書き戻させる
+
+    assert events.index("log") < events.index("testfile")
+    assert fm.page(BlockId("testfile", 0)).get_int(0) == 123
+
+
+def dirty(bm: BufferMgr, blknum: int, val: int, unpin: bool = True):
+    buff = bm.pin(BlockId("testfile", blknum))
+    buff.contents.set_int(0, val)
+    buff.set_modified(1, bm.lm.append(b"update"))
+    if unpin:
+        bm.unpin(buff)
+    return buff
+
+
+def read_int(bm: BufferMgr, blknum: int) -> int:
+    p = Page(bm.fm.block_size())
+    bm.fm.read(BlockId("testfile", blknum), p)
+    return p.get_int(0)
+
+
+def test_write_back_writes_unpinned_dirty_buffers_in_block_order(tmp_path):
+    bm = make_bm(tmp_path, 4)
+    for _ in range(4):
+        bm.fm.append("testfile")
+    dirty(bm, 2, 22)
+    dirty(bm, 0, 10)
+    pinned = dirty(bm, 1, 11, unpin=False)
+
+    written = []
+    write = bm.fm.write
+    bm.fm.write = lambda blk, p: (written.append(blk), write(blk, p))
+
+    assert bm.write_back() == 2
+    assert [b for b in written if b.filename == "testfile"] == [
+        BlockId("testfile", 0),
+        BlockId("testfile", 2),
+    ]
+    assert read_int(bm, 2) == 22
+    assert pinned.modifying_tx() == 1
+    assert all(not b.is_pinned() for b in bm.bufferpool if b is not pinned)
+    assert bm.available() == 3
+
+
+def test_write_back_flushes_log_up_to_page_lsn(tmp_path):
+    bm = make_bm(tmp_path, 4)
+    bm.fm.append("testfile")
+    bm.lm.flush(bm.lm.append(b"old"))
+    buff = dirty(bm, 0, 10)
+    assert bm.lm.last_saved_lsn < buff.lsn
+
+    assert bm.write_back() == 1
+    assert bm.lm.last_saved_lsn >= buff.lsn
+    assert read_int(bm, 0) == 10
+
+
+def test_flush_for_checkpoint_includes_pinned_buffers(tmp_path):
+    bm = make_bm(tmp_path, 4)
+    for _ in range(2):
+        bm.fm.append("testfile")
+    dirty(bm, 0, 10)
+    pin_lsn = bm.lm.latest_lsn
+    pinned = dirty(bm, 1, 11, unpin=False)
+
+    redo_lsn = bm.flush_for_checkpoint()
+    assert redo_lsn == pin_lsn
+    assert read_int(bm, 0) == 10
+    assert read_int(bm, 1) == 11
+    assert pinned.modifying_tx() == 1  # ピン中のものは汚れたまま
+    assert pinned.pins == 1
+
+
+def test_checkpoint_keeps_update_made_during_snapshot(tmp_path):
+    bm = make_bm(tmp_path, 1)
+    bm.fm.append("testfile")
+    pinned = dirty(bm, 0, 1, unpin=False)
+    page = pinned.contents
+    contents = page.contents
+
+    def copy_then_update():
+        # 写し取った直後にピンしているtxが書き換える
+        data = bytes(contents())
+        page.set_int(0, 2)
+        pinned.set_modified(1, bm.lm.append(b"update"))
+        return data
+
+    page.contents = copy_then_update
+    bm.flush_for_checkpoint()
+    del page.contents
+    assert read_int(bm, 0) == 1
+    assert pinned.modifying_tx() == 1
+    bm.unpin(pinned)
+
+    bm.pin(BlockId("testfile", 1))  # 追い出すと新しい内容が書き戻される
+    assert read_int(bm, 0) == 2
+
+
+def test_background_writer(tmp_path):
+    bm = make_bm(tmp_path, 4)
+    bm.fm.append("testfile")
+    dirty(bm, 0, 42)
+
+    writer = BackgroundWriter(bm, interval=0.01)
+    writer.start()
+    deadline = time.monotonic() + 5
+    while bm.bufferpool[0].modifying_tx() >= 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    writer.stop()
+
+    assert read_int(bm, 0) == 42
+
+
+def test_unknown_policy(tmp_path):
+    with pytest.raises(ValueError):
+        make_bm(tmp_path, 3, "mru")
+
+
+def test_lru_replacer():
+    r = LRUReplacer(4)
+    for frame in (2, 0, 3):
+        r.set_evictable(frame, True)
+    r.set_evictable(0, False)
+    assert r.size() == 2
+    assert r.victim() == 2
+    assert r.victim() == 3
+    assert r.victim() is None
+
+
+def test_clock_replacer_gives_second_chance():
+    r = ClockReplacer(3)
+    for frame in range(3):
+        r.record_access(frame)
+        r.set_evictable(frame, True)
+    assert r.victim() == 0  # 全フレームの参照ビットを落として一周する
+    r.record_access(1)
+    assert r.victim() == 2
+    assert r.victim() == 1
+    assert r.victim() is None
+
+
+def test_lru_k_replacer_prefers_single_access_frames():
+    r = LRUKReplacer(3)
+    r.record_access(0)
+    r.record_access(0)  # ホットなフレーム
+    r.record_access(1)
+    r.record_access(2)
+    for frame in range(3):
+        r.set_evictable(frame, True)
+    assert r.victim() == 1
+    assert r.victim() == 2
+    assert r.victim() == 0
+    assert r.victim() is None
+
+
+def test_lru_k_replacer_keeps_only_evictable_frames_queued():
+    r = LRUKReplacer(4)
+    for frame in range(4):
+        r.record_access(frame)
+        r.set_evictable(frame, True)
+    r.set_evictable(0, False)  # ピンされた
+    r.set_evictable(1, False)
+    assert r.size() == 2
+    assert len(r.history) == 2
+    assert r.victim() == 2
+    r.set_evictable(0, True)
+    assert r.victim() == 3
+    assert r.victim() == 0
+    assert r.victim() is None
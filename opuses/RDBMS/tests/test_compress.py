@@ -0,0 +1,248 @@
+import os
+import random
+
+import pytest
+
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.compress import Codec, CompressedCache, lz4_block
+from rdbms.storage.disk import BlockId, CompressedFileMgr, FileMgr, Page
+from rdbms.storage.metrics import metrics
+from rdbms.transaction import ConcurrencyMgr, LockTable
+
+
+def make_fm(tmp_path, blocksize: int = 4096) -> CompressedFileMgr:
+    return CompressedFileMgr(str(tmp_path / "compresstest"), blocksize)
+
+
+def record_page(n: int, blocksize: int = 4096) -> Page:
+    """先頭に少しだけレコードが入ったページ"""
+    p = Page(blocksize)
+    for i in range(20):
+        p.set_int(i * 8, n * 100 + i)
+        p.set_string(200 + i * 20, f"row{n}-{i}")
+    return p
+
+
+def test_round_trip_and_reopen(tmp_path):
+    fm = make_fm(tmp_path)
+    for n in range(10):
+        fm.write(BlockId("testfile", n), record_page(n))
+    fm.append("testfile")
+    assert fm.length("testfile") == 11
+    # 中身の少ないページはブロックサイズよりずっと小さく格納される
+    assert fm.stored_bytes("testfile") <= 10 * 1024
+    assert os.path.getsize(tmp_path / "compresstest" / "testfile") <= 10 * 1024
+    fm.close()
+
+    fm = make_fm(tmp_path)
+    assert fm.length("testfile") == 11
+    for n in range(10):
+        p = Page(4096)
+        fm.read(BlockId("testfile", n), p)
+        assert p.contents() == record_page(n).contents()
+    p = Page(4096)
+    p.set_int(0, 99)
+    fm.read(BlockId("testfile", 10), p)  # 一度も書いていないブロック
+    assert p.contents() == bytes(4096)
+    fm.close()
+
+
+def test_growing_block_is_moved_and_incompressible_block_stored_raw(tmp_path):
+    fm = make_fm(tmp_path)
+    blk = BlockId("testfile", 0)
+    fm.write(blk, record_page(0))
+    fm.write(BlockId("testfile", 1), record_page(1))
+    first = fm.maps["testfile"][0]
+
+    noise = Page(random.Random(0).randbytes(4096))
+    fm.write(blk, noise)
+    offset, stored, cap = fm.maps["testfile"][0]
+    assert stored == 4096 and cap > first[2]
+
+    fm.write(blk, record_page(2))  # 今の版の領域は上書きしない
+    assert fm.maps["testfile"][0][0] != offset
+    p = Page(4096)
+    fm.read(blk, p)
+    assert p.contents() == record_page(2).contents()
+    fm.close()
+
+
+def test_unsynced_rewrite_leaves_previous_version_on_disk(tmp_path):
+    fm = make_fm(tmp_path)
+    blk = BlockId("testfile", 0)
+    fm.write(blk, record_page(1))
+    fm.sync("testfile")
+    fm.write(blk, record_page(2))
+
+    # 同期する前に落ちた: ディスク上の対応表は前の版を正しく指している
+    crashed = make_fm(tmp_path)
+    p = Page(4096)
+    crashed.read(blk, p)
+    assert p.contents() == record_page(1).contents()
+    # 対応表から指されていない新しい版の領域は使っていないことになる
+    assert crashed.stored_bytes("testfile") == crashed.maps["testfile"][0][2]
+    crashed.close()
+
+    fm.sync("testfile")
+    reopened = make_fm(tmp_path)
+    reopened.read(blk, p)
+    assert p.contents() == record_page(2).contents()
+    reopened.close()
+    fm.close()
+
+
+@pytest.mark.parametrize("durability", ["deferred", "fdatasync", "none"])
+def test_released_space_is_reused(tmp_path, durability):
+    fm = CompressedFileMgr(str(tmp_path / "compresstest"), 4096, durability=durability)
+    blk = BlockId("testfile", 0)
+    for n in range(20):
+        fm.write(blk, record_page(n))
+        fm.sync("testfile")
+    # 前の版の領域を使い回すので、書き直しても2つ分より大きくならない
+    assert fm.stored_bytes("testfile") <= 2 * fm.maps["testfile"][0][2]
+    p = Page(4096)
+    fm.read(blk, p)
+    assert p.contents() == record_page(19).contents()
+    fm.close()
+
+
+def test_holes_are_free_after_reopen(tmp_path):
+    fm = make_fm(tmp_path)
+    for n in range(2):
+        fm.write(BlockId("testfile", n), record_page(n))
+    fm.write(BlockId("testfile", 0), record_page(2))
+    fm.sync("testfile")
+    hole = fm.free_bytes("testfile")
+    assert hole > 0
+    fm.close()
+
+    fm = make_fm(tmp_path)
+    assert fm.free_bytes("testfile") == hole
+    fm.write(BlockId("testfile", 1), record_page(3))
+    assert fm.maps["testfile"][1][0] == 0  # 先頭の穴を使う
+    p = Page(4096)
+    fm.read(BlockId("testfile", 0), p)
+    assert p.contents() == record_page(2).contents()
+    fm.close()
+
+
+def test_read_many_and_rename_carry_the_map(tmp_path):
+    fm = make_fm(tmp_path)
+    blks = [BlockId("seg.1", n) for n in range(4)]
+    for n, blk in enumerate(blks):
+        fm.write(blk, record_page(n))
+    fm.rename("seg.1", "seg.2")
+    assert fm.list_files("seg") == ["seg.2"]
+    pages = [Page(4096) for _ in blks]
+    fm.read_many([BlockId("seg.2", n) for n in range(4)], pages)
+    assert [p.contents() for p in pages] == [
+        record_page(n).contents() for n in range(4)
+    ]
+
+    fm.remove("seg.2")
+    assert fm.length("seg.2") == 0
+    fm.close()
+
+
+def test_transactions_recover_on_compressed_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+    db = SimpleDB(str(tmp_path / "compresstest"), 4096, 8, compression="zlib")
+    blk = BlockId("testfile", 0)
+    tx = db.new_tx()
+    tx.pin(blk)
+    tx.set_int(blk, 0, 1, True)
+    tx.set_string(blk, 100, "committed", True)
+    tx.commit()
+    tx = db.new_tx()
+    tx.pin(blk)
+    tx.set_int(blk, 0, 2, True)
+    db.bm.flush_all(tx.txnum)
+    db.lm.flush(db.lm.latest_lsn)
+    db.fm.close()  # 終わっていない変更がディスクにある状態で落ちる
+
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+    db = SimpleDB(str(tmp_path / "compresstest"), 4096, 8, compression="zlib")
+    tx = db.new_tx(read_only=True)
+    tx.pin(blk)
+    assert tx.get_int(blk, 0) == 1
+    assert tx.get_string(blk, 100) == "committed"
+    tx.commit()
+    db.close()
+
+
+def test_compressed_cache_evicts_least_recently_used():
+    page = bytes(record_page(0).contents())
+    size = len(Codec().compress(page))
+    cache = CompressedCache(capacity=size * 2)
+    cache.put("a", page)
+    cache.put("b", page)
+    cache.put("c", page)
+    assert len(cache) == 2 and cache.size <= cache.capacity
+
+    out = bytearray(4096)
+    assert not cache.get("a", out)
+    assert cache.get("b", out) and out == page
+    cache.put("d", page)  # bは今使ったのでcが追い出される
+    assert cache.touch("b") and not cache.touch("c")
+
+
+def test_evicted_pages_reload_from_compressed_cache(tmp_path):
+    fm = FileMgr(str(tmp_path / "compresstest"), 4096)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 2, compressed_cache=1 << 20)
+    blks = [fm.append("testfile") for _ in range(6)]
+    for n, blk in enumerate(blks):
+        buff = bm.pin(blk)
+        buff.contents.set_int(0, n + 1)
+        buff.set_modified(1, -1)
+        bm.unpin(buff)
+
+    reads = []
+    read = fm.read
+    fm.read = lambda blk, p: (reads.append(blk), read(blk, p))
+    metrics.reset()
+    metrics.enable()
+    try:
+        for n, blk in enumerate(blks[:4]):
+            buff = bm.pin(blk)
+            assert buff.contents.get_int(0) == n + 1
+            bm.unpin(buff)
+    finally:
+        metrics.disable()
+    assert reads == []
+    assert metrics.snapshot()["counters"]["ccache_hits"] == 4
+    metrics.reset()
+    # 追い出す前に書き戻しているのでディスクの内容も同じ
+    p = Page(4096)
+    read(blks[0], p)
+    assert p.get_int(0) == 1
+    fm.close()
+
+
+def test_removed_file_is_dropped_from_compressed_cache(tmp_path):
+    fm = FileMgr(str(tmp_path / "compresstest"), 4096)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 2, compressed_cache=1 << 20)
+    blk = fm.append("temp1")
+    buff = bm.pin(blk)
+    buff.contents.set_int(0, 42)
+    buff.set_modified(1, -1)
+    bm.unpin(buff)
+    for n in range(2):  # 追い出して圧縮キャッシュに入れる
+        bm.unpin(bm.pin(fm.append("testfile")))
+    assert len(bm.ccache) == 1
+
+    fm.remove("temp1")
+    assert len(bm.ccache) == 0 and bm.ccache.size == 0
+    assert fm.append("temp1") == blk
+    buff = bm.pin(blk)
+    assert buff.contents.get_int(0) == 0
+    bm.unpin(buff)
+    fm.close()
+
+
+@pytest.mark.skipif(lz4_block is not None, reason="lz4 is installed")
+def test_lz4_codec_requires_lz4():
+    with pytest.raises(RuntimeError):
+        Codec("lz4")
@@ -1,4 +1,13 @@
-from rdbms.storage.disk import BlockId, Page
+import pickle
+import sys
+import threading
+from datetime import date
+
+import pytest
+
+from rdbms.storage.buffer import LogMgr
+from rdbms.storage.disk import BlockId, FileMgr, MappedPage, MMapFileMgr, Page
+from rdbms.transaction import CommitRecord, LogRecord
 
 
 def test_creation():
@@ -23,6 +32,58 @@ def test_equality():
     assert blk1 != blk4
 
 
+def test_block_id_is_immutable_and_cached():
+    blk = BlockId("student.tbl", 23)
+    with pytest.raises(AttributeError):
+        blk.blknum = 24
+    # 同じブロックは同じオブジェクトで、ハッシュは作成時に計算済み
+    assert BlockId("student.tbl", 23) is blk
+    assert hash(blk) == hash(("student.tbl", 23))
+    assert {blk: 1}[BlockId("student.tbl", 23)] == 1
+    # キャッシュから追い出されたあとでも等しい
+    other = object.__new__(BlockId)
+    object.__setattr__(other, "filename", "student.tbl")
+    object.__setattr__(other, "blknum", 23)
+    object.__setattr__(other, "_hash", hash(("student.tbl", 23)))
+    assert other is not blk and other == blk
+    assert pickle.loads(pickle.dumps(blk)) == blk
+
+
+def test_block_id_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(BlockId, "CACHE_SIZE", 8)
+    monkeypatch.setattr(BlockId, "_cache", {})
+    blks = [BlockId("bounded.tbl", n) for n in range(20)]
+    assert len(BlockId._cache) == 8
+    assert BlockId("bounded.tbl", 0) == blks[0]
+    assert BlockId("bounded.tbl", 19) is blks[19]
+
+
+def test_block_id_cache_is_thread_safe(monkeypatch):
+    monkeypatch.setattr(BlockId, "CACHE_SIZE", 64)
+    monkeypatch.setattr(BlockId, "_cache", {})
+    errors = []
+
+    def create(start: int) -> None:
+        try:
+            for n in range(start, start + 20000):
+                BlockId("threads.tbl", n % 20000)
+        except RuntimeError as e:
+            errors.append(e)
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # 追い出しの途中でスレッドを切り替えさせる
+    try:
+        threads = [threading.Thread(target=create, args=(i * 2500,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(BlockId._cache) <= 64
+
+
 def test_page_creation(page: Page):
     assert page.blocksize == 400
     assert len(page.bb) == 400
@@ -65,7 +126,226 @@ def test_multiple_values(page: Page):
     assert page.get_int(int_pos) == 99
 
 
+def test_typed_storage(page: Page):
+    page.set_long(0, -(2**40))
+    page.set_double(8, 3.25)
+    page.set_bool(16, True)
+    page.set_date(17, date(2024, 2, 29))
+    assert page.get_long(0) == -(2**40)
+    assert page.get_double(8) == 3.25
+    assert page.get_bool(16) is True
+    assert page.get_date(17) == date(2024, 2, 29)
+    # ビッグエンディアンで格納される
+    assert page.bb[0:8] == (-(2**40)).to_bytes(8, "big", signed=True)
+
+
+def test_array_storage(page: Page):
+    page.set_ints(0, [1, -2, 3])
+    assert page.get_ints(0, 3) == (1, -2, 3)
+    assert page.get_int(4) == -2
+    page.set_array(12, "d", [0.5, 1.5])
+    assert page.get_array(12, "d", 2) == (0.5, 1.5)
+    assert page.get_double(20) == 1.5
+
+
+def test_ndarray_view(page: Page):
+    np = pytest.importorskip("numpy")
+    page.set_ints(0, [1, 2, 3])
+    arr = page.ndarray(0, "i4", 3)
+    assert np.array_equal(arr, [1, 2, 3])
+    arr[1] = 20
+    assert page.get_int(4) == 20
+
+
 def test_max_length():
     # 文字列の最大長の計算が正しいか
     assert Page.max_length(10) == 14  # 4バイト（長さ用）+ 10バイト（ASCII文字）
     assert Page.max_length(0) == 4  # 空文字列
+
+
+@pytest.mark.parametrize("durability", ["none", "fdatasync", "deferred"])
+def test_file_write_and_read(tmp_path, durability):
+    fm = FileMgr(str(tmp_path / "filetest"), 400, durability=durability)
+    blk = fm.append("testfile")
+    fm.append("testfile")
+
+    p1 = Page(400)
+    p1.set_string(88, "abcdefghijklm")
+    p1.set_int(200, 345)
+    fm.write(blk, p1)
+
+    p2 = Page(400)
+    fm.read(blk, p2)
+    assert p2.get_string(88) == "abcdefghijklm"
+    assert p2.get_int(200) == 345
+    assert fm.length("testfile") == 2
+
+
+def test_file_length_survives_reopen(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 400)
+    for _ in range(3):
+        fm.append("testfile")
+    fm.close()
+
+    fm = FileMgr(str(tmp_path / "filetest"), 400)
+    assert not fm.is_new
+    assert fm.length("testfile") == 3
+
+
+def test_deferred_writes_are_synced_on_demand(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 400, durability="deferred")
+    fm.write(BlockId("testfile", 0), Page(400))
+    assert fm.dirty == {"testfile"}
+    fm.sync_all()
+    assert not fm.dirty
+
+
+def test_preallocation(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 400, prealloc_blocks=8)
+    for _ in range(3):
+        fm.append("testfile")
+    path = tmp_path / "filetest" / "testfile"
+    assert fm.length("testfile") == 3
+    assert path.stat().st_size == 3 * 400
+    assert fm.allocated["testfile"] in (3, 8)  # fallocateを使えなければ3
+
+    fm.close()
+    assert path.stat().st_size == 3 * 400
+
+
+def test_preallocated_log_reopens_without_close(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 400, prealloc_blocks=8)
+    lm = LogMgr(fm, "logfile")
+    for n in range(3):
+        lm.append(CommitRecord(n))
+    lm.flush(lm.latest_lsn)
+    fm.append("testfile")
+
+    # close()せずに止まった後で開き直す
+    fm2 = FileMgr(str(tmp_path / "filetest"), 400, prealloc_blocks=8)
+    assert fm2.length("testfile") == 1
+    lm2 = LogMgr(fm2, "logfile")
+    assert lm2.latest_lsn == lm.latest_lsn
+    it = lm2.iterator()
+    assert [LogRecord.create_log_record(rec) for rec in it] == [
+        CommitRecord(n) for n in (2, 1, 0)
+    ]
+
+
+def test_direct_io(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 4096, direct_io=True)
+    blk = fm.append("testfile")
+    p1 = Page(4096)
+    p1.set_string(100, "direct")
+    fm.write(blk, p1)
+
+    p2 = Page(4096)
+    fm.read(blk, p2)
+    assert p2.get_string(100) == "direct"
+
+
+def test_invalid_file_mgr_options(tmp_path):
+    with pytest.raises(ValueError):
+        FileMgr(str(tmp_path / "filetest"), 400, durability="always")
+    with pytest.raises(ValueError):
+        FileMgr(str(tmp_path / "filetest"), 400, direct_io=True)
+
+
+def test_concurrent_appends_and_positional_io(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 400, durability="none")
+    nthreads, nblocks = 4, 50
+    blks = []
+
+    def worker(i: int) -> None:
+        for _ in range(nblocks):
+            blk = fm.append("testfile")
+            blks.append(blk)
+            p = Page(400)
+            p.set_int(0, blk.blknum)
+            fm.write(blk, p)
+            fm.read(blk, p)
+            assert p.get_int(0) == blk.blknum
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(set(blks)) == nthreads * nblocks
+    assert fm.length("testfile") == nthreads * nblocks
+    p = Page(400)
+    for blk in blks:
+        fm.read(blk, p)
+        assert p.get_int(0) == blk.blknum
+
+
+def test_read_many(tmp_path):
+    fm = FileMgr(str(tmp_path / "filetest"), 400, durability="none")
+    blks = []
+    for filename in ("a.tbl", "b.tbl"):
+        for n in range(4):
+            blk = fm.append(filename)
+            p = Page(400)
+            p.set_string(0, str(blk))
+            fm.write(blk, p)
+            blks.append(blk)
+
+    # 順不同・飛び飛びでも対応するページに読み込まれる
+    wanted = [blks[5], blks[0], blks[1], blks[3], blks[4]]
+    pages = [Page(400) for _ in wanted]
+    fm.read_many(wanted, pages)
+    assert [p.get_string(0) for p in pages] == [str(blk) for blk in wanted]
+
+
+def test_mmap_page_is_zero_copy(tmp_path):
+    fm = MMapFileMgr(str(tmp_path / "filetest"), 400, chunk_blocks=4)
+    blks = [fm.append("testfile") for _ in range(6)]
+    p = Page(400)
+    p.set_string(0, "mapped")
+    fm.write(blks[5], p)
+
+    mp = fm.page(blks[5])
+    assert isinstance(mp, MappedPage) and mp.is_mapped()
+    assert mp.get_string(0) == "mapped"
+
+    # pwriteした内容はマッピングからもそのまま見える
+    p.set_string(0, "updated")
+    fm.write(blks[5], p)
+    assert mp.get_string(0) == "updated"
+    fm.close()
+
+
+def test_mapped_page_copies_on_write(tmp_path):
+    fm = MMapFileMgr(str(tmp_path / "filetest"), 400)
+    blk = fm.append("testfile")
+    mp = fm.page(blk)
+    mp.set_int(0, 42)
+    assert not mp.is_mapped()
+    assert fm.page(blk).get_int(0) == 0
+
+    fm.write(blk, mp)
+    assert fm.page(blk).get_int(0) == 42
+    fm.close()
+
+
+def test_mapped_page_typed_setters_copy_on_write(tmp_path):
+    fm = MMapFileMgr(str(tmp_path / "filetest"), 400)
+    blk = fm.append("testfile")
+    for set_value in (
+        lambda mp: mp.set_long(0, 7),
+        lambda mp: mp.set_double(0, 1.0),
+        lambda mp: mp.set_bool(0, True),
+        lambda mp: mp.set_ints(0, [1, 2]),
+    ):
+        mp = fm.page(blk)
+        set_value(mp)
+        assert not mp.is_mapped()
+        assert fm.page(blk).get_long(0) == 0
+    fm.close()
+
+
+def test_mmap_page_outside_file_is_empty(tmp_path):
+    fm = MMapFileMgr(str(tmp_path / "filetest"), 400)
+    p = fm.page(BlockId("testfile", 3))
+    assert p.get_int(0) == 0
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from rdbms.executor import RetryLimitExceeded, TxExecutor
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.disk import BlockId
+from rdbms.transaction import ConcurrencyMgr, LockAbortException, LockTable, Transaction
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+    db = SimpleDB(str(tmp_path / "exectest"), 400, 16)
+    yield db
+    db.close()
+
+
+def increment(tx: Transaction, blk: BlockId, pause: float = 0.0) -> int:
+    """読んでから書くので、同時に走るとSロックからの格上げでデッドロックする"""
+    tx.pin(blk)
+    val = tx.get_int(blk, 0) + 1
+    time.sleep(pause)  # 他のトランザクションにもSロックを取らせる
+    tx.set_int(blk, 0, val, True)
+    return val
+
+
+def test_tx_numbers_are_unique_across_threads(db):
+    numbers = []
+    lock = threading.Lock()
+
+    def worker() -> None:
+        for _ in range(200):
+            tx = db.new_tx()
+            with lock:
+                numbers.append(tx.txnum)
+            tx.commit()
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(set(numbers)) == len(numbers) == 1600
+    assert not set(numbers) & set(Transaction.active_tx_numbers())
+
+
+def test_concurrent_increments_retry_until_committed(db):
+    blk = BlockId("counter", 0)
+    with TxExecutor(db, workers=8, backoff=0.0005) as ex:
+        futures = [ex.submit(increment, blk, 0.001) for _ in range(200)]
+        values = sorted(f.result() for f in futures)
+    assert values == list(range(1, 201))
+    assert ex.committed == 200
+    assert ex.retried > 0
+    assert ex.failed == 0
+
+    tx = db.new_tx(read_only=True)
+    tx.pin(blk)
+    assert tx.get_int(blk, 0) == 200
+    tx.commit()
+
+
+def test_gives_up_after_max_retries(db):
+    calls = []
+
+    def always_aborts(tx: Transaction) -> None:
+        calls.append(tx.txnum)
+        raise LockAbortException("busy")
+
+    ex = TxExecutor(db, max_retries=3, backoff=0)
+    with pytest.raises(RetryLimitExceeded) as info:
+        ex.run(always_aborts)
+    ex.shutdown()
+    assert isinstance(info.value.__cause__, LockAbortException)
+    assert len(calls) == 4
+    assert (ex.retried, ex.failed) == (3, 1)
+    assert not set(calls) & set(ex.active_tx_numbers())
+
+
+def test_other_errors_roll_back_without_retry(db):
+    blk = BlockId("counter", 0)
+
+    def fails(tx: Transaction) -> None:
+        increment(tx, blk)
+        raise ValueError("bad input")
+
+    with TxExecutor(db) as ex:
+        with pytest.raises(ValueError):
+            ex.submit(fails).result()
+        assert ex.run(increment, blk) == 1
+    assert (ex.committed, ex.retried, ex.failed) == (1, 0, 1)
+
+
+def test_failed_commit_rolls_back(db, monkeypatch):
+    blk = BlockId("counter", 0)
+    group_flush = db.lm.group_flush
+
+    def broken_flush(lsn: int) -> None:
+        monkeypatch.setattr(db.lm, "group_flush", group_flush)
+        raise OSError("log device failed")
+
+    monkeypatch.setattr(db.lm, "group_flush", broken_flush)
+    with TxExecutor(db) as ex:
+        before = ex.active_tx_numbers()
+        with pytest.raises(OSError):
+            ex.run(increment, blk)
+        assert ex.active_tx_numbers() == before
+        # ロックが外れているので次のトランザクションは待たずに書ける
+        assert ex.run(increment, blk) == 1
+    assert (ex.committed, ex.retried, ex.failed) == (1, 0, 1)
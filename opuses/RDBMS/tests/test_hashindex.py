@@ -0,0 +1,121 @@
+import random
+
+import pytest
+
+from rdbms.hashindex import HashIndex
+from rdbms.record import RID
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.disk import FileMgr
+from rdbms.transaction import ConcurrencyMgr, LockTable, Transaction
+
+
+@pytest.fixture(autouse=True)
+def locktbl(monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+
+
+def open_db(path) -> tuple[FileMgr, LogMgr, BufferMgr]:
+    # 1ページ7エントリにしてあふれと分割をたくさん起こす
+    fm = FileMgr(str(path / "hashtest"), 100)
+    lm = LogMgr(fm, "logfile")
+    return fm, lm, BufferMgr(fm, lm, 16)
+
+
+def test_insert_search_delete(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = HashIndex(tx, "idx")
+    rng = random.Random(2)
+    keys = [rng.randrange(300) for _ in range(600)]
+    for i, key in enumerate(keys):
+        idx.insert(key, RID(i, 0))
+    # バケットは少しずつ増え、先頭ページはバケット数+メタデータだけ
+    assert idx.num_buckets() > 4
+    assert fm.length("idx.hash") == idx.num_buckets() + 1
+
+    for key in (0, 17, 299, 1000):
+        assert sorted(idx.search(key)) == [
+            RID(i, 0) for i, k in enumerate(keys) if k == key
+        ]
+    for i, key in enumerate(keys):
+        if i % 3 == 0:
+            assert idx.delete(key, RID(i, 0))
+    assert not idx.delete(keys[0], RID(0, 0))
+    for key in set(keys):
+        assert sorted(idx.search(key)) == [
+            RID(i, 0) for i, k in enumerate(keys) if k == key and i % 3 != 0
+        ]
+    tx.commit()
+
+
+def test_rollback_undoes_splits(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    HashIndex(tx, "idx").insert(1, RID(1, 1))
+    tx.commit()
+
+    tx = Transaction(fm, lm, bm)
+    idx = HashIndex(tx, "idx")
+    for key in range(200):
+        idx.insert(key, RID(key, 0))
+    assert idx.num_buckets() > 4
+    tx.rollback()
+
+    tx = Transaction(fm, lm, bm)
+    idx = HashIndex(tx, "idx")
+    assert idx.num_buckets() == 4
+    assert idx.search(1) == [RID(1, 1)]
+    assert idx.search(2) == []
+    # ロールバックで残ったバケットのブロックを使い直して分割できる
+    for key in range(200):
+        idx.insert(key, RID(key, 0))
+    assert all(idx.search(key) == [RID(key, 0)] for key in range(2, 200))
+    assert sorted(idx.search(1)) == [RID(1, 0), RID(1, 1)]
+    assert fm.length("idx.hash") == idx.num_buckets() + 1
+    tx.commit()
+
+
+def test_index_created_by_rolled_back_tx_is_recreated(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    HashIndex(tx, "idx").insert(1, RID(1, 1))
+    tx.rollback()
+
+    tx = Transaction(fm, lm, bm)
+    idx = HashIndex(tx, "idx")
+    assert idx.num_buckets() == 4
+    assert idx.search(1) == []
+    idx.insert(1, RID(1, 2))
+    assert idx.search(1) == [RID(1, 2)]
+    tx.commit()
+
+
+def test_recovery_redoes_committed_index_changes(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = HashIndex(tx, "idx")
+    for key in range(100):
+        idx.insert(key, RID(key, 0))
+    tx.commit()
+    fm.close()  # バッファを書き出さずにクラッシュ
+
+    fm, lm, bm = open_db(tmp_path)
+    ConcurrencyMgr.locktbl = LockTable()
+    tx = Transaction(fm, lm, bm)
+    tx.recover()
+    idx = HashIndex(tx, "idx")
+    assert all(idx.search(key) == [RID(key, 0)] for key in range(100))
+    tx.commit()
+
+
+def test_long_overflow_chain_of_one_key(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    tx = Transaction(fm, lm, bm)
+    idx = HashIndex(tx, "idx")
+    # 1つのキーのあふれページがバッファプールより長くなっても扱える
+    for i in range(300):
+        idx.insert(7, RID(i, 0))
+    assert fm.length("idx.ovf") > 16
+    assert sorted(idx.search(7)) == [RID(i, 0) for i in range(300)]
+    assert idx.delete(7, RID(299, 0))
+    tx.commit()
@@ -0,0 +1,306 @@
+import threading
+
+import pytest
+
+from rdbms.storage.buffer import LogIterator, LogMgr, read_names
+from rdbms.storage.codec import get_svarint, get_varint, put_svarint, put_varint
+from rdbms.storage.disk import BlockId, FileMgr, Page
+from rdbms.transaction import (
+    CheckpointRecord,
+    CommitRecord,
+    LogRecord,
+    SetIntRecord,
+    SetStringRecord,
+    StartRecord,
+)
+
+
+def make_lm(tmp_path, **kwargs) -> tuple[LogMgr, list[str]]:
+    fm = FileMgr(str(tmp_path / "logtest"), 400)
+    syncs = []
+    sync = fm.sync
+    lm = LogMgr(fm, "logfile", **kwargs)
+
+    def counting_sync(filename: str) -> None:
+        syncs.append(filename)
+        sync(filename)
+
+    fm.sync = counting_sync
+    return lm, syncs
+
+
+def test_flush_skips_already_saved_lsn(tmp_path):
+    lm, syncs = make_lm(tmp_path)
+    lsn = lm.append(b"record")
+    lm.flush(lsn)
+    lm.flush(lsn)
+    assert lm.last_saved_lsn == lsn
+    assert len(syncs) == 1
+
+
+def test_group_flush_without_group_commit_flushes_each_time(tmp_path):
+    lm, syncs = make_lm(tmp_path)
+    for i in range(3):
+        lm.group_flush(lm.append(b"commit"))
+    assert len(syncs) == 3
+
+
+def test_group_commit_batches_concurrent_commits(tmp_path):
+    lm, syncs = make_lm(tmp_path, group_commit=True, group_window=0.2)
+    nthreads = 8
+    barrier = threading.Barrier(nthreads)
+
+    def commit() -> None:
+        barrier.wait()
+        lm.group_flush(lm.append(b"commit"))
+
+    threads = [threading.Thread(target=commit) for _ in range(nthreads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+
+    assert lm.last_saved_lsn == lm.latest_lsn
+    assert len(syncs) < nthreads
+
+
+def test_group_commit_flushes_early_on_byte_threshold(tmp_path):
+    lm, syncs = make_lm(tmp_path, group_commit=True, group_window=10, group_bytes=8)
+    lsn = lm.append(b"a large commit record")
+    lm.group_flush(lsn)
+    assert lm.last_saved_lsn == lsn
+    assert len(syncs) == 1
+
+
+def test_varint_roundtrip():
+    buf = bytearray()
+    values = [0, 1, 127, 128, 300, 2**31, 2**40]
+    svalues = [0, -1, 1, -64, 64, -(2**31), 2**31 - 1]
+    for n in values:
+        put_varint(buf, n)
+    for n in svalues:
+        put_svarint(buf, n)
+    pos, decoded = 0, []
+    for _ in values:
+        n, pos = get_varint(buf, pos)
+        decoded.append(n)
+    for _ in svalues:
+        n, pos = get_svarint(buf, pos)
+        decoded.append(n)
+    assert decoded == values + svalues
+    assert pos == len(buf)
+
+
+def read_records(lm: LogMgr) -> list:
+    it = lm.iterator()
+    return [LogRecord.create_log_record(rec, it.names) for rec in it]
+
+
+def test_compact_records_roundtrip_with_interned_file_names(tmp_path):
+    lm, _ = make_lm(tmp_path)
+    recs = [
+        StartRecord(3),
+        SetIntRecord(3, 80, -1, 2**20, BlockId("student.tbl", 7)),
+        SetStringRecord(3, 20, "old", "new", BlockId("student.tbl", 7)),
+        SetIntRecord(3, 4, 0, 1, BlockId("dept.tbl", 0)),
+        CheckpointRecord(42, [3, 5]),
+        CommitRecord(3),
+    ]
+    for rec in recs:
+        lm.append(rec)
+    assert read_records(lm) == recs[::-1]
+    assert read_names(lm.logpage) == ["student.tbl", "dept.tbl"]
+
+    # ファイル名を繰り返さないので、4バイト整数で書くより小さい
+    assert len(recs[1].encode(lambda name: 0)) < 4 * 6
+
+
+def test_append_many_spans_blocks_and_reopens(tmp_path):
+    lm, syncs = make_lm(tmp_path)
+    recs = [SetIntRecord(1, i, i, i + 1, BlockId("testfile", i)) for i in range(100)]
+    lsn = lm.append_many(recs)
+    assert lsn == lm.latest_lsn
+    assert lm.current_blk.blknum > 0
+    lm.flush(lsn)
+
+    lm2 = LogMgr(lm.fm, "logfile")
+    lm2.append(SetIntRecord(2, 0, 0, 1, BlockId("testfile", 0)))
+    records = read_records(lm2)
+    assert records[0].tx_number() == 2
+    assert records[1:] == recs[::-1]
+
+
+def test_corrupted_block_is_detected_with_checksum(tmp_path):
+    lm, _ = make_lm(tmp_path, checksum=True)
+    lsn = lm.append(CommitRecord(1))
+    lm.flush(lsn)
+    assert read_records(lm) == [CommitRecord(1)]
+
+    p = Page(lm.fm.block_size())
+    lm.fm.read(lm.current_blk, p)
+    p.contents()[-1] ^= 0xFF
+    lm.fm.write(lm.current_blk, p)
+    with pytest.raises(RuntimeError):
+        LogIterator(lm, lm.current_gblk)
+
+
+def test_torn_tail_block_ends_the_log(tmp_path):
+    lm, _ = make_lm(tmp_path, checksum=True)
+    recs = [SetIntRecord(1, i, i, i + 1, BlockId("testfile", i)) for i in range(100)]
+    lsns = [lm.append(rec) for rec in recs]
+    lm.flush(lm.latest_lsn)
+    assert lm.current_gblk > 0
+    torn = lm.current_blk
+    tail_start = lm.current_gblk * lm.fm.block_size()
+    lm.append(CommitRecord(1))
+    lm.flush(lm.latest_lsn)
+
+    # 末尾のブロックを書き直している途中で止まった
+    p = Page(lm.fm.block_size())
+    lm.fm.read(torn, p)
+    p.contents()[-1] ^= 0xFF
+    lm.fm.write(torn, p)
+
+    lm2 = LogMgr(lm.fm, "logfile", checksum=True)
+    assert lm2.current_gblk == lm.current_gblk
+    kept = [rec for rec, lsn in zip(recs, lsns) if lsn <= tail_start]
+    assert read_records(lm2) == kept[::-1]
+    lm2.append(CommitRecord(2))
+    assert read_records(lm2)[0] == CommitRecord(2)
+
+
+def test_oversized_record_leaves_no_file_names(tmp_path):
+    lm, _ = make_lm(tmp_path)
+    lm.append(SetIntRecord(1, 0, 0, 1, BlockId("testfile", 0)))
+    with pytest.raises(ValueError):
+        lm.append(SetStringRecord(1, 0, "", "x" * 500, BlockId("bigfile", 0)))
+    assert "bigfile" not in lm.names
+    lm.append(SetIntRecord(1, 0, 1, 2, BlockId("otherfile", 0)))
+    lm.flush(lm.latest_lsn)
+    assert read_names(lm.logpage) == ["otherfile"]
+    assert read_records(lm)[0] == SetIntRecord(1, 0, 1, 2, BlockId("otherfile", 0))
+
+
+def fill(lm: LogMgr, n: int, txnum: int = 1) -> list:
+    recs = [SetIntRecord(txnum, i, i, i + 1, BlockId("testfile", i)) for i in range(n)]
+    lm.append_many(recs)
+    return recs
+
+
+def test_log_rotates_into_segments(tmp_path):
+    lm, _ = make_lm(tmp_path, segment_blocks=2)
+    recs = fill(lm, 200)
+    assert len(lm.segments) > 2
+    assert lm.fm.list_files("logfile.") == [lm.segment_name(s) for s in lm.segments]
+    assert lm.locate(lm.segments[1]) == BlockId(lm.segment_name(lm.segments[1]), 0)
+    assert read_records(lm) == recs[::-1]
+
+    lm2 = LogMgr(lm.fm, "logfile", segment_blocks=2)
+    assert lm2.latest_lsn == lm.latest_lsn
+    assert read_records(lm2) == recs[::-1]
+
+
+def test_truncate_recycles_old_segments(tmp_path):
+    lm, _ = make_lm(tmp_path, segment_blocks=2, recycle_segments=1)
+    fill(lm, 200)
+    keep = lm.latest_lsn
+    recs = fill(lm, 20, txnum=2)
+    nsegments = len(lm.segments)
+
+    removed = lm.truncate(keep)
+    assert removed > 0 and len(lm.segments) == nsegments - removed
+    assert lm.free_segments == lm.fm.list_files("logfile.recycle.")
+    assert len(lm.free_segments) == 1
+    records = read_records(lm)
+    assert records[: len(recs)] == recs[::-1]
+    assert all(rec.tx_number() == 2 for rec in records[: len(recs)])
+
+    # 使い回したファイルに残った古いブロックは再起動後に読まれない
+    fill(lm, 100, txnum=3)
+    assert lm.free_segments == []
+    lm.flush(lm.latest_lsn)
+    lm2 = LogMgr(lm.fm, "logfile", segment_blocks=2)
+    assert lm2.latest_lsn == lm.latest_lsn
+    assert read_records(lm2)[0].tx_number() == 3
+
+
+def test_forward_iterator_returns_records_oldest_first(tmp_path):
+    lm, _ = make_lm(tmp_path, segment_blocks=2)
+    recs = fill(lm, 200)
+    reads = []
+    read_many = lm.fm.read_many
+    lm.fm.read_many = lambda blks, pages: (
+        reads.append(len(blks)),
+        read_many(blks, pages),
+    )
+
+    it = lm.forward_iterator(readahead=4)
+    records, lsns = [], []
+    for rec in it:
+        assert isinstance(rec, memoryview)
+        records.append(LogRecord.create_log_record(rec, it.names))
+        lsns.append(it.lsn)
+    assert records == recs
+    assert lsns == sorted(lsns)
+    assert max(reads) == 4 and len(reads) < lm.current_gblk + 1
+
+    backward = lm.iterator()
+    next(backward)
+    assert lsns[-1] == backward.lsn
+
+
+def test_forward_iterator_range(tmp_path):
+    lm, _ = make_lm(tmp_path)
+    lsns = [lm.append(CommitRecord(n)) for n in range(100)]
+    it = lm.forward_iterator(start_lsn=lsns[10], end_lsn=lsns[20])
+    assert [LogRecord.create_log_record(r).tx_number() for r in it] == list(
+        range(10, 21)
+    )
+
+
+def test_forward_iterator_follows_new_records(tmp_path):
+    lm, _ = make_lm(tmp_path)
+    lm.flush(lm.append(CommitRecord(0)))
+    it = lm.forward_iterator(follow=True, timeout=5)
+    got = []
+
+    def consume() -> None:
+        for rec in it:
+            got.append(LogRecord.create_log_record(rec).tx_number())
+            if len(got) == 3:
+                break
+
+    t = threading.Thread(target=consume)
+    t.start()
+    for n in (1, 2):
+        lm.append(CommitRecord(n))
+        lm.flush(lm.latest_lsn)
+    t.join(timeout=5)
+    assert got == [0, 1, 2]
+
+    it.close()
+    assert list(it) == []
+    assert list(lm.forward_iterator(follow=True, timeout=0.01)) != []
+
+
+def test_forward_iterator_stops_before_empty_tail_block(tmp_path):
+    lm, _ = make_lm(tmp_path)
+    recs = []
+    while lm.current_gblk == 0:
+        recs.append(SetIntRecord(1, 0, 0, 1, BlockId("testfile", len(recs))))
+        lm.append(recs[-1])
+    # 新しいブロックの最初のレコードはフラッシュされずに落ちた
+    lm2 = LogMgr(lm.fm, "logfile")
+    assert lm2.latest_lsn == lm2.current_gblk * lm.fm.block_size()
+    for follow in (False, True):
+        got = []
+
+        def consume() -> None:
+            it = lm2.forward_iterator(follow=follow, timeout=0.05)
+            got.extend(LogRecord.create_log_record(r, it.names) for r in it)
+
+        t = threading.Thread(target=consume, daemon=True)
+        t.start()
+        t.join(timeout=5)
+        assert not t.is_alive()
+        assert got == recs[:-1]
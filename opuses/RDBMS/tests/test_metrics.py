@@ -0,0 +1,102 @@
+import pytest
+
+from rdbms.storage.buffer import BufferAbortException, BufferMgr, LogMgr
+from rdbms.storage.disk import BlockId, FileMgr
+from rdbms.storage.metrics import Metrics, metrics
+from rdbms.transaction import LockAbortException, LockTable
+
+
+@pytest.fixture
+def enabled():
+    metrics.reset()
+    metrics.enable()
+    yield metrics
+    metrics.disable()
+    metrics.reset()
+
+
+def test_disabled_metrics_record_nothing(tmp_path):
+    metrics.reset()
+    fm = FileMgr(str(tmp_path / "metricstest"), 400)
+    bm = BufferMgr(fm, LogMgr(fm, "logfile"), 2)
+    bm.unpin(bm.pin(BlockId("testfile", 0)))
+    assert all(v == 0 for v in metrics.snapshot()["counters"].values())
+
+
+def test_buffer_and_file_counters(tmp_path, enabled):
+    fm = FileMgr(str(tmp_path / "metricstest"), 400)
+    bm = BufferMgr(fm, LogMgr(fm, "logfile"), 2)
+    bm.MAX_TIME = 0
+    for n in (0, 0, 1, 2):  # 2つ目はヒット、ブロック2で0を追い出す
+        bm.unpin(bm.pin(BlockId("testfile", n)))
+    held = [bm.pin(BlockId("testfile", n)) for n in (1, 2)]
+    with pytest.raises(BufferAbortException):
+        bm.pin(BlockId("testfile", 3))
+    for buff in held:
+        bm.unpin(buff)
+
+    snap = enabled.snapshot()
+    c = snap["counters"]
+    assert c["buffer_hits"] == 3
+    assert c["buffer_misses"] == 3
+    assert c["buffer_evictions"] == 1
+    assert c["buffer_pin_aborts"] == 1
+    assert c["buffer_pin_waits"] == 1
+    assert c["file_blocks_read"] == 3
+    assert c["file_bytes_read"] == 3 * 400
+    assert snap["buffer_hit_ratio"] == 0.5
+    assert snap["histograms"]["file_read_seconds"]["count"] == 3
+
+
+def test_log_counters(tmp_path, enabled):
+    fm = FileMgr(str(tmp_path / "metricstest"), 400)
+    lm = LogMgr(fm, "logfile")
+    lsn = lm.append(b"x" * 10)
+    lm.append(b"y" * 20)
+    lm.flush(lsn)
+
+    c = enabled.snapshot()["counters"]
+    assert c["log_appends"] == 2
+    assert c["log_append_bytes"] >= 30
+    assert c["log_flushes"] == 1
+    assert c["file_syncs"] >= 1
+    flushed = enabled.snapshot()["histograms"]["log_flush_bytes"]
+    assert flushed["count"] == 1
+    assert flushed["sum"] == c["log_append_bytes"]
+
+
+def test_lock_counters(enabled):
+    lt = LockTable("timeout")
+    lt.MAX_TIME = 10
+    blk = BlockId("testfile", 1)
+    lt.x_lock(blk, 1)
+    with pytest.raises(LockAbortException):
+        lt.s_lock(blk, 2)
+
+    lt = LockTable("wait-die")
+    lt.x_lock(blk, 1)
+    with pytest.raises(LockAbortException):
+        lt.x_lock(blk, 2)
+
+    snap = enabled.snapshot()
+    assert snap["counters"]["lock_waits"] == 1
+    assert snap["counters"]["lock_timeouts"] == 1
+    assert snap["counters"]["lock_deadlocks"] == 1
+    assert snap["histograms"]["lock_wait_seconds"]["count"] == 1
+
+
+def test_prometheus_text():
+    m = Metrics(enabled=True)
+    m.inc("buffer_hits", 3)
+    m.inc("buffer_misses")
+    m.observe("lock_wait_seconds", 0.002)
+
+    text = m.to_prometheus()
+    assert "# TYPE rdbms_buffer_hits_total counter\n" in text
+    assert "rdbms_buffer_hits_total 3\n" in text
+    assert "# TYPE rdbms_lock_wait_seconds histogram\n" in text
+    assert 'rdbms_lock_wait_seconds_bucket{le="0.001"} 0\n' in text
+    assert 'rdbms_lock_wait_seconds_bucket{le="0.005"} 1\n' in text
+    assert 'rdbms_lock_wait_seconds_bucket{le="+Inf"} 1\n' in text
+    assert "rdbms_lock_wait_seconds_count 1\n" in text
+    assert "rdbms_buffer_hit_ratio 0.75\n" in text
@@ -0,0 +1,137 @@
+import pytest
+
+from rdbms.record import RID, FreeSpaceMap, Layout, RecordPage, Schema, TableScan
+from rdbms.storage.buffer import BufferMgr, LogMgr
+from rdbms.storage.disk import BlockId, FileMgr, Page
+from rdbms.transaction import ConcurrencyMgr, LockTable, Transaction
+
+
+@pytest.fixture(autouse=True)
+def isolated(monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+    monkeypatch.setattr(FreeSpaceMap, "maps", {})
+
+
+def open_db(path) -> tuple[FileMgr, LogMgr, BufferMgr]:
+    fm = FileMgr(str(path / "recordtest"), 400)
+    lm = LogMgr(fm, "logfile")
+    return fm, lm, BufferMgr(fm, lm, 8)
+
+
+def make_layout() -> Layout:
+    sch = Schema()
+    sch.add_int_field("A")
+    sch.add_string_field("B", 9)
+    return Layout(sch)
+
+
+def insert_rows(tx: Transaction, layout: Layout, n: int) -> list[RID]:
+    ts = TableScan(tx, "T", layout)
+    rids = []
+    for i in range(n):
+        rids.append(ts.insert())
+        ts.set_int("A", i)
+        ts.set_string("B", f"rec{i}")
+    ts.close()
+    return rids
+
+
+def read_rows(tx: Transaction, layout: Layout) -> dict[RID, tuple[int, str]]:
+    ts = TableScan(tx, "T", layout)
+    rows = {rid: (ts.get_int("A"), ts.get_string("B")) for rid in ts}
+    ts.close()
+    return rows
+
+
+def test_layout():
+    layout = make_layout()
+    assert layout.offset("A") == 0
+    assert layout.offset("B") == 4
+    assert layout.slotsize == 4 + Page.max_length(9)
+
+
+def test_insert_scan_update_delete(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    layout = make_layout()
+    tx = Transaction(fm, lm, bm)
+    rids = insert_rows(tx, layout, 50)
+    assert fm.length("T.tbl") > 1  # 複数ブロックにまたがる
+    assert read_rows(tx, layout) == {rid: (i, f"rec{i}") for i, rid in enumerate(rids)}
+
+    ts = TableScan(tx, "T", layout)
+    ts.move_to_rid(rids[10])
+    ts.set_int("A", -10)
+    ts.move_to_rid(rids[11])
+    ts.delete()
+    with pytest.raises(KeyError):
+        ts.move_to_rid(rids[11])
+    ts.close()
+    rows = read_rows(tx, layout)
+    assert rows[rids[10]] == (-10, "rec10")
+    assert rids[11] not in rows
+    assert len(rows) == 49
+    tx.commit()
+
+
+def test_insert_reuses_deleted_slot_via_free_space_map(tmp_path, monkeypatch):
+    fm, lm, bm = open_db(tmp_path)
+    layout = make_layout()
+    tx = Transaction(fm, lm, bm)
+    rids = insert_rows(tx, layout, 60)
+    nblocks = fm.length("T.tbl")
+    ts = TableScan(tx, "T", layout)
+    ts.move_to_rid(rids[3])
+    ts.delete()
+
+    # 空いたブロックはファイルを走査せずに見つかる
+    visited = []
+    move = TableScan._move_to_block
+
+    def spy(self, blknum):
+        visited.append(blknum)
+        move(self, blknum)
+
+    monkeypatch.setattr(TableScan, "_move_to_block", spy)
+    assert ts.insert() == rids[3]
+    assert visited == [rids[3].blknum]
+    assert fm.length("T.tbl") == nblocks
+    ts.close()
+    tx.commit()
+
+
+def test_free_space_map_is_built_from_existing_file(tmp_path, monkeypatch):
+    fm, lm, bm = open_db(tmp_path)
+    layout = make_layout()
+    tx = Transaction(fm, lm, bm)
+    rids = insert_rows(tx, layout, 40)
+    ts = TableScan(tx, "T", layout)
+    ts.move_to_rid(rids[0])
+    ts.delete()
+    ts.close()
+    tx.commit()
+    bm.flush_all(tx.txnum)
+
+    monkeypatch.setattr(FreeSpaceMap, "maps", {})
+    fsm = FreeSpaceMap.build(fm, bm, "T.tbl", layout)
+    # 1ブロック18レコードなので、削除したブロック0と最後のブロックに空きがある
+    assert fm.length("T.tbl") == 3
+    assert fsm.room == {0, 2}
+
+
+def test_rolled_back_insert_leaves_empty_page(tmp_path):
+    fm, lm, bm = open_db(tmp_path)
+    layout = make_layout()
+    tx = Transaction(fm, lm, bm)
+    insert_rows(tx, layout, 3)
+    tx.rollback()
+
+    tx = Transaction(fm, lm, bm)
+    assert read_rows(tx, layout) == {}
+    # ロールバックで0に戻ったページにもそのまま挿入できる
+    rids = insert_rows(tx, layout, 2)
+    assert rids == [RID(0, 0), RID(0, 1)]
+    blk = BlockId("T.tbl", 0)
+    tx.pin(blk)
+    assert RecordPage(tx, blk, make_layout()).num_slots() == 2
+    tx.unpin(blk)
+    tx.commit()
@@ -1,11 +1,458 @@
+import threading
+import time
 
-# 使用例
-def tx_test():
-    # この例はSimpleDBのインスタンスを作成し、
-    # 図5.3のテストコードと同様のトランザクションを実行します
+import pytest
 
-    # 簡単化のため、必要なコンポーネントが存在すると仮定
-    db = SimpleDB("txtest", 400, 8)
+from rdbms.simpledb import SimpleDB
+from rdbms.storage.buffer import Buffer, BufferMgr, LogMgr
+from rdbms.storage.disk import BlockId, FileMgr
+from rdbms.transaction import (
+    Checkpointer,
+    CheckpointRecord,
+    ConcurrencyMgr,
+    LockAbortException,
+    LockTable,
+    LogRecord,
+    SetIntRecord,
+    Transaction,
+)
+
+
+def test_checkpoint_record(tmp_path):
+    fm = FileMgr(str(tmp_path / "txtest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 8)
+    fm.append("testfile")
+    tx = Transaction(fm, lm, bm)
+
+    blk = BlockId("testfile", 0)
+    buff = bm.pin(blk)
+    buff.contents.set_int(0, 1)
+    update_lsn = SetIntRecord.write_to_log(lm, tx.txnum, blk, 0, 0, 1)
+    buff.set_modified(tx.txnum, update_lsn)
+    bm.unpin(buff)
+
+    lsn = Checkpointer(bm, lm).checkpoint()
+    assert lm.last_saved_lsn == lsn
+    assert buff.modifying_tx() == -1
+
+    it = lm.iterator()
+    rec = LogRecord.create_log_record(next(it))
+    assert isinstance(rec, CheckpointRecord)
+    assert it.lsn == lsn
+    assert rec.redo_lsn == update_lsn
+    assert tx.txnum in rec.active_txs
+    tx.rollback()
+    assert tx.txnum not in Transaction.active_tx_numbers()
+
+
+def test_checkpoint_lists_transactions_started_during_flush(
+    tmp_path, locktbl, monkeypatch
+):
+    fm = FileMgr(str(tmp_path / "txtest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 8)
+    blk = BlockId("testfile", 0)
+    started = []
+    flush = bm.flush_for_checkpoint
+
+    def start_tx_then_flush() -> int:
+        tx = Transaction(fm, lm, bm)
+        tx.pin(blk)
+        tx.set_int(blk, 0, 1, True)
+        tx.unpin(blk)
+        started.append(tx)
+        return flush()
+
+    monkeypatch.setattr(bm, "flush_for_checkpoint", start_tx_then_flush)
+    Checkpointer(bm, lm).checkpoint()
+    rec = LogRecord.create_log_record(next(lm.iterator()))
+    assert started[0].txnum in rec.active_txs
+    started[0].rollback()
+
+
+def run_in_thread(target) -> tuple[threading.Thread, list]:
+    result = []
+
+    def run():
+        try:
+            target()
+            result.append("ok")
+        except LockAbortException:
+            result.append("aborted")
+
+    t = threading.Thread(target=run)
+    t.start()
+    return t, result
+
+
+def wait_until_waiting(lt: LockTable, txnum: int) -> None:
+    while txnum not in lt.waiting_on:
+        time.sleep(0.001)
+
+
+def test_shared_locks_are_compatible():
+    lt = LockTable()
+    blk = BlockId("testfile", 1)
+    lt.s_lock(blk, 1)
+    lt.s_lock(blk, 2)
+    assert lt.locks[blk].holders == {1: "S", 2: "S"}
+    lt.unlock(blk, 1)
+    lt.unlock(blk, 2)
+    assert blk not in lt.locks
+
+
+def test_exclusive_lock_waits_for_shared_holders():
+    lt = LockTable()
+    blk = BlockId("testfile", 1)
+    lt.s_lock(blk, 1)
+    t, result = run_in_thread(lambda: lt.x_lock(blk, 2))
+    wait_until_waiting(lt, 2)
+    lt.unlock(blk, 1)
+    t.join(timeout=5)
+    assert result == ["ok"]
+    assert lt.locks[blk].holders == {2: "X"}
+
+
+def test_upgrade_shared_to_exclusive():
+    lt = LockTable()
+    blk = BlockId("testfile", 1)
+    lt.s_lock(blk, 1)
+    lt.x_lock(blk, 1)
+    assert lt.locks[blk].holders == {1: "X"}
+
+
+def test_lock_wait_times_out():
+    lt = LockTable("timeout")
+    lt.MAX_TIME = 50
+    blk = BlockId("testfile", 1)
+    lt.x_lock(blk, 1)
+    with pytest.raises(LockAbortException):
+        lt.s_lock(blk, 2)
+    assert lt.locks[blk].holders == {1: "X"}
+    assert not lt.locks[blk].waiting
+
+
+def test_deadlock_is_detected_immediately():
+    lt = LockTable("detect")
+    blk1, blk2 = BlockId("testfile", 1), BlockId("testfile", 2)
+    lt.x_lock(blk1, 1)
+    lt.x_lock(blk2, 2)
+    t, result = run_in_thread(lambda: lt.x_lock(blk2, 1))
+    wait_until_waiting(lt, 1)
+
+    start = time.monotonic()
+    with pytest.raises(LockAbortException):
+        lt.x_lock(blk1, 2)
+    assert time.monotonic() - start < 1
+
+    lt.unlock(blk2, 2)
+    t.join(timeout=5)
+    assert result == ["ok"]
+
+
+def test_wait_die_aborts_younger_requester():
+    lt = LockTable("wait-die")
+    blk = BlockId("testfile", 1)
+    lt.x_lock(blk, 1)
+    with pytest.raises(LockAbortException):
+        lt.x_lock(blk, 2)
+
+
+def test_wound_wait_aborts_younger_holder():
+    lt = LockTable("wound-wait")
+    blk1, blk2 = BlockId("testfile", 1), BlockId("testfile", 2)
+    lt.x_lock(blk1, 2)
+    lt.x_lock(blk2, 1)
+    t, result = run_in_thread(lambda: lt.x_lock(blk2, 2))  # 若い方が待つ
+    wait_until_waiting(lt, 2)
+
+    t1, result1 = run_in_thread(lambda: lt.x_lock(blk1, 1))  # 古い方が若い方を傷つける
+    t.join(timeout=5)
+    assert result == ["aborted"]
+
+    lt.unlock(blk1, 2)
+    lt.end(2)
+    t1.join(timeout=5)
+    assert result1 == ["ok"]
+
+
+def test_read_only_transactions_read_a_snapshot(tmp_path):
+    fm = FileMgr(str(tmp_path / "txtest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 8)
+    blk = BlockId("mvcctest", 1)
+
+    tx1 = Transaction(fm, lm, bm)
+    tx1.pin(blk)
+    tx1.set_int(blk, 80, 1, False)
+    tx1.commit()
+
+    r1 = Transaction(fm, lm, bm, read_only=True)
+    r1.pin(blk)
+    tx2 = Transaction(fm, lm, bm)
+    tx2.pin(blk)
+    tx2.set_int(blk, 80, 2, False)
+
+    # 書き込み中のXロックがあっても待たずに読める
+    assert r1.get_int(blk, 80) == 1
+    r2 = Transaction(fm, lm, bm, read_only=True)
+    r2.pin(blk)
+    assert r2.get_int(blk, 80) == 1
+
+    tx2.commit()
+    assert r1.get_int(blk, 80) == 1
+    r3 = Transaction(fm, lm, bm, read_only=True)
+    r3.pin(blk)
+    assert r3.get_int(blk, 80) == 2
+
+    for r in (r1, r2, r3):
+        r.commit()
+    assert blk not in Transaction.versions.chains
+
+
+def test_writes_without_snapshots_keep_only_undo(tmp_path):
+    fm = FileMgr(str(tmp_path / "txtest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 8)
+    blk, other = BlockId("mvcctest", 1), BlockId("mvcctest", 2)
+    versions = Transaction.versions
+
+    tx1 = Transaction(fm, lm, bm)
+    tx1.pin(blk)
+    tx1.pin(other)
+    tx1.set_int(blk, 80, 1, False)
+    tx1.set_string(other, 0, "old", False)
+    tx1.commit()
+
+    tx2 = Transaction(fm, lm, bm)
+    tx2.pin(blk)
+    tx2.pin(other)
+    tx2.set_int(blk, 80, 2, False)
+    tx2.set_int(blk, 80, 3, False)
+    tx2.set_string(other, 0, "new", False)
+    assert tx2.txnum not in versions.pending  # ページは写していない
+    tx2.unpin(other)  # pinを外すときにビフォーイメージを作る
+    assert other in versions.pending[tx2.txnum]
+
+    # 書き込み中に始まったスナップショットはundoから作った前の版を読む
+    r1 = Transaction(fm, lm, bm, read_only=True)
+    r1.pin(blk)
+    r1.pin(other)
+    assert r1.get_int(blk, 80) == 1
+    assert r1.get_string(other, 0) == "old"
+    tx2.set_int(blk, 80, 4, False)
+    tx2.commit()
+    assert r1.get_int(blk, 80) == 1
+    r1.commit()
+
+    r2 = Transaction(fm, lm, bm, read_only=True)
+    r2.pin(blk)
+    assert r2.get_int(blk, 80) == 4
+    r2.commit()
+    assert tx2.txnum not in versions.pending and blk not in versions.writers
+
+
+def test_read_only_transaction_cannot_write(tmp_path):
+    fm = FileMgr(str(tmp_path / "txtest"), 400)
+    lm = LogMgr(fm, "logfile")
+    bm = BufferMgr(fm, lm, 8)
+    tx = Transaction(fm, lm, bm, read_only=True)
+    blk = BlockId("mvcctest", 1)
+    tx.pin(blk)
+    with pytest.raises(RuntimeError):
+        tx.set_int(blk, 0, 1, False)
+    tx.rollback()
+
+
+def open_db(path) -> tuple[FileMgr, LogMgr, BufferMgr]:
+    fm = FileMgr(str(path / "recoverytest"), 400)
+    lm = LogMgr(fm, "logfile")
+    return fm, lm, BufferMgr(fm, lm, 8)
+
+
+def crash(fm: FileMgr) -> None:
+    """バッファを書き出さずにファイルだけ閉じる"""
+    fm.close()
+
+
+@pytest.fixture
+def locktbl(monkeypatch):
+    monkeypatch.setattr(ConcurrencyMgr, "locktbl", LockTable())
+
+
+def test_rollback_restores_before_images(tmp_path, locktbl):
+    fm, lm, bm = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+    tx = Transaction(fm, lm, bm)
+    tx.pin(blk)
+    tx.set_int(blk, 0, 7, True)
+    tx.set_string(blk, 20, "old", True)
+    tx.commit()
+
+    tx = Transaction(fm, lm, bm)
+    tx.pin(blk)
+    tx.set_int(blk, 0, 8, True)
+    tx.set_string(blk, 20, "new", True)
+    tx.rollback()
+
+    tx = Transaction(fm, lm, bm)
+    tx.pin(blk)
+    assert tx.get_int(blk, 0) == 7
+    assert tx.get_string(blk, 20) == "old"
+    tx.commit()
+
+
+def test_unlock_releases_only_unwritten_blocks(tmp_path, locktbl):
+    fm, lm, bm = open_db(tmp_path)
+    read_blk, write_blk = BlockId("testfile", 0), BlockId("testfile", 1)
+    tx = Transaction(fm, lm, bm)
+    for blk in (read_blk, write_blk):
+        tx.pin(blk)
+        tx.x_lock(blk)
+    tx.set_int(write_blk, 0, 1, True)
+    tx.unlock(read_blk)
+    tx.unlock(write_blk)
+    assert read_blk not in ConcurrencyMgr.locktbl.locks
+    assert ConcurrencyMgr.locktbl.locks[write_blk].holders == {tx.txnum: "X"}
+    tx.rollback()
+
+
+@pytest.mark.parametrize("checkpoint", [False, True])
+def test_recover_redoes_committed_and_undoes_unfinished(tmp_path, locktbl, checkpoint):
+    fm, lm, bm = open_db(tmp_path)
+    blks = [BlockId("testfile", n) for n in range(4)]
+
+    tx1 = Transaction(fm, lm, bm)
+    for n, blk in enumerate(blks):
+        tx1.pin(blk)
+        tx1.set_int(blk, 0, 100 + n, True)
+    tx1.commit()
+    if checkpoint:
+        Checkpointer(bm, lm).checkpoint()
+
+    tx2 = Transaction(fm, lm, bm)
+    tx3 = Transaction(fm, lm, bm)
+    for n, blk in enumerate(blks):
+        tx2.pin(blk)
+        tx2.set_string(blk, 40, f"committed{n}", True)
+    tx2.commit()
+    tx3.pin(blks[0])
+    tx3.set_int(blks[0], 0, -1, True)
+    bm.flush_all(tx3.txnum)  # 未コミットの変更がディスクに出てしまった
+    lm.flush(lm.latest_lsn)
+    crash(fm)
+
+    fm, lm, bm = open_db(tmp_path)
+    ConcurrencyMgr.locktbl = LockTable()
+    tx = Transaction(fm, lm, bm)
+    tx.recover()
+    rec = LogRecord.create_log_record(next(lm.iterator()))
+    assert isinstance(rec, CheckpointRecord) and rec.active_txs == []
+    for n, blk in enumerate(blks):
+        tx.pin(blk)
+        assert tx.get_int(blk, 0) == 100 + n
+        assert tx.get_string(blk, 40) == f"committed{n}"
+    tx.commit()
+
+
+@pytest.mark.parametrize("page_on_disk", [False, True])
+def test_recover_keeps_rolled_back_changes_undone(tmp_path, locktbl, page_on_disk):
+    fm, lm, bm = open_db(tmp_path)
+    blk = BlockId("testfile", 0)
+    tx = Transaction(fm, lm, bm)
+    tx.pin(blk)
+    tx.set_int(blk, 0, 1, True)
+    tx.commit()
+
+    tx = Transaction(fm, lm, bm)
+    tx.pin(blk)
+    tx.set_int(blk, 0, 2, True)
+    tx.set_string(blk, 20, "aborted", True)
+    if page_on_disk:
+        bm.flush_all(tx.txnum)  # 取り消す前の変更がディスクに出ている
+    tx.rollback()
+    crash(fm)
+
+    fm, lm, bm = open_db(tmp_path)
+    ConcurrencyMgr.locktbl = LockTable()
+    tx = Transaction(fm, lm, bm)
+    tx.recover()
+    tx.pin(blk)
+    assert tx.get_int(blk, 0) == 1
+    assert tx.get_string(blk, 20) == ""
+    tx.commit()
+
+
+def test_checkpoint_truncates_log_but_keeps_active_transactions(
+    tmp_path, locktbl, monkeypatch
+):
+    monkeypatch.setattr(Transaction, "_active_txs", {})
+    fm = FileMgr(str(tmp_path / "recoverytest"), 400)
+    lm = LogMgr(fm, "logfile", segment_blocks=2)
+    bm = BufferMgr(fm, lm, 8)
+    blk = BlockId("testfile", 0)
+
+    active = Transaction(fm, lm, bm)
+    active.pin(blk)
+    active.set_int(blk, 0, 5, True)
+    other = BlockId("testfile", 1)
+    for i in range(200):
+        tx = Transaction(fm, lm, bm)
+        tx.pin(other)
+        tx.set_int(other, 0, i, True)
+        tx.commit()
+    Checkpointer(bm, lm).checkpoint()
+    kept = len(lm.segments)
+    assert kept > 1
+    assert lm.first_block() == 0  # activeのSTARTが残っている
+
+    active.rollback()
+    tx = Transaction(fm, lm, bm)
+    tx.pin(blk)
+    assert tx.get_int(blk, 0) == 0
+    tx.commit()
+    Checkpointer(bm, lm).checkpoint()
+    assert lm.first_block() > 0
+    assert len(lm.segments) < kept
+
+
+def test_recover_redoes_blocks_in_parallel(tmp_path, locktbl, monkeypatch):
+    fm, lm, bm = open_db(tmp_path)
+    blks = [BlockId("testfile", n) for n in range(6)]
+    tx1 = Transaction(fm, lm, bm)
+    for n, blk in enumerate(blks):
+        tx1.pin(blk)
+        for i in range(5):
+            tx1.set_int(blk, 4 * i, n * 10 + i, True)
+    tx1.commit()
+    crash(fm)
+
+    fm, lm, bm = open_db(tmp_path)
+    ConcurrencyMgr.locktbl = LockTable()
+    threads = set()
+    set_modified = Buffer.set_modified
+
+    def record_thread(buff, txnum, lsn):
+        threads.add(threading.current_thread().name)
+        set_modified(buff, txnum, lsn)
+
+    monkeypatch.setattr(Buffer, "set_modified", record_thread)
+    tx = Transaction(fm, lm, bm)
+    tx.recovery_mgr.recover(workers=3)
+    monkeypatch.undo()
+    assert threads and all(name.startswith("redo") for name in threads)
+    for n, blk in enumerate(blks):
+        tx.pin(blk)
+        assert [tx.get_int(blk, 4 * i) for i in range(5)] == [
+            n * 10 + i for i in range(5)
+        ]
+    tx.commit()
+
+
+def test_simpledb_commit_and_rollback(tmp_path, locktbl):
+    # 図5.3のテストコードと同じ流れのトランザクションを実行する
+    db = SimpleDB(str(tmp_path / "txtest"), 400, 8)
     fm = db.file_mgr()
     lm = db.log_mgr()
     bm = db.buffer_mgr()
@@ -23,27 +470,46 @@ def tx_test():
     tx2.pin(blk)
     ival = tx2.get_int(blk, 80)
     sval = tx2.get_string(blk, 40)
-    print(f"initial value at location 80 = {ival}")
-    print(f"initial value at location 40 = {sval}")
-
-    newival = ival + 1
-    newsval = sval + "!"
-    tx2.set_int(blk, 80, newival, True)
-    tx2.set_string(blk, 40, newsval, True)
+    assert (ival, sval) == (1, "one")
+    tx2.set_int(blk, 80, ival + 1, True)
+    tx2.set_string(blk, 40, sval + "!", True)
     tx2.commit()
 
     # トランザクション3: 値を読み、更新してからロールバック
     tx3 = Transaction(fm, lm, bm)
     tx3.pin(blk)
-    print(f"new value at location 80 = {tx3.get_int(blk, 80)}")
-    print(f"new value at location 40 = {tx3.get_string(blk, 40)}")
-
+    assert tx3.get_int(blk, 80) == 2
+    assert tx3.get_string(blk, 40) == "one!"
     tx3.set_int(blk, 80, 9999, True)
-    print(f"pre-rollback value at location 80 = {tx3.get_int(blk, 80)}")
+    assert tx3.get_int(blk, 80) == 9999
     tx3.rollback()
 
     # トランザクション4: ロールバック後の値を確認
     tx4 = Transaction(fm, lm, bm)
     tx4.pin(blk)
-    print(f"post-rollback at location 80 = {tx4.get_int(blk, 80)}")
+    assert tx4.get_int(blk, 80) == 2
     tx4.commit()
+    db.close()
+
+
+def test_simpledb_recovers_on_reopen(tmp_path, locktbl):
+    db = SimpleDB(str(tmp_path / "txtest"), 400, 8)
+    blk = BlockId("testfile", 0)
+    tx = db.new_tx()
+    tx.pin(blk)
+    tx.set_int(blk, 0, 1, True)
+    tx.commit()
+    tx = db.new_tx()
+    tx.pin(blk)
+    tx.set_int(blk, 0, 2, True)
+    db.bm.flush_all(tx.txnum)  # 未コミットの変更がディスクに出てしまった
+    db.lm.flush(db.lm.latest_lsn)
+    crash(db.fm)
+
+    ConcurrencyMgr.locktbl = LockTable()
+    db = SimpleDB(str(tmp_path / "txtest"), 400, 8)
+    tx = db.new_tx(read_only=True)
+    tx.pin(blk)
+    assert tx.get_int(blk, 0) == 1
+    tx.commit()
+    db.close()